@@ -79,6 +79,12 @@ def serialize(resource):
         ('format', format),
         ('source', source),
         ('type', resource.data_type),
+        ('layers', [
+            OrderedDict([
+                ('name', layer.name),
+                ('type', layer.type),
+                ('summary', layer.summary),
+                ]) for layer in resource.get_layers()]),
         # TODO
         ])
 
@@ -22,10 +22,14 @@ import csv
 from dateutil.relativedelta import relativedelta
 from django.conf import settings
 from django.core.mail import EmailMessage
+from django.core.management import call_command
 from django.utils import timezone
+from idgo_admin.datagis import clean_up_staging_tables
 from idgo_admin.models import Mail
+from idgo_admin.models.layer import rebuild_layergroup
 from idgo_admin.models.mail import get_admins_mails
 from idgo_admin.models import Resource
+from idgo_admin.mra_client import MRA_MIRROR
 from io import StringIO
 from uuid import UUID
 
@@ -66,9 +70,40 @@ def clean_tasktracking_table(*args, **kwargs):
 
 
 @celery_app.task()
-def save_resource(*args, pk=None, **kwargs):
+def clean_up_datagis_staging(*args, **kwargs):
+    clean_up_staging_tables(**kwargs)
+
+
+@celery_app.task()
+def reconcile_mra(*args, **kwargs):
+    # Le miroir des objets MRA n'est tenu que s'il est activé
+    if MRA_MIRROR:
+        call_command('reconcile_mra', **kwargs)
+
+
+@celery_app.task(bind=True)
+def save_resource(self, *args, pk=None, **kwargs):
+    ttracking = TaskTracking.objects.get(uuid=UUID(self.request.id))
+
+    def progress(table_id, count, total):
+        ttracking.detail = {**ttracking.detail, **{
+            'progress': {'table': table_id, 'count': count, 'total': total}}}
+        ttracking.save(update_fields=['detail'])
+
     resource = Resource.objects.get(pk=pk)
-    resource.save(current_user=None, synchronize=True)
+    resource.save(
+        current_user=None, synchronize=True, progress=progress,
+        skip_if_unchanged=True)
+    if resource.quarantine_report:
+        ttracking.detail = {**ttracking.detail, **{
+            'quarantine': resource.quarantine_report}}
+        ttracking.save(update_fields=['detail'])
+
+
+@celery_app.task()
+def rebuild_layergroups(*args, datasets=None, **kwargs):
+    for dataset_id in datasets or []:
+        rebuild_layergroup(dataset_id)
 
 
 @celery_app.task()
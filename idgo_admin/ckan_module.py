@@ -23,11 +23,13 @@ from django.core.exceptions import ValidationError
 from django.db import IntegrityError
 from functools import wraps
 from idgo_admin.exceptions import CkanBaseError
+from idgo_admin.http_client import get_session
 from idgo_admin import logger
 from idgo_admin.utils import Singleton
 import inspect
 import os
-import timeout_decorator
+import requests
+import time
 import unicodedata
 from urllib.parse import urljoin
 
@@ -35,23 +37,14 @@ from urllib.parse import urljoin
 CKAN_URL = settings.CKAN_URL
 CKAN_API_KEY = settings.CKAN_API_KEY
 try:
-    CKAN_TIMEOUT = settings.GEONET_TIMEOUT
+    CKAN_TIMEOUT = settings.CKAN_TIMEOUT
 except AttributeError:
     CKAN_TIMEOUT = 36000
 
-
-def timeout(fun):
-    t = CKAN_TIMEOUT  # in seconds
-
-    @timeout_decorator.timeout(t, use_signals=False)
-    def return_with_timeout(fun, args=tuple(), kwargs=dict()):
-        return fun(*args, **kwargs)
-
-    @wraps(fun)
-    def wrapper(*args, **kwargs):
-        return return_with_timeout(fun, args=args, kwargs=kwargs)
-
-    return wrapper
+# Durée (en secondes) pendant laquelle un site CKAN ayant répondu à
+# `site_read` n'est pas de nouveau vérifié à l'ouverture d'une connexion
+SITE_READ_TTL = 300
+_site_read_at = {}
 
 
 class CkanReadError(CkanBaseError):
@@ -116,7 +109,7 @@ class CkanExceptionsHandler(object):
                 return f(*args, **kwargs)
             except Exception as e:
                 logger.exception(e)
-                if isinstance(e, timeout_decorator.TimeoutError):
+                if isinstance(e, requests.exceptions.Timeout):
                     raise CkanTimeoutError
                 if self.is_ignored(e):
                     return f(*args, **kwargs)
@@ -144,7 +137,12 @@ class CkanBaseHandler(object):
     def __init__(self, url, apikey=None):
 
         self.apikey = apikey
-        self.remote = RemoteCKAN(url, apikey=self.apikey)
+        # Les connexions sont partagées par toutes les instances (Cf. `http_client`)
+        self.remote = RemoteCKAN(
+            url, apikey=self.apikey,
+            session=get_session('ckan', deadline=CKAN_TIMEOUT))
+        if time.monotonic() - _site_read_at.get(url, -SITE_READ_TTL) < SITE_READ_TTL:
+            return
         try:
             res = self.call_action('site_read')
         except Exception:
@@ -154,6 +152,7 @@ class CkanBaseHandler(object):
         if not res:
             self.close()
             raise CkanApiError()
+        _site_read_at[url] = time.monotonic()
 
     def __enter__(self):
         return self
@@ -162,10 +161,9 @@ class CkanBaseHandler(object):
         self.close()
 
     def close(self):
-        self.remote.close()
+        # La session partagée n'est pas fermée
         logger.info('Close CKAN connection')
 
-    # @timeout
     def call_action(self, action, **kwargs):
         return self.remote.call_action(action, kwargs)
 
@@ -213,7 +211,6 @@ class CkanBaseHandler(object):
         return self.get_package(name) and True or False
 
     @CkanExceptionsHandler()
-    # @timeout
     def push_resource(self, package, **kwargs):
         kwargs['package_id'] = package['id']
         kwargs['created'] = datetime.now().isoformat()
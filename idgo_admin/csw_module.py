@@ -23,24 +23,11 @@ import os
 from owslib.csw import CatalogueServiceWeb
 from owslib.fes import PropertyIsEqualTo
 import re
-import timeout_decorator
+import requests
 
 
-CSW_TIMEOUT = 36000
-
-
-def timeout(fun):
-    t = CSW_TIMEOUT  # in seconds
-
-    @timeout_decorator.timeout(t, use_signals=False)
-    def return_with_timeout(fun, args=tuple(), kwargs=dict()):
-        return fun(*args, **kwargs)
-
-    @wraps(fun)
-    def wrapper(*args, **kwargs):
-        return return_with_timeout(fun, args=args, kwargs=kwargs)
-
-    return wrapper
+# Délai (en secondes) appliqué par OWSLib aux sockets
+CSW_TIMEOUT = 3600
 
 
 class CswReadError(CswBaseError):
@@ -77,7 +64,7 @@ class CswExceptionsHandler(object):
                 return f(*args, **kwargs)
             except Exception as e:
                 logger.exception(e)
-                if isinstance(e, timeout_decorator.TimeoutError):
+                if isinstance(e, requests.exceptions.Timeout):
                     raise CswTimeoutError
                 if self.is_ignored(e):
                     return f(*args, **kwargs)
@@ -96,7 +83,7 @@ class CswBaseHandler(object):
         self.password = password
         try:
             self.remote = CatalogueServiceWeb(
-                self.url, timeout=3600, lang='fr-FR', version='2.0.2',
+                self.url, timeout=CSW_TIMEOUT, lang='fr-FR', version='2.0.2',
                 skip_caps=True, username=self.username, password=self.password)
         except Exception:
             raise CswReadError()
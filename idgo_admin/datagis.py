@@ -14,22 +14,50 @@
 # under the License.
 
 
+from ctypes import c_int
+from ctypes import c_void_p
 import datetime
+import django
+import itertools
 from django.apps import apps
 from django.conf import settings
+from django.contrib.gis.gdal import CoordTransform
 from django.contrib.gis.gdal import DataSource
 from django.contrib.gis.gdal.error import GDALException
 from django.contrib.gis.gdal.error import SRSException
+from django.contrib.gis.gdal.libgdal import GDAL_VERSION
+from django.contrib.gis.gdal.libgdal import lgdal
+from django.contrib.gis.gdal.prototypes import ds as capi
 from django.contrib.gis.gdal import GDALRaster
+from django.contrib.gis.gdal import OGRGeometry
+from django.contrib.gis.gdal import SpatialReference
+from django.contrib.gis.geos import GEOSException
+from django.contrib.gis.geos import GEOSGeometry
 from django.db import connections
+from django.db import DatabaseError
+from django.db import OperationalError
+from django.db import transaction
+from django.utils.dateparse import parse_datetime
+from django.utils import timezone
 from django.utils.encoding import DjangoUnicodeDecodeError
 from idgo_admin.exceptions import DatagisBaseError
 from idgo_admin.exceptions import ExceedsMaximumLayerNumberFixedError
 from idgo_admin import logger
+from idgo_admin.utils import Singleton
 from idgo_admin.utils import slugify
 import json
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 from pathlib import Path
+import queue
+import os
 import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from urllib.parse import urlparse
 from uuid import uuid4
 
 
@@ -42,6 +70,152 @@ SCHEMA = 'public'
 THE_GEOM = 'the_geom'
 TO_EPSG = 4171
 
+# Méthode de chargement des données vectorielles :
+# 'insert' (une requête par objet) ou 'copy' (chargement en masse)
+try:
+    LOAD_METHOD = settings.DATAGIS_LOAD_METHOD
+except AttributeError:
+    LOAD_METHOD = 'insert'
+
+# Nombre d'objets chargés par lot
+try:
+    BATCH_SIZE = settings.DATAGIS_BATCH_SIZE
+except AttributeError:
+    BATCH_SIZE = 1000
+
+# Nombre de processus chargeant en parallèle les couches
+# d'une source de données multi-couches
+try:
+    WORKERS = settings.DATAGIS_WORKERS
+except AttributeError:
+    WORKERS = 1
+
+# Schéma dans lequel les données sont chargées avant d'être publiées
+try:
+    STAGING_SCHEMA = settings.DATAGIS_STAGING_SCHEMA
+except AttributeError:
+    STAGING_SCHEMA = 'staging'
+
+# Délai (en secondes) au-delà duquel une table du schéma de chargement
+# qui n'est rattachée à aucun chargement est considérée comme abandonnée
+try:
+    STAGING_EXPIRATION = settings.DATAGIS_STAGING_EXPIRATION
+except AttributeError:
+    STAGING_EXPIRATION = 3600
+
+# Attente maximale d'un verrou lors de la publication des tables
+try:
+    LOCK_TIMEOUT = settings.DATAGIS_LOCK_TIMEOUT
+except AttributeError:
+    LOCK_TIMEOUT = '2s'
+
+# Encodages testés (dans l'ordre) lorsque celui des données n'est pas indiqué
+try:
+    ENCODINGS = settings.DATAGIS_ENCODINGS
+except AttributeError:
+    ENCODINGS = ['utf-8', 'cp1252', 'iso-8859-15', 'iso-8859-1']
+
+# Nombre d'objets lus pour déterminer l'encodage
+try:
+    ENCODING_SAMPLE_SIZE = settings.DATAGIS_ENCODING_SAMPLE_SIZE
+except AttributeError:
+    ENCODING_SAMPLE_SIZE = 1000
+
+# Réparer les géométries invalides plutôt que de rejeter les données ;
+# les objets irréparables sont écartés dans le schéma de quarantaine.
+try:
+    REPAIR_GEOMETRIES = settings.DATAGIS_REPAIR_GEOMETRIES
+except AttributeError:
+    REPAIR_GEOMETRIES = False
+
+try:
+    QUARANTINE_SCHEMA = settings.DATAGIS_QUARANTINE_SCHEMA
+except AttributeError:
+    QUARANTINE_SCHEMA = 'quarantine'
+
+# Réorganiser physiquement les tables selon l'index spatial après chargement
+try:
+    CLUSTER = settings.DATAGIS_CLUSTER
+except AttributeError:
+    CLUSTER = False
+
+# Tables généralisées produites pour l'affichage à petite échelle des couches
+# linéaires et surfaciques : liste de couples (tolérance, dénominateur
+# d'échelle) où la tolérance est exprimée dans l'unité de l'EPSG:4171 (degré),
+# p. ex. `[(0.0001, 50000), (0.001, 500000)]`. La table généralisée est
+# affichée à partir du dénominateur d'échelle indiqué.
+try:
+    GENERALIZATION = settings.DATAGIS_GENERALIZATION
+except AttributeError:
+    GENERALIZATION = []
+
+# Options de création des GeoTIFF optimisés (COG) servis par MapServer
+try:
+    COG_CREATION_OPTIONS = settings.DATAGIS_COG_CREATION_OPTIONS
+except AttributeError:
+    COG_CREATION_OPTIONS = [
+        'TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512',
+        'COMPRESS=DEFLATE', 'BIGTIFF=IF_SAFER']
+
+# Méthode de rééchantillonnage des aperçus
+try:
+    COG_RESAMPLING = settings.DATAGIS_COG_RESAMPLING
+except AttributeError:
+    COG_RESAMPLING = 'average'
+
+# Options de GDAL pour la lecture des sources distantes ou compressées
+# (/vsicurl/, /vsizip/, /vsigzip/, /vsitar/) ; le cache de lecture
+# anticipée est borné. Les variables d'environnement sont prioritaires.
+GDAL_CONFIG = {
+    'CPL_VSIL_CURL_CHUNK_SIZE': 1048576,
+    'CPL_VSIL_CURL_CACHE_SIZE': 67108864,
+    'VSI_CACHE': 'TRUE',
+    'VSI_CACHE_SIZE': 67108864,
+    'GDAL_HTTP_TIMEOUT': 60,
+    'GDAL_HTTP_MAX_RETRY': 5,
+    'GDAL_HTTP_RETRY_DELAY': 2}
+try:
+    GDAL_CONFIG.update(settings.DATAGIS_GDAL_CONFIG)
+except AttributeError:
+    pass
+for key, value in GDAL_CONFIG.items():
+    os.environ.setdefault(key, str(value))
+
+# Les aperçus sont calculés jusqu'à cette taille (en pixels)
+COG_OVERVIEW_MIN_SIZE = 256
+
+LOCK_ATTEMPTS = 5
+LOCK_NOT_AVAILABLE = '55P03'
+
+# Espace de nommage des verrous consultatifs (« advisory locks ») posés
+# pendant un chargement ; une table du schéma de chargement n'est
+# supprimée que si le chargement auquel elle appartient est terminé.
+IMPORT_LOCK_NAMESPACE = 0x1d90
+
+# Durée (en secondes) de conservation en mémoire de l'index des systèmes
+# de coordonnées ; au-delà, les modifications de `SupportedCrs` faites
+# par un autre processus sont prises en compte.
+try:
+    CRS_RESOLVER_TTL = settings.DATAGIS_CRS_RESOLVER_TTL
+except AttributeError:
+    CRS_RESOLVER_TTL = 3600
+
+# Répertoire du cache des tuiles vectorielles
+try:
+    TILES_CACHE_PATH = settings.DATAGIS_TILES_CACHE_PATH
+except AttributeError:
+    TILES_CACHE_PATH = os.path.join(tempfile.gettempdir(), 'idgo_tiles')
+
+# Niveau de zoom maximal des tuiles vectorielles
+try:
+    TILES_MAX_ZOOM = settings.DATAGIS_TILES_MAX_ZOOM
+except AttributeError:
+    TILES_MAX_ZOOM = 22
+
+# Résolution et marge (en unités de tuile) des tuiles vectorielles
+TILE_EXTENT = 4096
+TILE_BUFFER = 64
+
 
 class NotDataGISError(DatagisBaseError):
     message = "Le fichier reçu n'est pas reconnu comme étant un jeu de données SIG."
@@ -67,6 +241,10 @@ class DataDecodingError(DatagisBaseError):
     message = "Impossible de décoder les données correctement."
 
 
+class RasterPreparationError(DatagisBaseError):
+    message = "La préparation des données matricielles a échoué."
+
+
 class SQLError(DatagisBaseError):
     message = "Le fichier reçu n'est pas reconnu comme étant un jeu de données SIG."
 
@@ -76,17 +254,7 @@ class WrongDataError(DatagisBaseError):
 
 
 def is_valid_epsg(code):
-    sql = '''SELECT * FROM public.spatial_ref_sys WHERE auth_srid = '{}';'''.format(code)
-    with connections[DATABASE].cursor() as cursor:
-        try:
-            cursor.execute(sql)
-        except Exception as e:
-            logger.exception(e)
-            if e.__class__.__qualname__ != 'ProgrammingError':
-                raise e
-        records = cursor.fetchall()
-        cursor.close()
-    return len(records) == 1
+    return CrsResolver.is_known(code)
 
 
 def get_proj4s():
@@ -103,32 +271,150 @@ def get_proj4s():
     return records
 
 
-def retreive_epsg_through_proj4(proj4):
+def normalize_proj4_value(value):
+    try:
+        return repr(float(value))
+    except ValueError:
+        return value
 
-    def parse(line):
-        matches = re.finditer('\+(\w+)(=([a-zA-Z0-9\.\,]+))?', line)
-        return set(match.group(0) for match in matches)
 
-    parsed_proj4 = parse(proj4)
-    candidate = []
-    for row in get_proj4s():
-        tested = parse(row[1])
-        if not len(parsed_proj4 - tested) and len(tested - parsed_proj4) < 2:
-            candidate.append(row[0])
-    if len(candidate) == 1:
-        return candidate[0]
+def parse_proj4(line):
+    params = []
+    for match in re.finditer('\+(\w+)(=([a-zA-Z0-9\.\,]+))?', line):
+        key, value = match.group(1), match.group(3)
+        if value is None:
+            params.append('+{}'.format(key))
+        else:
+            params.append('+{}={}'.format(
+                key, ','.join(map(normalize_proj4_value, value.split(',')))))
+    return frozenset(params)
+
+
+class CrsResolver(metaclass=Singleton):
+    """Index en mémoire de `spatial_ref_sys` et de `SupportedCrs`.
+
+    Chaque définition proj4 est indexée par l'empreinte de ses paramètres
+    normalisés, ainsi que par celle de chacun de ses sous-ensembles privés
+    d'un paramètre : une recherche revient donc à un accès au dictionnaire
+    suivi de la vérification des quelques candidats trouvés.
+    """
+
+    def __init__(self, ttl=CRS_RESOLVER_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._srids = None
+        self._proj4s = None
+        self._regexes = None
+        self._loaded_at = None
+
+    def invalidate(self):
+        with self._lock:
+            self._srids = None
+            self._proj4s = None
+            self._regexes = None
+            self._loaded_at = None
+
+    @staticmethod
+    def _key(params):
+        return hash(tuple(sorted(params)))
+
+    def _load(self):
+        with self._lock:
+            if self._loaded_at is not None \
+                    and time.monotonic() - self._loaded_at < self.ttl:
+                return
+
+            srids = set()
+            params_by_srid = {}
+            index = {}
+            for srid, proj4text in get_proj4s():
+                srids.add(srid)
+                if not proj4text:
+                    continue
+                params = parse_proj4(proj4text)
+                params_by_srid[srid] = params
+                index.setdefault(self._key(params), []).append(srid)
+                for param in params:
+                    index.setdefault(self._key(params - {param}), []).append(srid)
+
+            SupportedCrs = apps.get_model(
+                app_label='idgo_admin', model_name='SupportedCrs')
+            regexes = [
+                (re.compile(regex, flags=re.IGNORECASE), auth_code)
+                for regex, auth_code
+                in SupportedCrs.objects.values_list('regex', 'auth_code')
+                if regex]
+
+            self._srids = srids
+            self._proj4s = (params_by_srid, index)
+            self._regexes = regexes
+            self._loaded_at = time.monotonic()
+
+            logger.debug('CRS resolver loaded: {} proj4 definitions, {} regex'.format(
+                len(params_by_srid), len(regexes)))
+
+    def is_known(self, code):
+        self._load()
+        try:
+            return int(code) in self._srids
+        except (TypeError, ValueError):
+            return False
+
+    def through_proj4(self, proj4):
+        self._load()
+        params_by_srid, index = self._proj4s
+
+        parsed = parse_proj4(proj4)
+        # Même critère que précédemment : tous les paramètres reçus sont
+        # présents dans la définition, qui peut en compter un de plus.
+        candidate = [
+            srid for srid in set(index.get(self._key(parsed), []))
+            if parsed <= params_by_srid[srid]
+            and len(params_by_srid[srid] - parsed) < 2]
+        if len(candidate) == 1:
+            return candidate[0]
+
+    def through_regex(self, text):
+        self._load()
+        for regex, auth_code in self._regexes:
+            if regex.match(text):
+                return auth_code
+
+
+CrsResolver = CrsResolver()
+
+
+def retreive_epsg_through_proj4(proj4):
+    return CrsResolver.through_proj4(proj4)
 
 
 def retreive_epsg_through_regex(text):
+    return CrsResolver.through_regex(text)
 
-    SupportedCrs = apps.get_model(
-        app_label='idgo_admin', model_name='SupportedCrs')
 
-    for supported_crs in SupportedCrs.objects.all():
-        if not supported_crs.regex:
-            continue
-        if re.match(supported_crs.regex, text, flags=re.IGNORECASE):
-            return supported_crs.auth_code
+def is_remote(filename):
+    return urlparse(filename).scheme in ('http', 'https', 'ftp')
+
+
+def vsi_path(filename, extension=None):
+    """Retourner le chemin GDAL permettant de lire la source sans la copier.
+
+    Les sources distantes sont lues par `/vsicurl/` et les archives
+    (locales ou distantes) par `/vsizip/`, `/vsitar/` ou `/vsigzip/`.
+    """
+    path = filename
+    name = filename.lower()
+    if is_remote(filename):
+        path = '/vsicurl/{}'.format(filename)
+        name = urlparse(filename).path.lower()
+
+    if extension == 'zip' or name.endswith('.zip'):
+        path = '/vsizip/{}'.format(path)
+    elif extension == 'tar' or name.endswith(('.tar', '.tar.gz', '.tgz')):
+        path = '/vsitar/{}'.format(path)
+    elif name.endswith('.gz'):
+        path = '/vsigzip/{}'.format(path)
+    return path
 
 
 class GdalOpener(object):
@@ -137,8 +423,7 @@ class GdalOpener(object):
 
     def __init__(self, filename, extension=None):
 
-        if extension == 'zip':
-            filename = '/vsizip/{}'.format(filename)
+        filename = vsi_path(filename, extension=extension)
 
         try:
             self._coverage = GDALRaster(filename)
@@ -159,8 +444,7 @@ class OgrOpener(object):
 
     def __init__(self, filename, extension=None):
 
-        if extension == 'zip':
-            filename = '/vsizip/{}'.format(filename)
+        filename = vsi_path(filename, extension=extension)
 
         try:
             self._datastore = DataSource(filename)
@@ -188,18 +472,700 @@ def get_gdalogr_object(filename, extension):
 CREATE_TABLE = '''
 CREATE TABLE {schema}."{table}" (
   fid serial NOT NULL, {attrs}
-  {the_geom} geometry({geometry}, {to_epsg}),
-  CONSTRAINT "{table}_pkey" PRIMARY KEY (fid)) WITH (OIDS=FALSE);
+  {the_geom} geometry({geometry}, {to_epsg})) WITH (OIDS=FALSE);
 ALTER TABLE {schema}."{table}" OWNER TO {owner};
-CREATE UNIQUE INDEX "{table}_fid" ON {schema}."{table}" USING btree (fid);
-CREATE INDEX "{table}_gix" ON {schema}."{table}" USING GIST ({the_geom});
 GRANT SELECT ON TABLE  {schema}."{table}" TO {mra_datagis_user};
 '''
 
 
+def create_table_sql(table_id, attributes, geometry, schema=SCHEMA, comment=None):
+    if attributes:
+        attrs = '\n  {attrs},\n  '.format(
+            attrs=',\n  '.join(['"{}" {}'.format(k, v) for k, v in attributes.items()])
+            )
+    else:
+        attrs = ''
+
+    sql = CREATE_TABLE.format(
+        attrs=attrs,
+        geometry=geometry,
+        owner=OWNER,
+        mra_datagis_user=MRA_DATAGIS_USER,
+        schema=schema,
+        table=str(table_id),
+        the_geom=THE_GEOM,
+        to_epsg=TO_EPSG)
+    if comment:
+        sql += COMMENT_ON_TABLE.format(
+            comment=comment, schema=schema, table=str(table_id))
+    return sql
+
+
+CREATE_STAGING_TABLE = '''
+CREATE TEMPORARY TABLE "{staging}" ({attrs}{the_geom} geometry, _id serial) ON COMMIT DROP;'''
+
+
 INSERT_INTO = '''
-INSERT INTO {schema}."{table}" ({attrs_name}{the_geom})
-VALUES ({attrs_value}ST_Transform({geom}, {to_epsg}));'''
+INSERT INTO "{staging}" ({attrs_name}{the_geom})
+VALUES {values};'''
+
+
+INSERT_VALUES = '''
+  ({attrs_value}{geom})'''
+
+
+COPY_FROM = '''
+COPY "{staging}" ({attrs_name}{the_geom}) FROM STDIN;'''
+
+
+# La synthèse de la table (Cf. `summarize_table`) est calculée
+# sur les lignes insérées, dans la même requête.
+INSERT_FROM_STAGING = '''
+WITH inserted AS (
+  INSERT INTO {schema}."{table}" ({attrs_name}{the_geom})
+  SELECT {attrs_name}ST_Transform({geom}, {to_epsg}) FROM "{staging}"
+  RETURNING {attrs_name}{the_geom})
+SELECT count(*), coalesce(sum(ST_NPoints({the_geom})), 0),
+  min(ST_XMin({the_geom})), min(ST_YMin({the_geom})),
+  max(ST_XMax({the_geom})), max(ST_YMax({the_geom})){aggregates}
+FROM inserted;'''
+
+
+# La clé primaire et les index sont créés une fois
+# les données chargées (Cf. `finalize_table`)
+CREATE_INDEXES = '''
+ALTER TABLE {schema}."{table}" ADD CONSTRAINT "{table}_pkey" PRIMARY KEY (fid);
+CREATE INDEX "{table}_gix" ON {schema}."{table}" USING GIST ({the_geom});'''
+
+
+CLUSTER_TABLE = '''
+CLUSTER {schema}."{table}" USING "{table}_gix";'''
+
+
+ANALYZE_TABLE = '''
+ANALYZE {schema}."{table}";'''
+
+
+# Les sommets sont d'abord alignés sur une grille dix fois plus fine que
+# la tolérance (ce qui élimine les sommets redondants), puis la géométrie
+# est simplifiée sans que les anneaux ne se croisent.
+CREATE_GENERALIZED_TABLE = '''
+DROP TABLE IF EXISTS {schema}."{generalized}";
+CREATE TABLE {schema}."{generalized}" AS
+SELECT fid, {attrs_name}ST_SimplifyPreserveTopology(
+  ST_SnapToGrid({the_geom}, {grid}), {tolerance})::geometry({geometry}, {to_epsg}) AS {the_geom}
+FROM {schema}."{table}";
+ALTER TABLE {schema}."{generalized}" ADD CONSTRAINT "{generalized}_pkey" PRIMARY KEY (fid);
+CREATE INDEX "{generalized}_gix" ON {schema}."{generalized}" USING GIST ({the_geom});
+ALTER TABLE {schema}."{generalized}" OWNER TO {owner};
+GRANT SELECT ON TABLE {schema}."{generalized}" TO {mra_datagis_user};
+ANALYZE {schema}."{generalized}";'''
+
+
+# Fonctions (temporaires) de réparation et de reprojection qui retournent
+# NULL plutôt qu'une erreur ; elles ne sont appelées que pour les objets
+# invalides, ou si la reprojection de l'ensemble des objets a échoué.
+CREATE_REPAIR_FUNCTIONS = '''
+CREATE OR REPLACE FUNCTION pg_temp.idgo_make_valid(g geometry, dim integer, multi boolean)
+RETURNS geometry AS $$
+DECLARE
+  r geometry;
+BEGIN
+  r := ST_MakeValid(g);
+  IF dim IS NOT NULL THEN
+    r := ST_CollectionExtract(r, dim);
+    IF NOT multi THEN
+      IF ST_NumGeometries(r) <> 1 THEN
+        RETURN NULL;
+      END IF;
+      r := ST_GeometryN(r, 1);
+    END IF;
+  END IF;
+  IF r IS NULL OR ST_IsEmpty(r) OR NOT ST_IsValid(r) THEN
+    RETURN NULL;
+  END IF;
+  RETURN r;
+EXCEPTION WHEN OTHERS THEN
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+CREATE OR REPLACE FUNCTION pg_temp.idgo_try_transform(g geometry, srid_in integer, srid_out integer)
+RETURNS geometry AS $$
+BEGIN
+  RETURN ST_Transform(ST_SetSRID(g, srid_in), srid_out);
+EXCEPTION WHEN OTHERS THEN
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;'''
+
+
+# La table de quarantaine est chargée à côté de la table de données, puis
+# publiée avec elle dans le schéma `QUARANTINE_SCHEMA` (Cf. `publish_tables`).
+CREATE_QUARANTINE_TABLE = '''
+DROP TABLE IF EXISTS {quarantine};
+CREATE TABLE {quarantine} AS
+SELECT *, NULL::text AS _error FROM "{staging}" WITH NO DATA;'''
+
+
+REPAIR_GEOMETRIES_SQL = '''
+CREATE TEMPORARY TABLE "{repaired}" ON COMMIT DROP AS
+SELECT _id, pg_temp.idgo_make_valid({the_geom}, {dim}, {multi}) AS geom
+FROM "{staging}" WHERE {the_geom} IS NOT NULL AND NOT ST_IsValid({the_geom});
+INSERT INTO {quarantine}
+SELECT *, 'Géométrie absente ou illisible' FROM "{staging}" WHERE {the_geom} IS NULL;
+INSERT INTO {quarantine}
+SELECT s.*, 'Géométrie invalide irréparable' FROM "{staging}" s
+JOIN "{repaired}" r ON s._id = r._id WHERE r.geom IS NULL;
+DELETE FROM "{staging}" WHERE {the_geom} IS NULL
+OR _id IN (SELECT _id FROM "{repaired}" WHERE geom IS NULL);
+UPDATE "{staging}" s SET {the_geom} = r.geom FROM "{repaired}" r WHERE s._id = r._id;'''
+
+
+QUARANTINE_UNTRANSFORMABLE = '''
+CREATE TEMPORARY TABLE "{failed}" ON COMMIT DROP AS
+SELECT _id FROM "{staging}"
+WHERE pg_temp.idgo_try_transform({the_geom}, {epsg}, {to_epsg}) IS NULL;
+INSERT INTO {quarantine}
+SELECT *, 'Reprojection impossible' FROM "{staging}" WHERE _id IN (SELECT _id FROM "{failed}");
+DELETE FROM "{staging}" WHERE _id IN (SELECT _id FROM "{failed}");'''
+
+
+# Estimations disponibles après `ANALYZE`
+COLUMN_STATISTICS = '''
+SELECT attname, n_distinct FROM pg_stats
+WHERE schemaname = %s AND tablename = %s;'''
+
+
+COMMENT_ON_TABLE = '''
+COMMENT ON TABLE {schema}."{table}" IS '{comment}';'''
+
+
+TRY_IMPORT_LOCK = '''
+SELECT pg_try_advisory_lock(%s, %s);'''
+
+
+IMPORT_UNLOCK = '''
+SELECT pg_advisory_unlock(%s, %s);'''
+
+
+CREATE_STAGING_SCHEMA = '''
+CREATE SCHEMA IF NOT EXISTS {staging_schema} AUTHORIZATION {owner};'''
+
+
+TABLE_COLUMNS = '''
+SELECT a.attname, format_type(a.atttypid, a.atttypmod) FROM pg_attribute a
+WHERE a.attrelid = %s::regclass AND a.attnum > 0 AND NOT a.attisdropped
+ORDER BY a.attnum;'''
+
+
+# Les objets sont identifiés par l'empreinte de leurs valeurs ; le rang
+# de l'objet parmi ceux de même empreinte permet de gérer les doublons.
+CREATE_HASH_TABLE = '''
+CREATE TEMPORARY TABLE "{hash_table}" ON COMMIT DROP AS
+SELECT fid, hash, row_number() OVER (PARTITION BY hash ORDER BY fid) AS rank
+FROM (SELECT fid, md5(ROW({columns})::text) AS hash FROM {schema}."{table}") AS t;
+CREATE INDEX ON "{hash_table}" (hash, rank);'''
+
+
+DELETE_REMOVED_FEATURES = '''
+DELETE FROM {schema}."{table}" WHERE fid IN (
+  SELECT a.fid FROM "{old}" a LEFT JOIN "{new}" b
+  ON a.hash = b.hash AND a.rank = b.rank WHERE b.fid IS NULL);'''
+
+
+INSERT_ADDED_FEATURES = '''
+INSERT INTO {schema}."{table}" ({columns})
+SELECT {columns} FROM {staging_schema}."{table}" WHERE fid IN (
+  SELECT b.fid FROM "{new}" b LEFT JOIN "{old}" a
+  ON a.hash = b.hash AND a.rank = b.rank WHERE a.fid IS NULL);'''
+
+
+PUBLISH_TABLE = '''
+DROP TABLE IF EXISTS {schema}."{table}";
+ALTER TABLE {staging_schema}."{table}" SET SCHEMA {schema};
+COMMENT ON TABLE {schema}."{table}" IS NULL;'''
+
+
+# La quarantaine précédente est remplacée par celle du chargement, s'il y en a une
+PUBLISH_QUARANTINE_TABLE = '''
+DROP TABLE IF EXISTS {quarantine_schema}."{table}";
+ALTER TABLE IF EXISTS {staging_schema}."{quarantine}" SET SCHEMA {quarantine_schema};
+ALTER TABLE IF EXISTS {quarantine_schema}."{quarantine}" RENAME TO "{table}";'''
+
+
+class CopyStream(object):
+    """Objet « fichier » alimenté par un générateur de lignes (pour `COPY`)."""
+
+    def __init__(self, lines):
+        self._lines = lines
+        self._buffer = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += next(self._lines)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self._buffer)
+        chunk, self._buffer = self._buffer[:size], self._buffer[size:]
+        return chunk
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+
+# Chaîne de traitement des objets : lecture -> conversion -> écriture
+# ===================================================================
+
+
+def batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def detect_encoding(layers, sample_size=None):
+    """Déterminer l'encodage des attributs à partir d'un échantillon d'objets.
+
+    Lorsque le fichier .cpg ou l'entête DBF l'indique, le pilote OGR
+    convertit déjà les valeurs en UTF-8 : l'échantillon le confirme.
+    Sinon, le premier encodage de `ENCODINGS` qui permet de décoder toutes
+    les valeurs de l'échantillon est retenu.
+    """
+    samples = []
+    for layer in layers:
+        indexes = [
+            i for i, t in enumerate(layer.field_types)
+            if t.__qualname__.startswith(('OFTString', 'OFTWideString'))]
+        if not indexes:
+            continue
+        for feature in itertools.islice(layer, sample_size or ENCODING_SAMPLE_SIZE):
+            for i in indexes:
+                value = capi.get_field_as_string(feature.ptr, i)
+                if value and max(value) > 0x7f:
+                    samples.append(value)
+
+    if not samples:
+        return ENCODINGS[0]
+
+    for encoding in ENCODINGS:
+        try:
+            for value in samples:
+                value.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+        return encoding
+    raise DataDecodingError()
+
+
+def read_features(layer, attributes, geom_types, repair=False):
+    """Lire les objets de la couche : retourne des couples (valeurs, géométrie).
+
+    Les types de géométrie rencontrés sont ajoutés à `geom_types`
+    au fil de la lecture. En mode `repair`, une géométrie illisible
+    est retournée comme nulle (l'objet sera mis en quarantaine).
+    """
+    for feature in layer:
+        properties = []
+        for k in attributes.keys():
+            try:
+                v = feature.get(k)
+            except DjangoUnicodeDecodeError as e:
+                logger.exception(e)
+                raise DataDecodingError()
+            properties.append(v)
+        try:
+            geom = feature.geom
+            geom_types.add(str(geom.geom_type))
+        except Exception as e:
+            if not repair:
+                logger.exception(e)
+                raise WrongDataError()
+            logger.warning(e)
+            geom = None
+        yield properties, geom
+
+
+def sql_value(v):
+    if isinstance(v, type(None)):
+        return 'null'
+    if isinstance(v, (datetime.date, datetime.time, datetime.datetime)):
+        return "'{}'".format(v.isoformat())
+    if isinstance(v, str):
+        return "'{}'".format(v.replace("'", "''"))
+    return '{}'.format(v)
+
+
+def copy_value(v):
+    # Format texte de `COPY` : NULL vaut `\N` et les caractères
+    # de contrôle (séparateurs) doivent être échappés.
+    if isinstance(v, type(None)):
+        return '\\N'
+    if isinstance(v, (datetime.date, datetime.time, datetime.datetime)):
+        v = v.isoformat()
+    return str(v) \
+        .replace('\\', '\\\\') \
+        .replace('\n', '\\n') \
+        .replace('\r', '\\r') \
+        .replace('\t', '\\t')
+
+
+def attributes_name(attributes):
+    if not attributes:
+        return ''
+    return ', '.join(['"{}"'.format(k) for k in attributes.keys()]) + ', '
+
+
+def insert_features(cursor, features, staging, attributes, batch_size=None):
+    """Écrire les objets dans la table temporaire par lots de requêtes `INSERT`.
+
+    Générateur : retourne le nombre d'objets écrits pour chaque lot.
+    """
+    def values():
+        for properties, geom in features:
+            yield INSERT_VALUES.format(
+                attrs_value=''.join(
+                    ['{}, '.format(sql_value(v)) for v in properties]),
+                geom=geom is None and 'null' or "ST_GeomFromtext('{}')".format(geom.wkt))
+
+    for batch in batched(values(), batch_size or BATCH_SIZE):
+        cursor.execute(INSERT_INTO.format(
+            attrs_name=attributes_name(attributes),
+            staging=staging,
+            the_geom=THE_GEOM,
+            values=','.join(batch)))
+        yield len(batch)
+
+
+def copy_features(cursor, features, staging, attributes, batch_size=None):
+    """Écrire les objets dans la table temporaire avec `COPY` (géométries en WKB).
+
+    Générateur : retourne le nombre d'objets écrits pour chaque lot.
+    """
+    def lines():
+        for properties, geom in features:
+            values = [copy_value(v) for v in properties]
+            values.append(geom is None and '\\N' or geom.hex.decode())
+            yield '{}\n'.format('\t'.join(values))
+
+    for batch in batched(lines(), batch_size or BATCH_SIZE):
+        cursor.copy_expert(COPY_FROM.format(
+            attrs_name=attributes_name(attributes),
+            staging=staging,
+            the_geom=THE_GEOM),
+            CopyStream(iter(batch)))
+        yield len(batch)
+
+
+def finalize_table(cursor, table_id, schema=SCHEMA, cluster=None):
+    """Créer la clé primaire et les index d'une table chargée,
+    la réorganiser et l'analyser.
+
+    Retourne la durée (en secondes) de chacune des étapes.
+    """
+    if cluster is None:
+        cluster = CLUSTER
+    timings = {}
+
+    def timed(step, sql):
+        t0 = time.monotonic()
+        cursor.execute(sql.format(
+            schema=schema, table=str(table_id), the_geom=THE_GEOM))
+        timings[step] = round(time.monotonic() - t0, 3)
+
+    timed('index', CREATE_INDEXES)
+    if cluster:
+        timed('cluster', CLUSTER_TABLE)
+    timed('analyze', ANALYZE_TABLE)
+
+    return timings
+
+
+def generalized_table_name(table_id, level):
+    return '{}_g{}'.format(table_id, level)
+
+
+def generalize_table(cursor, table_id, attributes, geometry, schema=SCHEMA,
+                     generalization=None, import_lock=None):
+    """Créer les tables généralisées d'une table tout juste chargée.
+
+    Les couches ponctuelles ne sont pas généralisées. Retourne pour chaque
+    table créée son nom, la tolérance et le dénominateur d'échelle à partir
+    duquel elle est affichée.
+    """
+    if generalization is None:
+        generalization = GENERALIZATION
+    if 'Point' in geometry or geometry == 'Geometry':
+        return []
+
+    generalized = []
+    for level, (tolerance, scale) in enumerate(
+            sorted(generalization, key=lambda item: item[1]), start=1):
+        name = generalized_table_name(table_id, level)
+        cursor.execute(CREATE_GENERALIZED_TABLE.format(
+            attrs_name=attributes_name(attributes),
+            generalized=name,
+            geometry=geometry,
+            grid=tolerance / 10,
+            mra_datagis_user=MRA_DATAGIS_USER,
+            owner=OWNER,
+            schema=schema,
+            table=str(table_id),
+            the_geom=THE_GEOM,
+            to_epsg=TO_EPSG,
+            tolerance=tolerance))
+        if schema != SCHEMA:
+            cursor.execute(COMMENT_ON_TABLE.format(
+                comment=staging_comment(import_lock),
+                schema=schema, table=name))
+        generalized.append(
+            {'name': name, 'tolerance': tolerance, 'scale': scale})
+
+    return generalized
+
+
+def summary_aggregates(attributes):
+    aggregates = ''
+    for name, type in attributes.items():
+        if type == 'bytea':
+            aggregates += ', count("{0}"), NULL, NULL'.format(name)
+        else:
+            aggregates += ', count("{0}"), min("{0}")::text, max("{0}")::text'.format(name)
+    return aggregates
+
+
+def summarize_table(cursor, record, table_id, attributes, geometry,
+                    schema=SCHEMA, max_length=255):
+    """Établir la synthèse d'une table tout juste chargée et analysée.
+
+    Les décomptes, l'emprise et les bornes des attributs (`record`) sont
+    calculés lors de l'insertion des objets (Cf. `INSERT_FROM_STAGING`) ;
+    le nombre de valeurs distinctes est celui estimé par `ANALYZE`.
+    """
+    count, vertices = record[0], record[1]
+    extent = record[2] is not None and list(record[2:6]) or None
+
+    cursor.execute(COLUMN_STATISTICS, [schema, str(table_id)])
+    n_distinct = dict(cursor.fetchall())
+
+    def estimate(name):
+        n = n_distinct.get(name)
+        if n is None:
+            return None
+        # Une valeur négative est une proportion du nombre de lignes
+        return int(round(n < 0 and -n * count or n))
+
+    def truncate(value):
+        return value and value[:max_length]
+
+    return {
+        'count': count,
+        'geometry': geometry,
+        'vertices': vertices,
+        'extent': extent,
+        'attributes': [{
+            'name': name,
+            'type': type,
+            'nulls': count - record[6 + i * 3],
+            'min': truncate(record[7 + i * 3]),
+            'max': truncate(record[8 + i * 3]),
+            'distinct': estimate(name),
+            } for i, (name, type) in enumerate(attributes.items())]}
+
+
+def quarantine_table_name(table_id):
+    return '{}_q'.format(table_id)
+
+
+def quarantine_table(table_id, schema=SCHEMA):
+    """Retourner le nom qualifié de la table de quarantaine de `table_id`
+    chargée dans le schéma `schema` (Cf. `PUBLISH_QUARANTINE_TABLE`)."""
+    if schema == SCHEMA:
+        return '{}."{}"'.format(QUARANTINE_SCHEMA, table_id)
+    return '{}."{}"'.format(schema, quarantine_table_name(table_id))
+
+
+def repair_features(cursor, staging, table_id, geometry, schema=SCHEMA):
+    """Réparer les géométries invalides de la table temporaire.
+
+    Les objets sans géométrie ou dont la géométrie ne peut être réparée
+    sont déplacés dans la table de quarantaine de la couche (Cf.
+    `quarantine_table`), qui doit exister.
+
+    Retourne le nombre d'objets réparés et d'objets mis en quarantaine.
+    """
+    repaired = '_{}'.format(str(uuid4())[:7])
+    dim = {'Point': 1, 'LineString': 2, 'Polygon': 3}.get(
+        re.sub('^Multi|Z$', '', geometry))
+
+    quarantine = quarantine_table(table_id, schema=schema)
+    cursor.execute(REPAIR_GEOMETRIES_SQL.format(
+        dim=dim or 'NULL',
+        multi=geometry.startswith('Multi') and 'true' or 'false',
+        quarantine=quarantine,
+        repaired=repaired,
+        staging=staging,
+        the_geom=THE_GEOM))
+
+    cursor.execute(
+        'SELECT count(*) FROM "{}" WHERE geom IS NOT NULL;'.format(repaired))
+    count = cursor.fetchone()[0]
+    cursor.execute('SELECT count(*) FROM {};'.format(quarantine))
+    return count, cursor.fetchone()[0]
+
+
+def quarantine_untransformable(cursor, staging, table_id, epsg, schema=SCHEMA):
+    """Mettre en quarantaine les objets qui ne peuvent être reprojetés."""
+    failed = '_{}'.format(str(uuid4())[:7])
+    cursor.execute(QUARANTINE_UNTRANSFORMABLE.format(
+        epsg=epsg,
+        failed=failed,
+        quarantine=quarantine_table(table_id, schema=schema),
+        staging=staging,
+        the_geom=THE_GEOM,
+        to_epsg=TO_EPSG))
+    cursor.execute('SELECT count(*) FROM "{}";'.format(failed))
+    return cursor.fetchone()[0]
+
+
+def load_layer(cursor, layer, table_id, attributes, epsg, schema=SCHEMA,
+               method=None, batch_size=None, progress=None, repair=None,
+               import_lock=None):
+    """Charger une couche de données dans la table `table_id` en une seule lecture.
+
+    Les objets sont d'abord écrits dans une table temporaire dont la colonne
+    géométrique n'est pas typée ; le type de géométrie est déterminé pendant
+    la lecture, puis la table définitive est créée et alimentée en une seule
+    requête (avec reprojection) qui en calcule aussi la synthèse. La clé
+    primaire et les index ne sont créés qu'ensuite.
+
+    En mode `repair`, les géométries invalides sont réparées et les objets
+    qui ne peuvent être chargés sont mis en quarantaine (Cf.
+    `quarantine_table`) plutôt que de faire échouer le chargement. Le
+    décompte figure dans la synthèse.
+
+    Les tables généralisées (Cf. `GENERALIZATION`) sont créées dans le
+    même schéma et sont indiquées dans la synthèse.
+
+    Hors du schéma publié, les tables sont rattachées au chargement
+    `import_lock` (Cf. `acquire_import_lock`).
+
+    Retourne le type de géométrie de la table, la durée des différentes
+    étapes du chargement et la synthèse de la table.
+    """
+    write_features = \
+        (method or LOAD_METHOD) == 'copy' and copy_features or insert_features
+    if repair is None:
+        repair = REPAIR_GEOMETRIES
+    staging = '_{}'.format(str(uuid4())[:7])
+    geom_types = set()
+
+    if attributes:
+        attrs = ', '.join(
+            ['"{}" {}'.format(k, v) for k, v in attributes.items()]) + ', '
+    else:
+        attrs = ''
+
+    total = len(layer)
+    count = 0
+    t0 = time.monotonic()
+    with transaction.atomic(using=DATABASE):
+        cursor.execute(CREATE_STAGING_TABLE.format(
+            attrs=attrs, staging=staging, the_geom=THE_GEOM))
+
+        features = read_features(layer, attributes, geom_types, repair=repair)
+        for n in write_features(
+                cursor, features, staging, attributes, batch_size=batch_size):
+            count += n
+            logger.debug('Table "{}": {}/{} features loaded'.format(
+                table_id, count, total))
+            progress and progress(table_id, count, total)
+
+        geometry = handle_geometry_types(geom_types)
+
+        # Le chargement d'origine permet de détecter les tables abandonnées
+        cursor.execute(create_table_sql(
+            table_id, attributes, geometry, schema=schema,
+            comment=schema != SCHEMA and staging_comment(import_lock) or None))
+
+        if geometry.startswith('Multi'):
+            geom = 'ST_Multi(ST_SetSRID({the_geom}, {epsg}))'
+        else:
+            geom = 'ST_SetSRID({the_geom}, {epsg})'
+
+        insert_from_staging = INSERT_FROM_STAGING.format(
+            aggregates=summary_aggregates(attributes),
+            attrs_name=attributes_name(attributes),
+            geom=geom.format(epsg=epsg, the_geom=THE_GEOM),
+            schema=schema,
+            staging=staging,
+            table=str(table_id),
+            the_geom=THE_GEOM,
+            to_epsg=TO_EPSG)
+
+        repaired = quarantined = 0
+        if repair:
+            quarantine = quarantine_table(table_id, schema=schema)
+            cursor.execute(CREATE_REPAIR_FUNCTIONS)
+            cursor.execute(CREATE_QUARANTINE_TABLE.format(
+                quarantine=quarantine, staging=staging))
+            if schema != SCHEMA:
+                cursor.execute(COMMENT_ON_TABLE.format(
+                    comment=staging_comment(import_lock), schema=schema,
+                    table=quarantine_table_name(table_id)))
+            repaired, quarantined = repair_features(
+                cursor, staging, table_id, geometry, schema=schema)
+            try:
+                with transaction.atomic(using=DATABASE):
+                    cursor.execute(insert_from_staging)
+                    record = cursor.fetchone()
+            except DatabaseError as e:
+                # Les objets en cause ne sont recherchés qu'en cas d'échec
+                logger.warning(e)
+                quarantined += quarantine_untransformable(
+                    cursor, staging, table_id, epsg, schema=schema)
+                cursor.execute(insert_from_staging)
+                record = cursor.fetchone()
+            if quarantined:
+                logger.warning('Table "{}": {} features quarantined'.format(
+                    table_id, quarantined))
+            else:
+                cursor.execute('DROP TABLE {};'.format(quarantine))
+        else:
+            cursor.execute(insert_from_staging)
+            record = cursor.fetchone()
+
+        timings = {'load': round(time.monotonic() - t0, 3)}
+        timings.update(finalize_table(cursor, table_id, schema=schema))
+
+        t0 = time.monotonic()
+        summary = summarize_table(
+            cursor, record, table_id, attributes, geometry, schema=schema)
+        summary['repaired'] = repaired
+        summary['quarantined'] = quarantined
+        # Identifiant du chargement, qui versionne les tuiles vectorielles,
+        # et colonnes encodées dans celles-ci (Cf. `get_tile`)
+        summary['load'] = uuid4().hex[:12]
+        summary['tile_columns'] = tile_columns(attributes)
+        timings['summary'] = round(time.monotonic() - t0, 3)
+
+        if GENERALIZATION:
+            t0 = time.monotonic()
+            summary['generalized'] = generalize_table(
+                cursor, table_id, attributes, geometry, schema=schema,
+                import_lock=import_lock)
+            timings['generalize'] = round(time.monotonic() - t0, 3)
+
+    logger.info('Table "{}" loaded: {}'.format(table_id, ', '.join(
+        '{} {}s'.format(step, duration) for step, duration in timings.items())))
+
+    return {'geometry': geometry, 'timings': timings, 'summary': summary}
 
 
 def handle_ogr_field_type(k, n=None, p=None):
@@ -236,6 +1202,40 @@ def handle_ogr_geom_type(ogr_geom_type):
         }.get(ogr_geom_type.name.lower(), ogr_geom_type.name)  # 'Geometry')
 
 
+def handle_geometry_types(test):
+    # Erreur dans Django
+    # Lorsqu'un 'layer' est composé de 'feature' de géométrie différente,
+    # `ft.geom.__class__.__qualname__ == feat.geom_type.name is False`
+    #
+    #       > django/contrib/gis/gdal/feature.py
+    #       @property
+    #       def geom_type(self):
+    #           "Return the OGR Geometry Type for this Feture."
+    #           return OGRGeomType(capi.get_fd_geom_type(self._layer._ldefn))
+    #
+    # La fonction est incorrecte puisqu'elle se base sur le 'layer' et non
+    # sur le 'feature'
+    #
+    # Donc on détermine le type de géométrie de la couche à partir de
+    # l'ensemble des types rencontrés lors de la lecture des objets, et
+    # dans le cas d'un mélange on le définit comme générique (soit 'Geometry')
+    if test == {'Polygon', 'MultiPolygon'}:
+        return 'MultiPolygon'
+    elif test == {'Polygon25D', 'MultiPolygon25D'}:
+        return 'MultiPolygonZ'
+    elif test == {'LineString', 'MultiLineString'}:
+        return 'MultiLineString'
+    elif test == {'LineString25D', 'MultiLineString25D'}:
+        return 'MultiLineStringZ'
+    elif test == {'Point', 'MultiPoint'}:
+        return 'MultiPoint'
+    elif test == {'Point25D', 'MultiPoint25D'}:
+        return 'MultiPointZ'
+    # geometry = len(test) > 1 \
+    #     and 'Geometry' or handle_ogr_geom_type(layer.geom_type)
+    return len(test) == 1 and list(test)[0] or 'Geometry'
+
+
 def get_epsg(obj):
     epsg = None
     if obj.srs:
@@ -292,23 +1292,255 @@ def gdalinfo(coverage, epsg=None, update={}):
         'extent': ((xmin, ymin), (xmax, ymax))}
 
 
+def overview_levels(width, height, min_size=COG_OVERVIEW_MIN_SIZE):
+    levels = []
+    factor = 2
+    while max(width, height) / factor >= min_size:
+        levels.append(factor)
+        factor *= 2
+    return levels
+
+
+def source_fingerprint(filename):
+    """Retourner l'empreinte d'un fichier local (taille, date de modification
+    et inode), ou rien s'il n'existe pas (ou est distant)."""
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return {
+        'size': st.st_size,
+        'mtime': st.st_mtime_ns,
+        'inode': [st.st_dev, st.st_ino]}
+
+
+def fingerprint_filename(dst):
+    return '{}.json'.format(dst)
+
+
+def is_up_to_date(dst, fingerprint):
+    """Vérifier que le fichier `dst` existe et a été produit à partir
+    de la source d'empreinte `fingerprint` (Cf. `gdal2cog`)."""
+    if not fingerprint or not os.path.exists(dst):
+        return False
+    try:
+        with open(fingerprint_filename(dst)) as f:
+            return json.load(f) == fingerprint
+    except (OSError, ValueError):
+        return False
+
+
+def write_fingerprint(dst, fingerprint):
+    filename = fingerprint_filename(dst)
+    if not fingerprint:
+        if os.path.exists(filename):
+            os.remove(filename)
+        return
+    tmp = '{}.{}'.format(filename, str(uuid4())[:7])
+    with open(tmp, 'w') as f:
+        json.dump(fingerprint, f)
+    os.replace(tmp, filename)
+
+
+def gdal2cog(coverage, dst, resampling=None, creation_options=None,
+             force=False, fingerprint=None):
+    """Écrire la donnée matricielle en GeoTIFF tuilé, compressé et doté
+    d'aperçus internes (Cloud Optimized GeoTIFF).
+
+    Les aperçus sont calculés sur une copie intermédiaire puis recopiés
+    en tête de fichier (`COPY_SRC_OVERVIEWS`). Le fichier `dst` n'est
+    remplacé qu'une fois entièrement écrit (sous un nom temporaire,
+    puis renommé).
+
+    L'empreinte de la source est conservée à côté de `dst` (fichier
+    `<dst>.json`) : sauf si `force`, rien n'est fait lorsqu'elle n'a pas
+    changé. Par défaut, il s'agit de celle du fichier (Cf.
+    `source_fingerprint`) ; pour une source distante, l'appelant
+    fournit la sienne (p. ex. les validateurs HTTP), sans quoi la
+    conversion est toujours refaite.
+    """
+    if fingerprint is None:
+        fingerprint = source_fingerprint(coverage.name)
+    if not force and is_up_to_date(dst, fingerprint):
+        logger.info('COG "{}" is up to date'.format(dst))
+        return dst
+
+    resampling = resampling or COG_RESAMPLING
+    options = []
+    for option in creation_options or COG_CREATION_OPTIONS:
+        options.extend(['-co', option])
+
+    tmp = '{}.{}.tmp.tif'.format(dst, str(uuid4())[:7])
+    cog = '{}.{}.cog.tif'.format(dst, str(uuid4())[:7])
+    levels = [str(level) for level in overview_levels(
+        coverage.width, coverage.height)]
+
+    commands = [['gdal_translate', '-q', '-of', 'GTiff'] + options + [coverage.name, tmp]]
+    if levels:
+        commands.append(['gdaladdo', '-q', '-r', resampling, tmp] + levels)
+    commands.append(
+        ['gdal_translate', '-q', '-of', 'GTiff'] + options
+        + ['-co', 'COPY_SRC_OVERVIEWS=YES', tmp, cog])
+
+    t0 = time.monotonic()
+    try:
+        for command in commands:
+            subprocess.run(
+                command, check=True,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.exception(e)
+        stderr = getattr(e, 'stderr', None)
+        if os.path.exists(cog):
+            os.remove(cog)
+        raise RasterPreparationError(stderr and stderr.decode() or e.__str__())
+    else:
+        os.replace(cog, dst)
+        write_fingerprint(dst, fingerprint)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+    logger.info('COG "{}" written in {}s ({} overviews)'.format(
+        dst, round(time.monotonic() - t0, 3), len(levels)))
+
+    return dst
+
+
 def bounds_to_wkt(xmin, ymin, xmax, ymax):
     return (
         'POLYGON(({xmin} {ymin}, {xmax} {ymin}, {xmax} {ymax}, {xmin} {ymax}, {xmin} {ymin}))'
         ).format(xmin=xmin, ymin=ymin, xmax=xmax, ymax=ymax)
 
 
-def ogr2postgis(ds, epsg=None, limit_to=1, update={}, filename=None, encoding='utf-8'):
-    sql = []
+def load_layer_in_worker(datasource, index, encoding, table_id, attributes,
+                         epsg, schema, method, batch_size, repair, import_lock,
+                         progress_queue):
+    """Charger une couche dans un processus ou un fil d'exécution (avec sa propre connexion)."""
+    layer = DataSource(datasource, encoding=encoding)[index]
+
+    def progress(table_id, count, total):
+        progress_queue.put((table_id, count, total))
+
+    try:
+        with connections[DATABASE].cursor() as cursor:
+            return load_layer(
+                cursor, layer, table_id, attributes, epsg, schema=schema,
+                method=method, batch_size=batch_size, progress=progress,
+                repair=repair, import_lock=import_lock)
+    except (DataDecodingError, WrongDataError):
+        raise
+    except Exception as e:
+        logger.exception(e)
+        # Les erreurs de la base ne sont pas toujours sérialisables
+        raise SQLError(e.__str__())
+    finally:
+        connections[DATABASE].close()
+
+
+def load_layers_in_parallel(ds, jobs, encoding, processes, schema=SCHEMA,
+                            method=None, batch_size=None, progress=None,
+                            repair=None, import_lock=None, threads=False):
+    """Charger les couches en parallèle (une connexion par processus).
+
+    Avec `threads`, les couches sont chargées par des fils d'exécution du
+    processus courant plutôt que par des processus enfants, ce qui est
+    le seul moyen dans un processus « démon » (p. ex. un worker Celery).
+    La lecture (GDAL) et l'écriture (PostgreSQL) des objets libèrent le
+    GIL, mais leur conversion reste limitée à un seul cœur.
+
+    Retourne la liste des résultats de `load_layer` dans l'ordre de `jobs`.
+    En cas d'erreur, celle-ci est levée une fois tous les processus
+    terminés : les tables éventuellement créées doivent être supprimées
+    par l'appelant.
+    """
+    manager = None
+    if threads:
+        progress_queue = queue.Queue()
+    else:
+        # Les processus sont démarrés par `spawn` afin de ne pas hériter
+        # des connexions ouvertes du processus parent.
+        context = multiprocessing.get_context('spawn')
+        manager = context.Manager()
+        progress_queue = manager.Queue()
+
+    def show_progress():
+        while True:
+            try:
+                args = progress_queue.get_nowait()
+            except queue.Empty:
+                return
+            progress and progress(*args)
+
+    try:
+        if threads:
+            pool = ThreadPool(processes=processes)
+        else:
+            pool = context.Pool(processes=processes, initializer=django.setup)
+        with pool:
+            results = [
+                pool.apply_async(load_layer_in_worker, (
+                    ds._datastore.name, job['index'], encoding,
+                    job['table_id'], job['attributes'], job['epsg'],
+                    schema, method, batch_size, repair, import_lock,
+                    progress_queue))
+                for job in jobs]
+            for result in results:
+                while not result.ready():
+                    result.wait(timeout=1)
+                    show_progress()
+            show_progress()
+            errors = [result for result in results if not result.successful()]
+            for result in errors:
+                result.get()  # Retourne l'erreur
+            return [result.get() for result in results]
+    finally:
+        manager and manager.shutdown()
+
+
+def ogr2postgis(ds, epsg=None, limit_to=1, update={}, filename=None,
+                encoding=None, method=None, batch_size=None, progress=None,
+                workers=None, incremental=False, repair=None):
+    """Convertir les couches de données vectorielles vers PostGIS.
+
+    Les objets sont lus, convertis et écrits par lots de `batch_size`
+    objets ; la fonction `progress(table_id, count, total)` est
+    appelée après chaque lot.
+
+    Les sources multi-couches sont chargées en parallèle par `workers`
+    processus (ou fils d'exécution dans un processus « démon », Cf.
+    `load_layers_in_parallel`) ; si le chargement d'une couche échoue,
+    aucune table n'est conservée.
+
+    Les tables sont chargées dans le schéma `STAGING_SCHEMA`, puis
+    publiées (en remplaçant les éventuelles tables existantes) dans
+    une seule et courte transaction.
+
+    En mode `incremental`, les tables mises à jour (`update`) dont la
+    structure n'a pas changé ne sont pas remplacées : seules les
+    différences y sont appliquées (Cf. `apply_diff`), dans la même
+    transaction que la publication des autres tables, et les statistiques
+    sont retournées dans la clé 'diff'.
+
+    En mode `repair` (Cf. `load_layer`), les objets erronés n'empêchent
+    pas le chargement ; leur décompte figure dans la synthèse des tables.
+
+    Si l'`encoding` n'est pas indiqué, il est déterminé à partir d'un
+    échantillon des données (Cf. `detect_encoding`).
+    """
+    jobs = []
     tables = []
 
     layers = ds.get_layers()
     if len(layers) > limit_to:
         raise ExceedsMaximumLayerNumberFixedError(
             count=len(layers), maximum=limit_to)
+    if not encoding:
+        encoding = detect_encoding(layers)
+        logger.info('Detected encoding: {}'.format(encoding))
     layers.encoding = encoding
     # else:
-    for layer in layers:
+    for index, layer in enumerate(layers):
         layername = slugify(layer.name).replace('-', '_')
 
         if layername == 'ogrgeojson':
@@ -352,155 +1584,364 @@ def ogr2postgis(ds, epsg=None, limit_to=1, update={}, filename=None, encoding='u
                 p=layer.field_precisions[i])
             attributes[k] = t
 
-        # Erreur dans Django
-        # Lorsqu'un 'layer' est composé de 'feature' de géométrie différente,
-        # `ft.geom.__class__.__qualname__ == feat.geom_type.name is False`
-        #
-        #       > django/contrib/gis/gdal/feature.py
-        #       @property
-        #       def geom_type(self):
-        #           "Return the OGR Geometry Type for this Feture."
-        #           return OGRGeomType(capi.get_fd_geom_type(self._layer._ldefn))
-        #
-        # La fonction est incorrecte puisqu'elle se base sur le 'layer' et non
-        # sur le 'feature'
-        #
-        # Donc dans ce cas on définit le type de géométrie de la couche
-        # comme générique (soit 'Geometry')
-        # Mais ceci est moche :
-        try:
-            test = set(str(feature.geom.geom_type) for feature in layer)
-        except Exception as e:
-            logger.exception(e)
-            raise WrongDataError()
-        # else:
-        if test == {'Polygon', 'MultiPolygon'}:
-            geometry = 'MultiPolygon'
-        elif test == {'Polygon25D', 'MultiPolygon25D'}:
-            geometry = 'MultiPolygonZ'
-        elif test == {'LineString', 'MultiLineString'}:
-            geometry = 'MultiLineString'
-        elif test == {'LineString25D', 'MultiLineString25D'}:
-            geometry = 'MultiLineStringZ'
-        elif test == {'Point', 'MultiPoint'}:
-            geometry = 'MultiPoint'
-        elif test == {'Point25D', 'MultiPoint25D'}:
-            geometry = 'MultiPointZ'
+        jobs.append({
+            'index': index,
+            'layer': layer,
+            'table_id': table_id,
+            'attributes': attributes,
+            'epsg': epsg})
+
+    clean_up_staging_tables()
+    import_lock = acquire_import_lock()
+    prepare_staging_tables([table['id'] for table in tables])
+
+    def rollback():
+        # Les tables publiées ne sont pas modifiées
+        for table_id in [table['id'] for table in tables]:
+            drop_table(table_id, schema=STAGING_SCHEMA)
+            drop_table(quarantine_table_name(table_id), schema=STAGING_SCHEMA)
+            for level in range(1, len(GENERALIZATION) + 1):
+                drop_table(generalized_table_name(table_id, level),
+                           schema=STAGING_SCHEMA)
+
+    processes = min(workers or WORKERS, len(jobs))
+
+    try:
+        if processes > 1:
+            # Un processus « démon » ne peut pas avoir de processus enfants
+            results = load_layers_in_parallel(
+                ds, jobs, encoding, processes, schema=STAGING_SCHEMA,
+                method=method, batch_size=batch_size, progress=progress,
+                repair=repair, import_lock=import_lock,
+                threads=multiprocessing.current_process().daemon)
         else:
-            # geometry = len(test) > 1 \
-            #     and 'Geometry' or handle_ogr_geom_type(layer.geom_type)
-            geometry = len(test) > 1 and 'Geometry' or list(test)[0]
-
-        if attributes:
-            attrs = '\n  {attrs},\n  '.format(
-                attrs=',\n  '.join(['"{}" {}'.format(k, v) for k, v in attributes.items()])
-                )
+            with connections[DATABASE].cursor() as cursor:
+                results = [
+                    load_layer(
+                        cursor, job['layer'], job['table_id'], job['attributes'],
+                        job['epsg'], schema=STAGING_SCHEMA, method=method,
+                        batch_size=batch_size, progress=progress, repair=repair,
+                        import_lock=import_lock)
+                    for job in jobs]
+        diff_ids = []
+        if incremental:
+            diff_ids = [
+                table['id'] for table in tables
+                if table['id'] in update.values() and has_same_structure(table['id'])]
+        # Les tables généralisées sont toujours remplacées
+        generalized = [
+            item['name'] for result in results
+            for item in result['summary'].get('generalized', [])]
+        diffs = publish_tables(
+            [table['id'] for table in tables if table['id'] not in diff_ids]
+            + generalized, diff_ids=diff_ids)
+        for table in tables:
+            if table['id'] in diffs:
+                table['diff'] = diffs[table['id']]
+    except (DataDecodingError, WrongDataError, SQLError):
+        rollback()
+        raise
+    except Exception as e:
+        logger.exception(e)
+        rollback()
+        # Puis retourner l'erreur
+        raise SQLError(e.__str__())
+    finally:
+        release_import_lock(import_lock)
+
+    for table, result in zip(tables, results):
+        table.update(result)
+
+    return tables
+
+
+def staging_comment(import_lock=None):
+    return json.dumps({
+        'created': timezone.now().isoformat(), 'import': import_lock})
+
+
+def acquire_import_lock():
+    """Poser le verrou d'un nouveau chargement et retourner sa clé.
+
+    Le verrou est attaché à la session (il survit aux transactions) et
+    libéré par `release_import_lock`, ou à la fermeture de la connexion
+    si le processus s'interrompt.
+    """
+    with connections[DATABASE].cursor() as cursor:
+        while True:
+            key = uuid4().int & 0x7fffffff
+            cursor.execute(TRY_IMPORT_LOCK, [IMPORT_LOCK_NAMESPACE, key])
+            if cursor.fetchone()[0]:
+                return key
+
+
+def release_import_lock(key):
+    with connections[DATABASE].cursor() as cursor:
+        cursor.execute(IMPORT_UNLOCK, [IMPORT_LOCK_NAMESPACE, key])
+
+
+def is_import_running(key):
+    with connections[DATABASE].cursor() as cursor:
+        cursor.execute(TRY_IMPORT_LOCK, [IMPORT_LOCK_NAMESPACE, key])
+        if not cursor.fetchone()[0]:
+            return True
+        cursor.execute(IMPORT_UNLOCK, [IMPORT_LOCK_NAMESPACE, key])
+    return False
+
+
+def prepare_staging_tables(table_ids, staging_schema=STAGING_SCHEMA):
+    sql = CREATE_STAGING_SCHEMA.format(
+        owner=OWNER, staging_schema=staging_schema)
+    sql += CREATE_STAGING_SCHEMA.format(
+        owner=OWNER, staging_schema=QUARANTINE_SCHEMA)
+    for table_id in table_ids:
+        for table in (table_id, quarantine_table_name(table_id)):
+            sql += '\nDROP TABLE IF EXISTS {schema}."{table}";'.format(
+                schema=staging_schema, table=table)
+    with connections[DATABASE].cursor() as cursor:
+        cursor.execute(sql)
+
+
+def publish_tables(table_ids, staging_schema=STAGING_SCHEMA, schema=SCHEMA,
+                   diff_ids=None):
+    """Déplacer les tables chargées vers le schéma publié (en une transaction).
+
+    Les tables existantes de même nom sont remplacées, sauf celles de
+    `diff_ids` auxquelles seules les différences sont appliquées
+    (Cf. `apply_diff`) ; les tables de quarantaine sont publiées
+    avec elles. Tout est publié ou rien ne l'est. Si les verrous
+    ne peuvent être obtenus rapidement (p. ex. des requêtes WMS en
+    cours), la transaction est abandonnée puis retentée plus tard
+    afin de ne pas bloquer les autres requêtes.
+
+    Retourne les statistiques de mise à jour des tables de `diff_ids`.
+    """
+    diff_ids = diff_ids or []
+    if not table_ids and not diff_ids:
+        return {}
+
+    sql = ''.join([
+        PUBLISH_TABLE.format(
+            schema=schema, staging_schema=staging_schema, table=table_id)
+        for table_id in table_ids])
+    sql += ''.join([
+        PUBLISH_QUARANTINE_TABLE.format(
+            quarantine=quarantine_table_name(table_id),
+            quarantine_schema=QUARANTINE_SCHEMA,
+            staging_schema=staging_schema, table=table_id)
+        for table_id in table_ids + diff_ids])
+
+    for attempt in range(1, LOCK_ATTEMPTS + 1):
+        try:
+            with transaction.atomic(using=DATABASE):
+                with connections[DATABASE].cursor() as cursor:
+                    cursor.execute(
+                        "SET LOCAL lock_timeout = '{}';".format(LOCK_TIMEOUT))
+                    diffs = dict(
+                        (table_id, apply_diff(
+                            cursor, table_id,
+                            staging_schema=staging_schema, schema=schema))
+                        for table_id in diff_ids)
+                    cursor.execute(sql)
+        except OperationalError as e:
+            if getattr(e.__cause__, 'pgcode', None) != LOCK_NOT_AVAILABLE \
+                    or attempt == LOCK_ATTEMPTS:
+                raise e
+            logger.warning('Unable to lock tables {}, retrying ({}/{})'.format(
+                ', '.join(table_ids + diff_ids), attempt, LOCK_ATTEMPTS))
+            time.sleep(2 ** attempt)
         else:
-            attrs = ''
+            return diffs
 
-        sql.append(CREATE_TABLE.format(
-            attrs=attrs,
-            # description=layer.name,
-            epsg=epsg,
-            geometry=geometry,
-            owner=OWNER,
-            mra_datagis_user=MRA_DATAGIS_USER,
-            schema=SCHEMA,
-            table=str(table_id),
-            the_geom=THE_GEOM,
-            to_epsg=TO_EPSG))
-
-        for feature in layer:
-            properties = {}
-            for field in feature.fields:
-                k = field.decode()
-                try:
-                    v = feature.get(k)
-                except DjangoUnicodeDecodeError as e:
-                    logger.exception(e)
-                    raise DataDecodingError()
-                if isinstance(v, type(None)):
-                    properties[k] = 'null'
-                elif isinstance(v, (datetime.date, datetime.time, datetime.datetime)):
-                    properties[k] = "'{}'".format(v.isoformat())
-                elif isinstance(v, str):
-                    properties[k] = "'{}'".format(v.replace("'", "''"))
-                else:
-                    properties[k] = "{}".format(v)
-
-            if geometry.startswith('Multi'):
-                geom = "ST_Multi(ST_GeomFromtext('{wkt}', {epsg}))"
-            else:
-                geom = "ST_GeomFromtext('{wkt}', {epsg})"
-
-            if properties:
-                attrs_name = '{attrs}, '.format(
-                    attrs=', '.join(['"{}"'.format(x) for x in properties.keys()]),
-                    )
-                attrs_value = '{attrs}, '.format(
-                    attrs=', '.join(properties.values()),
-                    )
-            else:
-                attrs_name = ''
-                attrs_value = ''
-
-            sql.append(INSERT_INTO.format(
-                attrs_name=attrs_name,
-                attrs_value=attrs_value,
-                geom=geom.format(epsg=epsg, wkt=feature.geom),
-                owner=OWNER,
-                schema=SCHEMA,
-                table=str(table_id),
-                the_geom=THE_GEOM,
-                to_epsg=TO_EPSG))
-
-    for table_id in update.values():
-        rename_table(table_id, '__{}'.format(table_id))
 
+def get_table_columns(table, schema=SCHEMA):
     with connections[DATABASE].cursor() as cursor:
-        for q in sql:
-            try:
-                cursor.execute(q)
-            except Exception as e:
-                logger.exception(e)
-                # Revenir à l'état initial
-                for table_id in [table['id'] for table in tables]:
-                    drop_table(table_id)
-                for table_id in update.values():
-                    rename_table('__{}'.format(table_id), table_id)
-                # Puis retourner l'erreur
-                raise SQLError(e.__str__())
+        cursor.execute(TABLE_COLUMNS, ['{}."{}"'.format(schema, table)])
+        records = cursor.fetchall()
+        cursor.close()
+    return records
 
-    for table_id in update.values():
-        drop_table('__{}'.format(table_id))
 
-    return tables
+def has_same_structure(table_id, staging_schema=STAGING_SCHEMA, schema=SCHEMA):
+    """Vérifier que la table chargée et la table publiée ont les mêmes colonnes."""
+    columns = get_table_columns(table_id, schema=staging_schema)
+    return columns == get_table_columns(table_id, schema=schema)
+
+
+def apply_diff(cursor, table_id, staging_schema=STAGING_SCHEMA, schema=SCHEMA):
+    """Mettre à jour la table publiée à partir de la table chargée, objet par objet.
+
+    Seuls les objets supprimés ou ajoutés sont appliqués à la table
+    publiée (un objet modifié est supprimé puis ajouté), celle-ci reste
+    donc disponible. La table chargée est ensuite supprimée.
+
+    Les deux tables doivent avoir la même structure (Cf. `has_same_structure`).
+    Aucune transaction n'est ouverte ici : c'est à l'appelant de valider
+    (Cf. `publish_tables`).
+
+    Retourne les statistiques de mise à jour.
+    """
+    columns = ', '.join([
+        '"{}"'.format(name) for name, _ in get_table_columns(
+            table_id, schema=staging_schema) if name != 'fid'])
+    old, new = ['_{}'.format(str(uuid4())[:7]) for _ in range(2)]
+
+    cursor.execute(CREATE_HASH_TABLE.format(
+        columns=columns, hash_table=old, schema=schema, table=table_id))
+    cursor.execute(CREATE_HASH_TABLE.format(
+        columns=columns, hash_table=new, schema=staging_schema, table=table_id))
+    cursor.execute(DELETE_REMOVED_FEATURES.format(
+        new=new, old=old, schema=schema, table=table_id))
+    deleted = cursor.rowcount
+    cursor.execute(INSERT_ADDED_FEATURES.format(
+        columns=columns, new=new, old=old, schema=schema,
+        staging_schema=staging_schema, table=table_id))
+    inserted = cursor.rowcount
+    cursor.execute('SELECT count(*) FROM "{}";'.format(new))
+    total = cursor.fetchone()[0]
+    cursor.execute('DROP TABLE {}."{}";'.format(staging_schema, table_id))
+    cursor.execute(ANALYZE_TABLE.format(schema=schema, table=table_id))
 
+    return {
+        'inserted': inserted,
+        'deleted': deleted,
+        'unchanged': total - inserted}
 
-def get_extent(tables, schema='public'):
-    if not tables:
-        return None
 
-    sub = 'SELECT {the_geom} as the_geom FROM {schema}."{table}"'
-    sql = 'WITH all_geoms AS ({}) SELECT geometry(ST_Extent(the_geom)) FROM all_geoms;'.format(
-        ' UNION '.join([
-            sub.format(table=table, the_geom=THE_GEOM, schema=schema)
-            for table in tables]))
+def clean_up_staging_tables(expiration=None):
+    """Supprimer les tables abandonnées du schéma de chargement.
 
+    Une table est abandonnée dès lors que le chargement auquel elle
+    appartient n'est plus en cours (son verrou est libre) : elle n'a
+    pas été publiée. Les tables qui ne sont rattachées à aucun chargement
+    (versions précédentes) sont supprimées passé le délai `expiration` ;
+    une table sans commentaire est datée lors du premier passage, le
+    délai court alors à partir de celui-ci.
+
+    Sont également supprimées les tables `__<table>` laissées par
+    les versions précédentes lors des mises à jour interrompues, ainsi
+    que les tables de quarantaine dont la couche n'existe plus.
+    """
+    expiration = expiration or STAGING_EXPIRATION
+
+    sql = '''
+SELECT n.nspname, c.relname, obj_description(c.oid, 'pg_class')
+FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+WHERE c.relkind = 'r' AND (n.nspname = %s OR (
+  n.nspname = %s AND c.relname LIKE '\\_\\_%%' AND EXISTS (
+    SELECT 1 FROM pg_class d WHERE d.relnamespace = c.relnamespace
+    AND d.relkind = 'r' AND d.relname = substr(c.relname, 3))) OR (
+  n.nspname = %s AND NOT EXISTS (
+    SELECT 1 FROM pg_class d JOIN pg_namespace m ON m.oid = d.relnamespace
+    WHERE m.nspname = %s AND d.relkind = 'r' AND d.relname = c.relname)));
+'''
     with connections[DATABASE].cursor() as cursor:
         try:
-            cursor.execute(sql)
+            cursor.execute(
+                sql, [STAGING_SCHEMA, SCHEMA, QUARANTINE_SCHEMA, SCHEMA])
         except Exception as e:
             logger.exception(e)
             if e.__class__.__qualname__ != 'ProgrammingError':
                 raise e
         records = cursor.fetchall()
         cursor.close()
-    try:
-        return records[0][0]
-    except Exception:
+
+    limit = timezone.now() - datetime.timedelta(seconds=expiration)
+    for schema, table, comment in records:
+        if schema == STAGING_SCHEMA and not comment:
+            stamp_staging_table(table)
+            continue
+        if schema == STAGING_SCHEMA:
+            try:
+                stamp = json.loads(comment)
+            except ValueError:
+                stamp = None
+            if not isinstance(stamp, dict):
+                stamp = {'created': comment}  # Versions précédentes
+            if stamp.get('import') is not None:
+                if is_import_running(stamp['import']):
+                    continue
+            else:
+                created = parse_datetime(stamp.get('created') or '')
+                if created and created > limit:
+                    continue
+        logger.info('Drop stale table {}."{}"'.format(schema, table))
+        drop_table(table, schema=schema)
+
+
+def stamp_staging_table(table):
+    sql = COMMENT_ON_TABLE.format(
+        comment=staging_comment(), schema=STAGING_SCHEMA, table=table)
+    with connections[DATABASE].cursor() as cursor:
+        try:
+            cursor.execute(sql)
+        except Exception as e:
+            logger.exception(e)
+            if e.__class__.__qualname__ != 'ProgrammingError':
+                raise e
+        cursor.close()
+
+
+ESTIMATED_EXTENT = '''
+SELECT ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e)
+FROM (SELECT ST_EstimatedExtent('{schema}', '{table}', '{the_geom}') AS e) AS x;'''
+
+
+TABLE_EXTENT = '''
+SELECT ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e)
+FROM (SELECT ST_Extent({the_geom}) AS e FROM {schema}."{table}") AS x;'''
+
+
+def get_table_extent(table, schema=SCHEMA, estimated=True):
+    """Retourner l'emprise (xmin, ymin, xmax, ymax) d'une table.
+
+    L'emprise calculée lors du chargement (Cf. `summarize_table`) est
+    conservée dans la synthèse de la couche jusqu'au chargement suivant.
+    À défaut, on se contente de l'estimation issue des statistiques de
+    la table si elles existent, sinon la table est parcourue.
+    """
+    if schema == SCHEMA:
+        Layer = apps.get_model(app_label='idgo_admin', model_name='Layer')
+        summary = Layer.objects.filter(
+            name=table).values_list('summary', flat=True).first()
+        if summary and 'extent' in summary:
+            return summary['extent'] and tuple(summary['extent'])
+
+    with connections[DATABASE].cursor() as cursor:
+        record = None
+        if estimated:
+            try:
+                with transaction.atomic(using=DATABASE):
+                    cursor.execute(ESTIMATED_EXTENT.format(
+                        schema=schema, table=table, the_geom=THE_GEOM))
+                    record = cursor.fetchone()
+            except DatabaseError as e:
+                # Pas de statistiques pour cette table
+                logger.warning(e)
+        if not record or record[0] is None:
+            cursor.execute(TABLE_EXTENT.format(
+                schema=schema, table=table, the_geom=THE_GEOM))
+            record = cursor.fetchone()
+    return record and record[0] is not None and tuple(record) or None
+
+
+def get_extent(tables, schema=SCHEMA, estimated=True):
+    """Retourner l'emprise (xmin, ymin, xmax, ymax) de l'ensemble des tables.
+
+    L'emprise de chacune des tables est obtenue séparément
+    (Cf. `get_table_extent`) puis les emprises sont réunies.
+    """
+    extents = [
+        extent for extent in (
+            get_table_extent(table, schema=schema, estimated=estimated)
+            for table in tables or [])
+        if extent]
+    if not extents:
         return None
 
+    xmin, ymin, xmax, ymax = zip(*extents)
+    return min(xmin), min(ymin), max(xmax), max(ymax)
+
 
 def rename_table(table, name, schema=SCHEMA):
 
@@ -522,7 +1963,7 @@ ALTER INDEX IF EXISTS "{table}_gix" RENAME TO "{name}_gix";
 
 
 def drop_table(table, schema=SCHEMA):
-    sql = 'DROP TABLE {schema}."{table}";'.format(schema=schema, table=table)
+    sql = 'DROP TABLE IF EXISTS {schema}."{table}";'.format(schema=schema, table=table)
     with connections[DATABASE].cursor() as cursor:
         try:
             cursor.execute(sql)
@@ -533,42 +1974,182 @@ def drop_table(table, schema=SCHEMA):
         cursor.close()
 
 
-def intersect(geojson1, geojson2):
+# Tuiles vectorielles
+# ===================
+
+# Demi-circonférence de la Terre en EPSG:3857 et dénominateur d'échelle
+# du niveau de zoom 0 (tuiles de 256 pixels de 0,28 mm)
+WEB_MERCATOR_BOUND = 20037508.342789244
+ZOOM_0_SCALE = 559082264.028717
+
+# Le filtre est appliqué dans le CRS de la table afin d'utiliser l'index
+# spatial ; les géométries sont ensuite découpées au format de la tuile.
+TILE_SQL = '''
+SELECT ST_AsMVT(t, %s, {extent}, 'geom') FROM (
+  SELECT {columns}ST_AsMVTGeom(
+    ST_Transform({the_geom}, 3857), ST_MakeEnvelope(%s, %s, %s, %s, 3857),
+    {extent}, {buffer}, true) AS geom
+  FROM {schema}."{table}"
+  WHERE {the_geom} && ST_Transform(ST_MakeEnvelope(%s, %s, %s, %s, 3857), {to_epsg})
+) AS t WHERE geom IS NOT NULL;'''
+
+
+def tile_bounds(z, x, y):
+    """Retourner l'emprise (en EPSG:3857) de la tuile `z/x/y`."""
+    size = 2 * WEB_MERCATOR_BOUND / 2 ** z
+    xmin = -WEB_MERCATOR_BOUND + x * size
+    ymax = WEB_MERCATOR_BOUND - y * size
+    return xmin, ymax - size, xmin + size, ymax
+
+
+def is_valid_tile(z, x, y):
+    return 0 <= z <= TILES_MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+def get_tile_table(table, generalized, z):
+    """Retourner la table à utiliser au niveau de zoom `z`.
+
+    Il s'agit de la table généralisée (Cf. `generalize_table`) de plus
+    grand dénominateur d'échelle inférieur à celui du niveau de zoom,
+    ou à défaut de la table d'origine.
+    """
+    scale = ZOOM_0_SCALE / 2 ** z
+    for item in generalized or []:
+        if item['scale'] <= scale:
+            table = item['name']
+    return table
+
+
+def tile_columns(columns):
+    """Retourner les colonnes encodées dans les tuiles vectorielles parmi
+    `columns` (nom et type) : les colonnes binaires et tableaux ne le
+    sont pas."""
+    if isinstance(columns, dict):
+        columns = columns.items()
+    return ['fid'] + [
+        name for name, type in columns
+        if name not in ('fid', THE_GEOM) and type != 'bytea' and not type.endswith('[]')]
+
+
+def get_tile(table, z, x, y, layer_name=None, schema=SCHEMA, columns=None):
+    """Produire la tuile vectorielle (Mapbox Vector Tile) `z/x/y` d'une table.
+
+    Les colonnes encodées sont celles calculées au chargement de la table
+    (Cf. `tile_columns`) ; à défaut, elles sont lues dans le catalogue.
+    """
+    if columns is None:
+        columns = tile_columns(get_table_columns(table, schema=schema))
+    columns = ''.join(['"{}", '.format(name) for name in columns])
+
+    bounds = tile_bounds(z, x, y)
+    sql = TILE_SQL.format(
+        buffer=TILE_BUFFER, columns=columns, extent=TILE_EXTENT,
+        schema=schema, table=table, the_geom=THE_GEOM, to_epsg=TO_EPSG)
+    with connections[DATABASE].cursor() as cursor:
+        cursor.execute(sql, [layer_name or table] + list(bounds) + list(bounds))
+        tile = cursor.fetchone()[0]
+        cursor.close()
+    return bytes(tile or b'')
 
-    sql = '''
-SELECT ST_AsGeoJSON(ST_Intersection(
-    ST_GeomFromGeoJSON('{geojson1}'), ST_GeomFromGeoJSON('{geojson2}'))) AS geojson;
-'''.format(geojson1=geojson1, geojson2=geojson2)
 
-    with connections[DATABASE].cursor() as cursor:
-        try:
-            cursor.execute(sql)
-        except Exception as e:
-            logger.exception(e)
-            if e.__class__.__qualname__ == 'TopologyException':
-                raise SQLError()
-            if e.__class__.__qualname__ != 'ProgrammingError':
-                raise e
-        else:
-            records = cursor.fetchall()
-            cursor.close()
-            return json.loads(records[0][0])
+def get_cached_tile(layer, version, z, x, y, produce):
+    """Retourner la tuile depuis le cache disque, ou la produire et la stocker.
 
+    Les tuiles sont rangées par couche puis par version de la couche
+    (identifiant du chargement) : une couche rechargée n'utilise donc
+    jamais les tuiles de la version précédente.
+    """
+    filename = os.path.join(
+        TILES_CACHE_PATH, layer, version, str(z), str(x), '{}.pbf'.format(y))
+    try:
+        with open(filename, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
 
-def transform(wkt, epsg_in, epsg_out=4171):
+    tile = produce()
+    try:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        # Écriture atomique : une tuile partielle n'est jamais lue
+        tmp = '{}.{}'.format(filename, str(uuid4())[:7])
+        with open(tmp, 'wb') as f:
+            f.write(tile)
+        os.replace(tmp, filename)
+    except OSError as e:
+        logger.warning(e)
+    return tile
+
+
+def invalidate_tiles(layer):
+    """Supprimer les tuiles en cache d'une couche."""
+    path = os.path.join(TILES_CACHE_PATH, layer)
+    if not os.path.isdir(path):
+        return
+    # Le répertoire est d'abord renommé : les tuiles produites
+    # pendant la suppression le sont dans un nouveau répertoire
+    trash = '{}.{}'.format(path, str(uuid4())[:7])
+    try:
+        os.rename(path, trash)
+    except OSError as e:
+        logger.warning(e)
+        return
+    shutil.rmtree(trash, ignore_errors=True)
+
+
+# Les opérations géométriques sont effectuées dans le processus (GDAL/GEOS)
+# plutôt que par un aller-retour vers la base PostGIS. Les objets
+# `CoordTransform` ne sont pas partagés entre les threads.
+_geometry_cache = threading.local()
+
+# GDAL 3 respecte l'ordre des axes défini par l'autorité (latitude puis
+# longitude pour les CRS géographiques de l'EPSG) : l'ordre longitude puis
+# latitude de GDAL 2 et de `ST_Transform` est imposé.
+OAMS_TRADITIONAL_GIS_ORDER = 0
+if GDAL_VERSION[:2] >= (3, 0):
+    set_axis_mapping_strategy = lgdal.OSRSetAxisMappingStrategy
+    set_axis_mapping_strategy.argtypes = [c_void_p, c_int]
+    set_axis_mapping_strategy.restype = None
+else:
+    set_axis_mapping_strategy = None
+
+
+def get_spatial_reference(epsg):
+    srs = SpatialReference(epsg)
+    if set_axis_mapping_strategy:
+        set_axis_mapping_strategy(srs.ptr, OAMS_TRADITIONAL_GIS_ORDER)
+    return srs
+
+
+def get_coord_transform(epsg_in, epsg_out):
+    try:
+        transforms = _geometry_cache.transforms
+    except AttributeError:
+        transforms = _geometry_cache.transforms = {}
 
-    sql = '''
-SELECT ST_AsText(ST_Transform(ST_GeomFromText('{wkt}', {epsg_in}), {epsg_out})) AS wkt;
-'''.format(wkt=wkt, epsg_in=epsg_in, epsg_out=epsg_out)
+    key = (int(epsg_in), int(epsg_out))
+    if key not in transforms:
+        transforms[key] = CoordTransform(
+            get_spatial_reference(key[0]), get_spatial_reference(key[1]))
+    return transforms[key]
 
-    with connections[DATABASE].cursor() as cursor:
-        try:
-            cursor.execute(sql)
-        except Exception as e:
-            logger.exception(e)
-            if e.__class__.__qualname__ != 'ProgrammingError':
-                raise e
-        else:
-            records = cursor.fetchall()
-            cursor.close()
-            return records[0][0]
+
+def intersect(geojson1, geojson2):
+    try:
+        geom = GEOSGeometry(geojson1).intersection(GEOSGeometry(geojson2))
+    except GEOSException as e:
+        logger.exception(e)
+        raise SQLError()
+    return json.loads(geom.json)
+
+
+def transform(wkt, epsg_in, epsg_out=4171):
+    # Les coordonnées sont dans l'ordre longitude/latitude, comme avec
+    # `ST_Transform` (Cf. `get_spatial_reference`) ; en cas d'erreur
+    # (géométrie ou CRS invalide), rien n'est retourné.
+    try:
+        geom = OGRGeometry(wkt)
+        geom.transform(get_coord_transform(epsg_in, epsg_out))
+    except (GDALException, SRSException, ValueError) as e:
+        logger.exception(e)
+        return None
+    return geom.wkt
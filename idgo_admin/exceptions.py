@@ -82,6 +82,10 @@ class MraBaseError(GenericException):
     pass
 
 
+class NotModifiedError(GenericException):
+    message = "La ressource distante n'a pas été modifiée."
+
+
 class ProfileHttp404(Http404):
     pass
 
@@ -15,9 +15,9 @@
 
 
 from django.conf import settings
+from idgo_admin.http_client import get_session
 from idgo_admin.utils import Singleton
 from owslib.csw import CatalogueServiceWeb
-import requests
 from urllib.parse import urljoin
 
 
@@ -42,7 +42,7 @@ class GeonetUserHandler(metaclass=Singleton):
             username=self.username, password=self.password)
 
     def _get(self, url, params):
-        r = requests.get(
+        r = get_session('geonetwork', deadline=GEONET_TIMEOUT).get(
             url, params=params, auth=(self.username, self.password))
         r.raise_for_status()
         return r
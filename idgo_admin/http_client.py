@@ -0,0 +1,234 @@
+# Copyright (c) 2017-2019 Datasud.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from django.conf import settings
+import os
+import requests
+from requests.adapters import HTTPAdapter
+from requests.adapters import TimeoutSauce
+import socket
+import threading
+import time
+
+
+# Délai maximal (en secondes) d'établissement de la connexion
+try:
+    HTTP_CONNECT_TIMEOUT = settings.HTTP_CONNECT_TIMEOUT
+except AttributeError:
+    HTTP_CONNECT_TIMEOUT = 10
+
+# Délai maximal (en secondes) entre deux réceptions de données ; il est
+# réduit à la durée totale des requêtes du service (`deadline`) si
+# celle-ci est inférieure
+try:
+    HTTP_READ_TIMEOUT = settings.HTTP_READ_TIMEOUT
+except AttributeError:
+    HTTP_READ_TIMEOUT = 300
+
+# Nombre de connexions conservées (keep-alive) par hôte et par session
+try:
+    HTTP_POOL_SIZE = settings.HTTP_POOL_SIZE
+except AttributeError:
+    HTTP_POOL_SIZE = 10
+
+# Nombre d'hôtes distincts dont les connexions sont conservées par session
+try:
+    HTTP_POOL_HOSTS = settings.HTTP_POOL_HOSTS
+except AttributeError:
+    HTTP_POOL_HOSTS = 10
+
+# Taille des blocs lus lors de la réception du corps de la réponse
+HTTP_CHUNK_SIZE = 64 * 1024
+
+
+class DeadlineExceeded(requests.exceptions.Timeout):
+    """La durée totale de la requête a dépassé l'échéance fixée."""
+
+
+def response_socket(r):
+    """Retourner la socket de la réponse `r` (en cours de réception), si
+    elle est accessible."""
+    sock = getattr(getattr(r.raw, '_connection', None), 'sock', None)
+    if sock is None:
+        # La connexion n'est pas conservée (`Connection: close`) : la
+        # socket n'est plus référencée que par le flux de la réponse
+        fp = getattr(getattr(r.raw, '_fp', None), 'fp', None)
+        sock = getattr(getattr(fp, 'raw', None), '_sock', None)
+    return sock
+
+
+class DeadlineTimer(object):
+    """Interrompre la réception sur la socket `sock` après `delay` secondes.
+
+    Le délai de lecture s'applique à chaque réception : un serveur qui
+    envoie la réponse par petits morceaux ne le déclenche jamais. La
+    socket est alors fermée en lecture, ce qui met fin à la réception
+    en cours.
+    """
+
+    def __init__(self, sock, delay):
+        self.expired = False
+        self._sock = sock
+        self._timer = threading.Timer(max(delay, 0), self.expire)
+        self._timer.daemon = True
+        if sock:
+            self._timer.start()
+
+    def expire(self):
+        self.expired = True
+        try:
+            self._sock.shutdown(socket.SHUT_RD)
+        except OSError:
+            pass
+
+    def cancel(self):
+        self._timer.cancel()
+
+
+class Session(requests.Session):
+    """Session HTTP dont les requêtes sont bornées dans le temps.
+
+    Les délais de connexion et de lecture sont appliqués aux sockets
+    (dans le processus appelant). La durée totale (`deadline`) borne
+    l'ensemble de l'appel : l'envoi de la requête et la réception des
+    en-têtes (durée totale de urllib3), puis celle du corps de la
+    réponse, interrompue à l'échéance (Cf. `DeadlineTimer`). Toutes
+    ces erreurs héritent de `requests.exceptions.Timeout`.
+
+    En mode `stream`, le corps est lu par l'appelant : seuls l'envoi de
+    la requête et la réception des en-têtes sont bornés par la durée
+    totale.
+
+    Par défaut, le délai de lecture est `HTTP_READ_TIMEOUT`, réduit à
+    la durée totale configurée pour le service (p. ex. `MRA['TIMEOUT']`)
+    si elle est inférieure : une connexion bloquée est ainsi détectée
+    sans attendre l'échéance lorsque celle-ci est longue (p. ex.
+    `CKAN_TIMEOUT`, dix heures par défaut pour les téléversements).
+    """
+
+    def __init__(self, deadline=None, connect_timeout=None, read_timeout=None,
+                 pool_size=None, pool_hosts=None):
+        super().__init__()
+        self.deadline = deadline
+        self.connect_timeout = connect_timeout or HTTP_CONNECT_TIMEOUT
+        self.read_timeout = read_timeout or HTTP_READ_TIMEOUT
+        self.requests_count = 0
+        self._count_lock = threading.Lock()  # La session est partagée entre threads
+        adapter = HTTPAdapter(
+            pool_connections=pool_hosts or HTTP_POOL_HOSTS,
+            pool_maxsize=pool_size or HTTP_POOL_SIZE)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+
+    def request(self, method, url, deadline=None, **kwargs):
+        deadline = deadline or self.deadline
+        read_timeout = self.read_timeout
+        if deadline:
+            read_timeout = min(read_timeout, deadline)
+            kwargs.setdefault('timeout', TimeoutSauce(
+                connect=self.connect_timeout, read=read_timeout, total=deadline))
+        kwargs.setdefault('timeout', (self.connect_timeout, read_timeout))
+
+        t0 = time.monotonic()
+        with self._count_lock:
+            self.requests_count += 1
+        stream = kwargs.pop('stream', False)
+        r = super().request(method, url, stream=True, **kwargs)
+        if stream:
+            return r
+
+        def deadline_exceeded():
+            return DeadlineExceeded('{} {}: deadline of {}s exceeded'.format(
+                method.upper(), url, deadline), response=r)
+
+        # À l'échéance, la connexion est interrompue (Cf. `DeadlineTimer`)
+        timer = deadline and DeadlineTimer(
+            response_socket(r), deadline - (time.monotonic() - t0))
+        chunks = []
+        try:
+            for chunk in r.iter_content(HTTP_CHUNK_SIZE):
+                chunks.append(chunk)
+                if deadline and time.monotonic() - t0 > deadline:
+                    raise deadline_exceeded()
+            if timer and timer.expired:
+                raise deadline_exceeded()
+        except requests.exceptions.RequestException as e:
+            if timer and timer.expired and not isinstance(e, DeadlineExceeded):
+                raise deadline_exceeded() from e
+            raise e
+        finally:
+            timer and timer.cancel()
+            r.close()
+        r._content = b''.join(chunks)
+        return r
+
+    def stats(self):
+        """Retourner le nombre de requêtes et de connexions ouvertes, par hôte."""
+        hosts = {}
+        for adapter in set(self.adapters.values()):
+            for key in adapter.poolmanager.pools.keys():
+                try:
+                    pool = adapter.poolmanager.pools[key]
+                except KeyError:  # Connexions de l'hôte fermées entre-temps
+                    continue
+                host = '{}://{}:{}'.format(pool.scheme, pool.host, pool.port)
+                hosts[host] = {
+                    'requests': pool.num_requests,
+                    'connections': pool.num_connections,
+                    'reused': max(pool.num_requests - pool.num_connections, 0)}
+        return {'requests': self.requests_count, 'hosts': hosts}
+
+
+class SessionPool(object):
+    """Sessions HTTP partagées, une par service externe et par processus.
+
+    Les connexions (keep-alive) de chaque session sont conservées
+    d'une requête à l'autre, et d'un thread à l'autre. Une session
+    créée avant un `fork` n'est pas réutilisée par le processus enfant.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._sessions = {}
+
+    def get(self, name, **kwargs):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._sessions = {}
+            if name not in self._sessions:
+                self._sessions[name] = Session(**kwargs)
+            return self._sessions[name]
+
+    def stats(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                return {}
+            sessions = dict(self._sessions)
+        return dict((name, session.stats()) for name, session in sessions.items())
+
+
+SessionPool = SessionPool()
+
+
+def get_session(name, **kwargs):
+    """Retourner la session partagée du service `name` (Cf. `SessionPool`).
+
+    Les paramètres (Cf. `Session`) ne sont pris en compte
+    qu'à la création de la session.
+    """
+    return SessionPool.get(name, **kwargs)
@@ -0,0 +1,158 @@
+# Copyright (c) 2017-2019 Datasud.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand
+from django.db import connections
+from idgo_admin import logger
+from idgo_admin.models import Dataset
+from idgo_admin.models import Layer
+from idgo_admin.models.layer import deferred_layergroups
+from idgo_admin.models.layer import layergroup_data
+from idgo_admin.models.layer import schedule_layergroup
+from idgo_admin.models import MraObject
+from idgo_admin.mra_client import MRAHandler
+import re
+
+
+class Command(BaseCommand):
+
+    help = """Réconcilier le miroir local des objets MRA avec MRA : les objets
+              absents (ou dont l'état diffère) sont retirés du miroir, puis
+              les couches concernées sont de nouveau synchronisées, de même
+              que les couches dont les objets MRA n'ont jamais été relevés.
+              Les groupes de couches qui diffèrent de ceux attendus sont
+              reconstruits, une seule fois par jeu de données."""
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=4,
+            help="Nombre de requêtes simultanées vers MRA.")
+        parser.add_argument(
+            '--dry-run', action='store_true', default=False,
+            help="Indiquer les écarts sans les corriger.")
+
+    def handle(self, *args, **options):
+        workers = options['workers']
+
+        objects = list(MraObject.objects.all())
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            drifted = [
+                obj for obj, is_synced
+                in zip(objects, executor.map(self.is_synced, objects))
+                if not is_synced]
+        for obj in drifted:
+            self.stdout.write('Drift: {}'.format(obj.path))
+
+        names = self.get_layers_to_repair(drifted)
+        datasets = self.get_layergroups_to_rebuild(drifted)
+        self.stdout.write(
+            '{} objects checked, {} drifted, {} layers to repair, '
+            '{} layergroups to rebuild'.format(
+                len(objects), len(drifted), len(names), len(datasets)))
+        if options['dry_run']:
+            return
+
+        MraObject.objects.filter(path__in=[obj.path for obj in drifted]).delete()
+        # Les groupes de couches des couches réparées sont reconstruits
+        # en une fois, à la sortie du bloc (Cf. `deferred_layergroups`).
+        with deferred_layergroups():
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                errors = [
+                    error for error in executor.map(
+                        lambda name: self.repair(name, datasets), sorted(names))
+                    if error]
+            for dataset_id in datasets:
+                schedule_layergroup(dataset_id)
+        for error in errors:
+            self.stderr.write(error)
+        self.stdout.write('{} layers repaired, {} failed, {} layergroups rebuilt'.format(
+            len(names) - len(errors), len(errors), len(datasets)))
+
+    def is_synced(self, obj):
+        try:
+            remote = MRAHandler.remote.get(*obj.path.split('/'))
+        except Exception as e:
+            if e.__class__.__qualname__ == 'HTTPError' \
+                    and e.response.status_code == 404:
+                return False
+            # MRA est indisponible : l'objet n'est pas considéré comme divergent
+            logger.exception(e)
+            return True
+        if obj.kind == 'layer' and obj.state:
+            remote = remote.get('layer', {})
+            return all(
+                remote[k] == v for k, v in obj.state.items() if k in remote)
+        if obj.kind == 'layergroup' and obj.state:
+            remote = remote.get('layerGroup', {})
+            if 'layers' in remote:
+                return [
+                    layer.get('name') if isinstance(layer, dict) else layer
+                    for layer in remote['layers'] or []
+                    ] == obj.state.get('layers')
+        return True
+
+    def get_layers_to_repair(self, drifted):
+        names = set()
+        for obj in drifted:
+            if obj.kind in ('featuretype', 'coverage', 'layer'):
+                # Tables généralisées : `<couche>_g<n>`
+                names.update(Layer.objects.filter(
+                    name__in=[obj.name, re.sub(r'_g\d+$', '', obj.name)]
+                    ).values_list('name', flat=True))
+            elif obj.kind == 'layergroup':
+                # Cf. `get_layergroups_to_rebuild`
+                continue
+            else:
+                names.update(Layer.objects.filter(
+                    resource__dataset__organisation__slug=obj.ws_name
+                    ).values_list('name', flat=True))
+
+        mirrored = MraObject.objects.filter(
+            kind__in=('featuretype', 'coverage')).values_list('name', flat=True)
+        names.update(Layer.objects.exclude(
+            name__in=list(mirrored)).values_list('name', flat=True))
+        return names
+
+    def get_layergroups_to_rebuild(self, drifted):
+        datasets = set(Dataset.objects.filter(slug__in=[
+            obj.name for obj in drifted if obj.kind == 'layergroup'
+            ]).values_list('pk', flat=True))
+
+        # Groupes de couches jamais relevés, obsolètes, ou qui diffèrent
+        # de ceux attendus (Cf. `layergroup_data`)
+        mirrored = dict(
+            (obj.path, obj.state) for obj
+            in MraObject.objects.filter(kind='layergroup'))
+        for dataset in Dataset.objects.filter(
+                organisation__isnull=False).select_related('organisation'):
+            path = '/'.join([
+                'workspaces', dataset.organisation.slug, 'layergroups', dataset.slug])
+            if mirrored.get(path) != layergroup_data(dataset):
+                datasets.add(dataset.pk)
+        return datasets
+
+    def repair(self, name, datasets):
+        try:
+            # Le groupe de couches est reconstruit par l'appelant
+            with deferred_layergroups(collect=datasets):
+                Layer.objects.get(name=name).save()
+        except Exception as e:
+            logger.exception(e)
+            return 'Layer "{}": {}'.format(name, e.__str__())
+        finally:
+            # Chaque thread dispose de ses propres connexions
+            connections.close_all()
@@ -43,7 +43,9 @@ class Command(BaseCommand):
 
                     task = Task.objects.create(action=__name__)
                     try:
-                        resource.save(current_user=None, synchronize=True)
+                        resource.save(
+                            current_user=None, synchronize=True,
+                            skip_if_unchanged=True)
                     except Exception as e:
                         task.extras = {**extras, **{'error': e.__str__()}}
                         task.state = 'failed'
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('idgo_admin', '0002_resource_sync_diff'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='resource',
+            name='dl_etag',
+            field=models.CharField(blank=True, max_length=255, null=True, verbose_name='ETag de la ressource téléchargée'),
+        ),
+        migrations.AddField(
+            model_name='resource',
+            name='dl_last_modified',
+            field=models.CharField(blank=True, max_length=255, null=True, verbose_name='Date de modification de la ressource téléchargée'),
+        ),
+        migrations.AddField(
+            model_name='resource',
+            name='dl_sha256',
+            field=models.CharField(blank=True, max_length=64, null=True, verbose_name='Empreinte SHA-256 de la ressource téléchargée'),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('idgo_admin', '0003_resource_dl_validators'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='layer',
+            name='summary',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, null=True, verbose_name='Synthèse des données'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('idgo_admin', '0004_layer_summary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MraObject',
+            fields=[
+                ('path', models.CharField(max_length=255, primary_key=True, serialize=False, verbose_name='Chemin')),
+                ('kind', models.CharField(choices=[('workspace', 'Workspace'), ('datastore', 'Data store'), ('featuretype', 'Feature type'), ('coveragestore', 'Coverage store'), ('coverage', 'Coverage'), ('layer', 'Couche'), ('layergroup', 'Groupe de couches')], max_length=16, verbose_name='Type')),
+                ('name', models.CharField(db_index=True, max_length=100, verbose_name='Nom')),
+                ('state', django.contrib.postgres.fields.jsonb.JSONField(blank=True, null=True, verbose_name='État connu')),
+                ('updated', models.DateTimeField(auto_now=True, verbose_name='Dernière mise à jour')),
+            ],
+            options={
+                'verbose_name': 'Objet MRA',
+                'verbose_name_plural': 'Objets MRA',
+            },
+        ),
+    ]
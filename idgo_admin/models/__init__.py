@@ -32,6 +32,7 @@ from idgo_admin.models.jurisdiction import JurisdictionCommune
 from idgo_admin.models.layer import Layer
 from idgo_admin.models.license import License
 from idgo_admin.models.mail import Mail
+from idgo_admin.models.mra_object import MraObject
 from idgo_admin.models.organisation import Organisation
 from idgo_admin.models.organisation import OrganisationType
 from idgo_admin.models.organisation import RemoteCkan
@@ -65,6 +66,7 @@ __all__ = [
     LiaisonsContributeurs,
     LiaisonsReferents,
     Mail,
+    MraObject,
     Organisation,
     OrganisationType,
     RemoteCkan,
@@ -33,6 +33,7 @@ from idgo_admin import logger
 from idgo_admin.managers import DefaultDatasetManager
 from idgo_admin.managers import HarvestedCkanDatasetManager
 from idgo_admin.managers import HarvestedCswDatasetManager
+from idgo_admin.models.layer import deferred_layergroups
 from idgo_admin.utils import three_suspension_points
 from taggit.admin import Tag
 from taggit.managers import TaggableManager
@@ -333,6 +334,7 @@ class Dataset(models.Model):
     # Méthodes héritées
     # =================
 
+    @deferred_layergroups()
     def save(self, *args, current_user=None, synchronize=True, **kwargs):
 
         # Version précédante du jeu de données (avant modification)
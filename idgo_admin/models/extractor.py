@@ -22,9 +22,9 @@ from django.contrib.postgres.fields import JSONField
 from django.db.models.signals import pre_init
 from django.dispatch import receiver
 from django.utils import timezone
+from idgo_admin.http_client import get_session
 from idgo_admin.models.mail import send_extraction_failure_mail
 from idgo_admin.models.mail import send_extraction_successfully_mail
-import requests
 import uuid
 
 User = get_user_model()
@@ -178,7 +178,7 @@ def synchronize_extractor_task(sender, *args, **kwargs):
             else:
                 if instance.success is None:
                     url = instance.details['possible_requests']['status']['url']
-                    r = requests.get(url)
+                    r = get_session('extractor').get(url)
 
                     if r.status_code == 200:
                         details = instance.details
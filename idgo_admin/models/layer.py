@@ -14,24 +14,29 @@
 # under the License.
 
 from django.contrib.auth import get_user_model
+from contextlib import contextmanager
 from django.apps import apps
 from django.conf import settings
 from django.contrib.gis.db import models
+from django.contrib.postgres.fields import JSONField
+from django.core.cache import cache
 from django.db.models.signals import post_delete
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 from idgo_admin.ckan_module import CkanHandler
 from idgo_admin.ckan_module import CkanUserHandler
 from idgo_admin.datagis import drop_table
+from idgo_admin.datagis import invalidate_tiles
+from idgo_admin.datagis import QUARANTINE_SCHEMA
 from idgo_admin import logger
 from idgo_admin.managers import RasterLayerManager
 from idgo_admin.managers import VectorLayerManager
 from idgo_admin.mra_client import MraBaseError
 from idgo_admin.mra_client import MRAHandler
-import itertools
 import json
 import os
 import re
+import threading
 
 User = get_user_model()
 
@@ -40,6 +45,22 @@ OWS_URL_PATTERN = settings.OWS_URL_PATTERN
 CKAN_STORAGE_PATH = settings.CKAN_STORAGE_PATH
 MAPSERV_STORAGE_PATH = settings.MAPSERV_STORAGE_PATH
 
+# Durée (en secondes) de conservation en cache des informations MRA des couches
+MRA_INFO_CACHE_TTL = MRA.get('INFO_CACHE_TTL', 300)
+
+# Durée (en secondes) pendant laquelle l'échec de l'obtention de ces
+# informations est conservé, afin de ne pas solliciter MRA à chaque accès
+MRA_INFO_FAILURE_TTL = MRA.get('INFO_FAILURE_TTL', 30)
+
+# Reconstruire les groupes de couches par une tâche de fond plutôt qu'à la
+# fin de l'enregistrement, après le délai indiqué (en secondes)
+LAYERGROUP_ASYNC = MRA.get('LAYERGROUP_ASYNC', False)
+LAYERGROUP_COUNTDOWN = MRA.get('LAYERGROUP_COUNTDOWN', 10)
+
+
+def mra_info_cache_key(name):
+    return 'idgo_admin:layer:{}:mra_info'.format(name)
+
 
 def get_all_users_for_organisations(list_id):
     return [
@@ -99,6 +120,12 @@ class Layer(models.Model):
         srid=4171,
         )
 
+    summary = JSONField(
+        verbose_name="Synthèse des données",
+        null=True,
+        blank=True,
+        )
+
     def __str__(self):
         return self.resource.__str__()
 
@@ -111,12 +138,33 @@ class Layer(models.Model):
 
     @property
     def geometry_type(self):
-        return {
+        types = {
             'POLYGON': 'Polygone',
             'POINT': 'Point',
             'LINESTRING': 'Ligne',
             'RASTER': 'Raster',
-            }.get(self.mra_info['type'], None)
+            }
+        type = None
+        if self.summary:
+            # Synthèse calculée lors du chargement des données
+            type = re.sub('^MULTI|(Z|25D)$', '', self.summary['geometry'].upper())
+        if type not in types:
+            # Géométries de types différents (`Geometry`) : on s'en
+            # remet au type de la couche déclaré à MapServer.
+            type = self.mra_info['type']
+        return types.get(type, None)
+
+    @property
+    def feature_count(self):
+        if self.summary:
+            return self.summary['count']
+
+    @property
+    def generalized(self):
+        # Tables généralisées, par ordre croissant de dénominateur d'échelle
+        if self.summary:
+            return self.summary.get('generalized', [])
+        return []
 
     @property
     def is_enabled(self):
@@ -157,19 +205,113 @@ class Layer(models.Model):
                     MAPSERV_STORAGE_PATH, x[:3], x[3:6], x[6:])
             return filename
 
+    @property
+    def mra_info(self):
+        # Les informations sont obtenues auprès de MRA au premier accès,
+        # puis conservées dans le cache partagé (Cf. `invalidate_mra_info`).
+        # Un échec est conservé aussi (`False`), mais moins longtemps.
+        mra_info = self.__dict__.get('_mra_info')
+        if mra_info is None:
+            key = mra_info_cache_key(self.name)
+            mra_info = cache.get(key)
+            if mra_info is None:
+                mra_info = self.fetch_mra_info() or False
+                cache.set(key, mra_info, mra_info and MRA_INFO_CACHE_TTL or MRA_INFO_FAILURE_TTL)
+            self._mra_info = mra_info
+        if mra_info is False:
+            # MRA indisponible ou couche inconnue : l'attribut est absent
+            raise AttributeError('mra_info')
+        return mra_info
+
+    @staticmethod
+    def invalidate_mra_info(name):
+        cache.delete(mra_info_cache_key(name))
+
+    def reset_mra_info(self):
+        self.__dict__.pop('_mra_info', None)
+        self.invalidate_mra_info(self.name)
+
     # Méthodes héritées
     # =================
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+    def save(self, *args, synchronize=False, **kwargs):
+        try:
+            # Synchronisation avec le service OGC en fonction du type de données
+            if self.type == 'vector':
+                self.save_vector_layer()
+            elif self.type == 'raster':
+                self.save_raster_layer()
+
+            # Puis sauvegarde
+            super().save(*args, **kwargs)
+            self.handle_enable_ows_status()
+            self.handle_layergroup()
+        finally:
+            # Les informations en cache, ou l'échec de leur obtention,
+            # ne sont plus à jour même si la synchronisation a échoué
+            self.reset_mra_info()
+
+        if synchronize:
+            self.synchronize()
+
+    def delete(self, *args, current_user=None, **kwargs):
+        with_user = current_user
+
+        # On supprime la ressource CKAN
+        if with_user:
+            username = with_user.username
+            apikey = CkanHandler.get_user(username)['apikey']
+            with CkanUserHandler(apikey=apikey) as ckan_user:
+                ckan_user.delete_resource(self.name)
+        else:
+            CkanHandler.delete_resource(self.name)
+
+        # On supprime les ressources MRA
+        try:
+            MRAHandler.del_layer(self.name)
+            ws_name = self.resource.dataset.organisation.slug
+            if self.type == 'vector':
+                MRAHandler.del_featuretype(ws_name, 'public', self.name)
+                for generalized in self.generalized:
+                    MRAHandler.del_layer(generalized['name'])
+                    MRAHandler.del_featuretype(
+                        ws_name, 'public', generalized['name'])
+            if self.type == 'raster':
+                MRAHandler.del_coverage(ws_name, self.name, self.name)
+                # MRAHandler.del_coveragestore(ws_name, self.name)
+        except Exception as e:
+            logger.error(e)
+            pass
+        self.reset_mra_info()
 
+        # On supprime la table de données PostGIS (et son éventuelle quarantaine)
+        try:
+            drop_table(self.name)
+            drop_table(self.name, schema=QUARANTINE_SCHEMA)
+            for generalized in self.generalized:
+                drop_table(generalized['name'])
+            invalidate_tiles(self.name)
+        except Exception as e:
+            logger.error(e)
+            pass
+
+        # Puis on supprime l'instance
+        dataset_id = self.resource.dataset_id
+        super().delete(*args, **kwargs)
+        schedule_layergroup(dataset_id)
+
+    # Autres méthodes
+    # ===============
+
+    def fetch_mra_info(self):
+        """Obtenir auprès de MRA les informations de la couche de données."""
         organisation = self.resource.dataset.organisation
         ws_name = organisation.slug
 
         try:
             l = MRAHandler.get_layer(self.name)
         except MraBaseError:
-            return
+            return None
 
         # Récupération des informations de couche vecteur
         # ===============================================
@@ -178,9 +320,9 @@ class Layer(models.Model):
             try:
                 ft = MRAHandler.get_featuretype(ws_name, 'public', self.name)
             except MraBaseError:
-                return
+                return None
             if not l or not ft:
-                return
+                return None
 
             ll = ft['featureType']['latLonBoundingBox']
             bbox = [[ll['miny'], ll['minx']], [ll['maxy'], ll['maxx']]]
@@ -206,9 +348,9 @@ class Layer(models.Model):
             try:
                 c = MRAHandler.get_coverage(ws_name, self.name, self.name)
             except MraBaseError:
-                return
+                return None
             if not l or not c:
-                return
+                return None
 
             ll = c['coverage']['latLonBoundingBox']
             bbox = [[ll['miny'], ll['minx']], [ll['maxy'], ll['maxx']]]
@@ -216,8 +358,10 @@ class Layer(models.Model):
             default_style_name = None
             styles = []
 
-        # Puis..
-        self.mra_info = {
+        else:
+            return None
+
+        return {
             'name': l['name'],
             'title': l['title'],
             'type': l['type'],
@@ -229,59 +373,6 @@ class Layer(models.Model):
                 'default': default_style_name,
                 'styles': styles}}
 
-    def save(self, *args, synchronize=False, **kwargs):
-        # Synchronisation avec le service OGC en fonction du type de données
-        if self.type == 'vector':
-            self.save_vector_layer()
-        elif self.type == 'raster':
-            self.save_raster_layer()
-
-        # Puis sauvegarde
-        super().save(*args, **kwargs)
-        self.handle_enable_ows_status()
-        self.handle_layergroup()
-
-        if synchronize:
-            self.synchronize()
-
-    def delete(self, *args, current_user=None, **kwargs):
-        with_user = current_user
-
-        # On supprime la ressource CKAN
-        if with_user:
-            username = with_user.username
-            apikey = CkanHandler.get_user(username)['apikey']
-            with CkanUserHandler(apikey=apikey) as ckan_user:
-                ckan_user.delete_resource(self.name)
-        else:
-            CkanHandler.delete_resource(self.name)
-
-        # On supprime les ressources MRA
-        try:
-            MRAHandler.del_layer(self.name)
-            ws_name = self.resource.dataset.organisation.slug
-            if self.type == 'vector':
-                MRAHandler.del_featuretype(ws_name, 'public', self.name)
-            if self.type == 'raster':
-                MRAHandler.del_coverage(ws_name, self.name, self.name)
-                # MRAHandler.del_coveragestore(ws_name, self.name)
-        except Exception as e:
-            logger.error(e)
-            pass
-
-        # On supprime la table de données PostGIS
-        try:
-            drop_table(self.name)
-        except Exception as e:
-            logger.error(e)
-            pass
-
-        # Puis on supprime l'instance
-        super().delete(*args, **kwargs)
-
-    # Autres méthodes
-    # ===============
-
     def save_raster_layer(self, *args, **kwargs):
         """Synchronizer la couche de données matricielle avec le service OGC via MRA."""
         organisation = self.resource.dataset.organisation
@@ -297,16 +388,12 @@ class Layer(models.Model):
                 # On vérifie si l'organisation du jeu de données a changée,
                 # auquel cas il est nécessaire de supprimer les objets MRA
                 # afin de les recréer dans le bon workspace (c-à-d Mapfile).
-                previous_layer = MRAHandler.get_layer(self.name)
-                regex = '/workspaces/(?P<ws_name>[a-z_\-]+)/coveragestores/'
-
-                matched = re.search(regex, previous_layer['resource']['href'])
-                if matched:
-                    previous_ws_name = matched.group('ws_name')
-                    if not ws_name == previous_ws_name:
-                        MRAHandler.del_layer(self.name)
-                        MRAHandler.del_coverage(
-                            previous_ws_name, cs_name, self.name)
+                previous_ws_name = MRAHandler.get_layer_workspace(
+                    self.name, store='coveragestores')
+                if previous_ws_name and not ws_name == previous_ws_name:
+                    MRAHandler.del_layer(self.name)
+                    MRAHandler.del_coverage(
+                        previous_ws_name, cs_name, self.name)
 
         MRAHandler.get_or_create_workspace(organisation)
         MRAHandler.get_or_create_coveragestore(ws_name, cs_name, filename=self.filename)
@@ -329,22 +416,57 @@ class Layer(models.Model):
                 # On vérifie si l'organisation du jeu de données a changée,
                 # auquel cas il est nécessaire de supprimer les objets MRA
                 # afin de les recréer dans le bon workspace (c-à-d Mapfile).
-                previous_layer = MRAHandler.get_layer(self.name)
-                regex = '/workspaces/(?P<ws_name>[a-z_\-]+)/datastores/'
-
-                matched = re.search(regex, previous_layer['resource']['href'])
-                if matched:
-                    previous_ws_name = matched.group('ws_name')
-                    if not ws_name == previous_ws_name:
-                        MRAHandler.del_layer(self.name)
+                previous_ws_name = MRAHandler.get_layer_workspace(
+                    self.name, store='datastores')
+                if previous_ws_name and not ws_name == previous_ws_name:
+                    MRAHandler.del_layer(self.name)
+                    MRAHandler.del_featuretype(
+                        previous_ws_name, ds_name, self.name)
+                    for generalized in self.generalized:
+                        MRAHandler.del_layer(generalized['name'])
                         MRAHandler.del_featuretype(
-                            previous_ws_name, ds_name, self.name)
+                            previous_ws_name, ds_name, generalized['name'])
 
         MRAHandler.get_or_create_workspace(organisation)
         MRAHandler.get_or_create_datastore(ws_name, ds_name)
         MRAHandler.get_or_create_featuretype(
             ws_name, ds_name, self.name, enabled=True,
             title=self.resource.title, abstract=self.resource.description)
+        self.save_generalized_layers()
+
+    def save_generalized_layers(self, previous=None):
+        """Synchroniser les couches généralisées avec le service OGC via MRA.
+
+        Chaque table généralisée est publiée comme une couche affichée
+        à partir de son dénominateur d'échelle ; la couche d'origine
+        n'est alors affichée qu'en deçà du premier. Les couches listées
+        dans `previous` (synthèse précédente) et qui ne sont plus produites
+        sont supprimées.
+        """
+        ws_name = self.resource.dataset.organisation.slug
+        ds_name = 'public'
+
+        names = [generalized['name'] for generalized in self.generalized]
+        for generalized in previous or []:
+            if generalized['name'] not in names:
+                MRAHandler.del_layer(generalized['name'])
+                MRAHandler.del_featuretype(ws_name, ds_name, generalized['name'])
+                drop_table(generalized['name'])
+
+        if not self.generalized and not previous:
+            return
+
+        scales = [generalized['scale'] for generalized in self.generalized]
+        MRAHandler.set_layer_scale_range(
+            ws_name, self.name, max_scale=scales and scales[0] or None)
+
+        for i, generalized in enumerate(self.generalized):
+            MRAHandler.get_or_create_featuretype(
+                ws_name, ds_name, generalized['name'], enabled=True,
+                title=self.resource.title, abstract=self.resource.description)
+            MRAHandler.set_layer_scale_range(
+                ws_name, generalized['name'], min_scale=scales[i],
+                max_scale=scales[i + 1] if i + 1 < len(scales) else None)
 
     def synchronize(self, with_user=None):
         """Synchronizer le jeu de données avec l'instance de CKAN."""
@@ -403,27 +525,122 @@ class Layer(models.Model):
     def handle_enable_ows_status(self):
         """Gérer le statut d'activation de la couche de données SIG."""
         ws_name = self.resource.dataset.organisation.slug
+        l_names = [self.name] + [
+            generalized['name'] for generalized in self.generalized]
         if self.resource.ogc_services:
-            MRAHandler.enable_layer(ws_name, self.name)
+            for l_name in l_names:
+                MRAHandler.enable_layer(ws_name, l_name)
             # TODO: Comment on gère les ressources CKAN service ???
         else:
-            MRAHandler.disable_layer(ws_name, self.name)
+            for l_name in l_names:
+                MRAHandler.disable_layer(ws_name, l_name)
             # TODO: Comment on gère les ressources CKAN service ???
+        self.reset_mra_info()
 
     def handle_layergroup(self):
-        dataset = self.resource.dataset
-        layers = list(itertools.chain.from_iterable([
-            qs for qs in [
-                resource.get_layers() for resource
-                in dataset.get_resources()]]))
-        # TODO remplacer par `layers = dataset.get_layers()`
-
-        MRAHandler.create_or_update_layergroup(
-            dataset.organisation.slug, {
-                'name': dataset.slug,
-                'title': dataset.title,
-                'abstract': dataset.description,
-                'layers': [layer.name for layer in layers]})
+        # Cf. `deferred_layergroups`
+        schedule_layergroup(self.resource.dataset_id)
+
+
+# Groupes de couches
+# ==================
+
+# Le groupe de couches d'un jeu de données est reconstruit entièrement ;
+# les demandes sont regroupées par jeu de données et, dans un bloc
+# `deferred_layergroups` (p. ex. l'enregistrement d'une ressource),
+# exécutées une seule fois à la sortie du bloc le plus externe. Les
+# demandes peuvent aussi être recueillies dans l'ensemble `collect`
+# (p. ex. pour les regrouper entre plusieurs threads).
+
+_layergroups = threading.local()
+
+
+def schedule_layergroup(dataset_id):
+    if getattr(_layergroups, 'depth', 0):
+        _layergroups.pending.add(dataset_id)
+    else:
+        flush_layergroups([dataset_id])
+
+
+@contextmanager
+def deferred_layergroups(collect=None):
+    depth = getattr(_layergroups, 'depth', 0)
+    if not depth:
+        _layergroups.pending = set()
+    _layergroups.depth = depth + 1
+
+    def flush():
+        if collect is not None:
+            collect.update(_layergroups.pending)
+        else:
+            flush_layergroups(_layergroups.pending)
+
+    try:
+        yield
+    except Exception:
+        _layergroups.depth = depth
+        if not depth:
+            # Les couches déjà synchronisées doivent figurer dans le groupe
+            try:
+                flush()
+            except Exception as e:
+                logger.exception(e)
+        raise
+    else:
+        _layergroups.depth = depth
+        if not depth:
+            flush()
+
+
+def flush_layergroups(dataset_ids):
+    dataset_ids = sorted(dataset_ids)
+    if not dataset_ids:
+        return
+    if LAYERGROUP_ASYNC:
+        # Import tardif : `celeriac` dépend de `idgo_admin`
+        from celeriac.tasks import rebuild_layergroups
+        rebuild_layergroups.apply_async(
+            kwargs={'datasets': dataset_ids}, countdown=LAYERGROUP_COUNTDOWN)
+        return
+    for dataset_id in dataset_ids:
+        rebuild_layergroup(dataset_id)
+
+
+def layergroup_data(dataset):
+    """Retourner le groupe de couches attendu du jeu de données (sans
+    instancier les couches), ou `None` si le jeu de données n'en a pas."""
+    layers = Layer.objects.filter(
+        resource__dataset=dataset).order_by('resource', 'name')
+    names = []
+    for name, summary in layers.values_list('name', 'summary'):
+        names.append(name)
+        names.extend([
+            generalized['name'] for generalized
+            in (summary or {}).get('generalized', [])])
+    if not names:
+        return None
+    return {
+        'name': dataset.slug,
+        'title': dataset.title,
+        'abstract': dataset.description,
+        'layers': names}
+
+
+def rebuild_layergroup(dataset_id):
+    """Reconstruire le groupe de couches du jeu de données."""
+    Dataset = apps.get_model(app_label='idgo_admin', model_name='Dataset')
+    try:
+        dataset = Dataset.objects.select_related('organisation').get(pk=dataset_id)
+    except Dataset.DoesNotExist:
+        return
+    if not dataset.organisation:
+        return
+
+    data = layergroup_data(dataset)
+    if not data:
+        MRAHandler.del_layergroup(dataset.organisation.slug, dataset.slug)
+        return
+    MRAHandler.create_or_update_layergroup(dataset.organisation.slug, data)
 
 
 # Signaux
@@ -0,0 +1,77 @@
+# Copyright (c) 2017-2019 Datasud.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from django.contrib.gis.db import models
+from django.contrib.postgres.fields import JSONField
+
+
+class MraObject(models.Model):
+    """Miroir local des objets MRA créés ou modifiés par IDGO.
+
+    L'objet est identifié par son chemin dans l'API de MRA
+    (p. ex. `workspaces/<ws>/datastores/<ds>/featuretypes/<ft>`).
+    """
+
+    class Meta(object):
+        verbose_name = "Objet MRA"
+        verbose_name_plural = "Objets MRA"
+
+    path = models.CharField(
+        verbose_name="Chemin",
+        max_length=255,
+        primary_key=True,
+        )
+
+    KIND_CHOICES = (
+        ('workspace', "Workspace"),
+        ('datastore', "Data store"),
+        ('featuretype', "Feature type"),
+        ('coveragestore', "Coverage store"),
+        ('coverage', "Coverage"),
+        ('layer', "Couche"),
+        ('layergroup', "Groupe de couches"),
+        )
+
+    kind = models.CharField(
+        verbose_name="Type",
+        max_length=16,
+        choices=KIND_CHOICES,
+        )
+
+    name = models.CharField(
+        verbose_name="Nom",
+        max_length=100,
+        db_index=True,
+        )
+
+    state = JSONField(
+        verbose_name="État connu",
+        blank=True,
+        null=True,
+        )
+
+    updated = models.DateTimeField(
+        verbose_name="Dernière mise à jour",
+        auto_now=True,
+        )
+
+    def __str__(self):
+        return self.path
+
+    @property
+    def ws_name(self):
+        if self.path.startswith('workspaces/'):
+            return self.path.split('/')[1]
@@ -19,6 +19,7 @@ from django.apps import apps
 from django.conf import settings
 from django.contrib.gis.db import models
 from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.fields import JSONField
 from django.core.exceptions import ValidationError
 from django.core.files import File
 from django.db import IntegrityError
@@ -34,19 +35,29 @@ from idgo_admin.ckan_module import CkanUserHandler
 from idgo_admin.datagis import bounds_to_wkt
 from idgo_admin.datagis import DataDecodingError
 from idgo_admin.datagis import drop_table
+from idgo_admin.datagis import fingerprint_filename
+from idgo_admin.datagis import gdal2cog
 from idgo_admin.datagis import gdalinfo
+from idgo_admin.datagis import get_extent
 from idgo_admin.datagis import get_gdalogr_object
+from idgo_admin.datagis import invalidate_tiles
 from idgo_admin.datagis import NotDataGISError
 from idgo_admin.datagis import NotFoundSrsError
 from idgo_admin.datagis import NotOGRError
 from idgo_admin.datagis import NotSupportedSrsError
+from idgo_admin.datagis import RasterPreparationError
 from idgo_admin.datagis import ogr2postgis
 from idgo_admin.datagis import WrongDataError
 from idgo_admin.exceptions import ExceedsMaximumLayerNumberFixedError
+from idgo_admin.exceptions import NotModifiedError
 from idgo_admin.exceptions import SizeLimitExceededError
 from idgo_admin import logger
 from idgo_admin.managers import DefaultResourceManager
+from idgo_admin.models.layer import deferred_layergroups
 from idgo_admin.utils import download
+from idgo_admin.utils import place_file
+from idgo_admin.utils import probe
+from idgo_admin.utils import remove_dir
 from idgo_admin.utils import remove_file
 from idgo_admin.utils import slugify
 from idgo_admin.utils import three_suspension_points
@@ -54,7 +65,6 @@ import json
 import os
 from pathlib import Path
 import re
-import shutil
 from urllib.parse import urljoin
 import uuid
 
@@ -67,6 +77,13 @@ try:
 except AttributeError:
     DOWNLOAD_SIZE_LIMIT = 104857600
 
+# Lire les données SIG distantes (`dl_url`) directement depuis
+# leur URL plutôt que de les télécharger au préalable
+try:
+    REMOTE_INGESTION = settings.DATAGIS_REMOTE_INGESTION
+except AttributeError:
+    REMOTE_INGESTION = False
+
 if settings.STATIC_ROOT:
     locales_path = os.path.join(
         settings.STATIC_ROOT, 'mdedit/config/locales/fr/locales.json')
@@ -395,13 +412,45 @@ class Resource(models.Model):
         null=True,
         )
 
+    sync_diff = JSONField(
+        verbose_name='Statistiques de la dernière synchronisation',
+        blank=True,
+        null=True,
+        )
+
+    dl_etag = models.CharField(
+        verbose_name='ETag de la ressource téléchargée',
+        max_length=255,
+        blank=True,
+        null=True,
+        )
+
+    dl_last_modified = models.CharField(
+        verbose_name='Date de modification de la ressource téléchargée',
+        max_length=255,
+        blank=True,
+        null=True,
+        )
+
+    dl_sha256 = models.CharField(
+        verbose_name='Empreinte SHA-256 de la ressource téléchargée',
+        max_length=64,
+        blank=True,
+        null=True,
+        )
+
     def __str__(self):
         return self.title
 
     # Propriétés
     # ==========
 
-    _encoding = 'utf-8'
+    # Déterminé à partir des données s'il n'est pas indiqué
+    _encoding = None
+
+    # Géométries réparées et objets mis en quarantaine lors du dernier
+    # chargement des données, par table (Cf. `ogr2postgis`)
+    quarantine_report = None
 
     @property
     def encoding(self):
@@ -445,8 +494,10 @@ class Resource(models.Model):
     # Méthodes héritées
     # =================
 
+    @deferred_layergroups()
     def save(self, *args, current_user=None, synchronize=False,
-             file_extras=None, skip_download=False, **kwargs):
+             file_extras=None, skip_download=False, progress=None,
+             skip_if_unchanged=False, **kwargs):
 
         # Version précédante de la ressource (avant modification)
         previous, created = self.pk \
@@ -482,6 +533,9 @@ class Resource(models.Model):
         content_type = None
         file_must_be_deleted = False  # permet d'indiquer si les fichiers doivent être supprimés à la fin de la chaine de traitement
         publish_raw_resource = True  # permet d'indiquer si les ressources brutes sont publiées dans CKAN
+        unchanged = False  # permet d'indiquer si les données distantes sont identiques à celles déjà chargées
+        remote_source = False  # permet d'indiquer si les données SIG sont lues directement à distance
+        fingerprint = None  # empreinte des données téléchargées (Cf. `gdal2cog`)
 
         if self.ftp_file and not skip_download:
             filename = self.ftp_file.file.name
@@ -501,7 +555,11 @@ class Resource(models.Model):
                             s1, s2, s3 = s0[:3], s0[3:6], s0[6:]
                             dir = os.path.join(CKAN_STORAGE_PATH, s1, s2)
                             os.makedirs(dir, mode=0o777, exist_ok=True)
-                            shutil.copyfile(filename, os.path.join(dir, s3))
+                            placed = place_file(filename, os.path.join(dir, s3))
+                            logger.info((
+                                'Resource "{pk}": raster file placed ({method}), '
+                                '{bytes}/{size} bytes copied in {seconds}s.'
+                                ).format(pk=self.pk, **placed))
 
                             src = os.path.join(dir, s3)
                             dst = os.path.join(dir, filename.split('/')[-1])
@@ -523,9 +581,29 @@ class Resource(models.Model):
             file_must_be_deleted = True
 
         elif self.dl_url and not skip_download:
+            # Les données SIG peuvent être lues à distance par GDAL
+            # (Cf. `datagis.vsi_path`) ; elles sont alors seulement contrôlées.
+            remote_source = REMOTE_INGESTION and self.format_type.is_gis_format
+            # Les validateurs de la version précédente ne sont utilisables
+            # que si rien d'autre ne justifie de recharger les données
+            same_source = previous \
+                and previous.dl_url == self.dl_url \
+                and previous.encoding == self.encoding \
+                and previous.format_type_id == self.format_type_id
             try:
-                directory, filename, content_type = download(
-                    self.dl_url, settings.MEDIA_ROOT, max_size=DOWNLOAD_SIZE_LIMIT)
+                opts = {
+                    'max_size': DOWNLOAD_SIZE_LIMIT,
+                    'etag': same_source and previous.dl_etag or None,
+                    'last_modified': same_source and previous.dl_last_modified or None}
+                if remote_source:
+                    content_type, validators = probe(self.dl_url, **opts)
+                    directory, filename = None, self.dl_url
+                else:
+                    directory, filename, content_type, validators = download(
+                        self.dl_url, settings.MEDIA_ROOT, **opts)
+            except NotModifiedError:
+                logger.info('Resource "{pk}": remote data not modified.'.format(pk=self.pk))
+                unchanged = True
             except SizeLimitExceededError as e:
                 l = len(str(e.max_size))
                 if l > 6:
@@ -551,7 +629,33 @@ class Resource(models.Model):
                 else:
                     msg = 'Le téléchargement du fichier a échoué.'
                 raise ValidationError(msg, code='dl_url')
-            file_must_be_deleted = True
+            else:
+                self.dl_etag = validators['etag']
+                self.dl_last_modified = validators['last_modified']
+                if same_source and validators['sha256'] \
+                        and previous.dl_sha256 == validators['sha256']:
+                    # Le contenu est identique à celui déjà chargé :
+                    # inutile de relancer toute la chaîne de traitement.
+                    logger.info('Resource "{pk}": remote data unchanged.'.format(pk=self.pk))
+                    directory and remove_dir(directory)
+                    filename = False
+                    unchanged = True
+                else:
+                    self.dl_sha256 = validators['sha256']
+                    file_must_be_deleted = not remote_source
+                    if validators['sha256']:
+                        fingerprint = {'sha256': validators['sha256']}
+                    elif validators['etag'] or validators['last_modified']:
+                        fingerprint = {
+                            'url': self.dl_url,
+                            'etag': validators['etag'],
+                            'last_modified': validators['last_modified']}
+
+        # Dans le cas d'une synchronisation planifiée, si les données
+        # distantes n'ont pas changé, il n'y a rien d'autre à faire.
+        if unchanged and skip_if_unchanged:
+            super().save(update_fields=['last_update', 'dl_etag', 'dl_last_modified'])
+            return
 
         # Synchronisation avec CKAN
         # =========================
@@ -559,7 +663,10 @@ class Resource(models.Model):
         # La synchronisation doit s'effectuer avant la publication des
         # éventuelles couches de données SIG car dans le cas des données
         # de type « raster », nous utilisons le filestore de CKAN.
-        if synchronize and publish_raw_resource:
+        if synchronize and remote_source:
+            # Les données n'étant pas téléchargées, on référence l'URL distante
+            self.synchronize(url=self.dl_url, with_user=current_user)
+        elif synchronize and publish_raw_resource:
             self.synchronize(
                 content_type=content_type, file_extras=file_extras,
                 filename=filename, with_user=current_user)
@@ -620,11 +727,21 @@ class Resource(models.Model):
 
                             # On convertit les données vers PostGIS
 
+                            def show_progress(table_id, count, total):
+                                logger.info(
+                                    'Resource "{pk}": {count}/{total} features loaded '
+                                    'into table "{table}"'.format(
+                                        pk=self.pk, count=count, total=total, table=table_id))
+                                progress and progress(table_id, count, total)
+
                             try:
                                 tables = ogr2postgis(
                                     gdalogr_obj, update=existing_layers,
                                     epsg=self.crs and self.crs.auth_code or None,
-                                    encoding=self.encoding)
+                                    encoding=self.encoding, progress=show_progress,
+                                    # Seules les différences sont appliquées aux
+                                    # tables des ressources synchronisées
+                                    incremental=self.synchronisation)
 
                             except NotOGRError as e:
                                 logger.warning(e)
@@ -677,13 +794,37 @@ class Resource(models.Model):
                                 raise ValidationError(e.__str__(), code='__all__')
 
                             else:
+                                self.quarantine_report = []
+                                for table in tables:
+                                    invalidate_tiles(table['id'])
+                                    summary = table['summary']
+                                    if summary['repaired'] or summary['quarantined']:
+                                        logger.warning(
+                                            'Resource "{pk}": table "{table}": {repaired} geometries '
+                                            'repaired, {quarantined} features quarantined'.format(
+                                                pk=self.pk, table=table['id'], **summary))
+                                        self.quarantine_report.append({
+                                            'table': table['id'],
+                                            'repaired': summary['repaired'],
+                                            'quarantined': summary['quarantined']})
+
+                                if self.synchronisation:
+                                    self.sync_diff = {
+                                        'date': timezone.now().isoformat(),
+                                        'tables': dict(
+                                            (table['id'], dict(
+                                                table.get('diff') or {'replaced': True},
+                                                repaired=table['summary']['repaired'],
+                                                quarantined=table['summary']['quarantined']))
+                                            for table in tables)}
+
                                 # Ensuite, pour tous les jeux de données SIG trouvés,
                                 # on crée le service ows à travers la création de `Layer`
                                 try:
                                     Layer = apps.get_model(app_label='idgo_admin', model_name='Layer')
                                     for table in tables:
                                         try:
-                                            Layer.objects.get(
+                                            layer = Layer.objects.get(
                                                 name=table['id'], resource=self)
                                         except Layer.DoesNotExist:
                                             save_opts = {'synchronize': synchronize}
@@ -691,7 +832,19 @@ class Resource(models.Model):
                                                 bbox=table['bbox'],
                                                 name=table['id'],
                                                 resource=self,
+                                                summary=table['summary'],
                                                 save_opts=save_opts)
+                                        else:
+                                            # La couche existe déjà : seule sa synthèse change
+                                            Layer.objects.filter(name=table['id']).update(
+                                                summary=table['summary'])
+                                            previous_generalized = layer.generalized
+                                            layer.summary = table['summary']
+                                            if previous_generalized or layer.generalized:
+                                                layer.save_generalized_layers(
+                                                    previous=previous_generalized)
+                                                layer.handle_enable_ows_status()
+                                                layer.handle_layergroup()
                                 except Exception as e:
                                     logger.error(e)
                                     file_must_be_deleted and remove_file(filename)
@@ -735,12 +888,31 @@ class Resource(models.Model):
                             s0 = str(self.ckan_id)
                             s1, s2, s3 = s0[:3], s0[3:6], s0[6:]
                             dir = os.path.join(CKAN_STORAGE_PATH, s1, s2)
+                            os.makedirs(dir, mode=0o777, exist_ok=True)
                             src = os.path.join(dir, s3)
                             dst = os.path.join(dir, filename.split('/')[-1])
+
+                            # Le service OGC s'appuie sur une version optimisée
+                            # (COG) des données ; à défaut, sur le fichier brut.
                             try:
-                                os.symlink(src, dst)
-                            except FileExistsError as e:
-                                logger.warning(e)
+                                src = gdal2cog(
+                                    coverage, '{}.cog.tif'.format(src),
+                                    fingerprint=fingerprint)
+                            except RasterPreparationError as e:
+                                logger.error(e)
+                                if remote_source:
+                                    # Les données distantes ne sont pas
+                                    # copiées : il n'y a pas de fichier brut.
+                                    msg = (
+                                        'La préparation des données matricielles '
+                                        'pour le service OGC a échoué.')
+                                    raise ValidationError(msg, code='dl_url')
+
+                            # Le lien est remplacé en une seule opération
+                            tmp = '{}.{}'.format(dst, str(uuid.uuid4())[:7])
+                            try:
+                                os.symlink(src, tmp)
+                                os.replace(tmp, dst)
                             except FileNotFoundError as e:
                                 logger.error(e)
                             else:
@@ -786,18 +958,25 @@ class Resource(models.Model):
                 self.crs = crs and crs[0] or None
 
                 # Si les données changent..
-                if existing_layers and \
-                        previous.get_layers() != self.get_layers():
+                if existing_layers:
                     # on supprime les anciens `layers`..
-                    for layer in previous.get_layers():
+                    for layer in previous.get_layers().exclude(
+                            name__in=[table['id'] for table in tables]):
                         layer.delete()
         ####
         if self.get_layers():
-            extent = self.get_layers().aggregate(models.Extent('bbox')).get('bbox__extent')
-            if extent:
-                xmin, ymin = extent[0], extent[1]
-                xmax, ymax = extent[2], extent[3]
-                setattr(self, 'bbox', bounds_to_wkt(xmin, ymin, xmax, ymax))
+            # L'emprise des tables est celle calculée lors de leur
+            # chargement (Cf. `get_extent`) ; celle des données
+            # matricielles est le rectangle englobant de la couche.
+            extents = [
+                get_extent(self.get_layers(type='vector').values_list('name', flat=True)),
+                self.get_layers().exclude(type='vector').aggregate(
+                    models.Extent('bbox')).get('bbox__extent')]
+            extents = [extent for extent in extents if extent]
+            if extents:
+                xmin, ymin, xmax, ymax = zip(*extents)
+                setattr(self, 'bbox', bounds_to_wkt(
+                    min(xmin), min(ymin), max(xmax), max(ymax)))
         else:
             # Si la ressource n'est pas de type SIG, on passe les trois arguments
             # qui concernent exclusivement ces dernières à « False ».
@@ -829,6 +1008,7 @@ class Resource(models.Model):
                           synchronize=True,
                           update_fields=['date_modification'])
 
+    @deferred_layergroups()
     def delete(self, *args, current_user=None, **kwargs):
         with_user = current_user
 
@@ -846,6 +1026,13 @@ class Resource(models.Model):
         else:
             CkanHandler.delete_resource(ckan_id)
 
+        # On supprime la version optimisée (COG) des données matricielles
+        cog = os.path.join(
+            CKAN_STORAGE_PATH, ckan_id[:3], ckan_id[3:6],
+            '{}.cog.tif'.format(ckan_id[6:]))
+        remove_file(cog)
+        remove_file(fingerprint_filename(cog))
+
         # On supprime l'instance
         super().delete(*args, **kwargs)
 
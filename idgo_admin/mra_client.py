@@ -20,12 +20,13 @@ from django.conf import settings
 from functools import reduce
 from functools import wraps
 from idgo_admin.exceptions import MraBaseError
+from idgo_admin.http_client import get_session
 from idgo_admin import logger
 from idgo_admin.utils import Singleton
 import inspect
 import os
-from requests import request
-import timeout_decorator
+import re
+import requests
 from urllib.parse import urljoin
 #
 from idgo_admin.utils import kill_all_special_characters
@@ -34,24 +35,14 @@ from idgo_admin.utils import kill_all_special_characters
 
 MRA = settings.MRA
 MRA_TIMEOUT = MRA.get('TIMEOUT', 3600)
+# Tenir un miroir local des objets MRA (Cf. `MraObject`) afin de
+# n'envoyer que les écritures nécessaires ; il doit alors être réconcilié
+# régulièrement avec MRA (Cf. la tâche `reconcile_mra`)
+MRA_MIRROR = MRA.get('MIRROR', False)
 MRA_DATAGIS_USER = MRA['DATAGIS_DB_USER']
 DB_SETTINGS = settings.DATABASES[settings.DATAGIS_DB]
 
 
-def timeout(fun):
-    t = MRA_TIMEOUT  # in seconds
-
-    @timeout_decorator.timeout(t, use_signals=False)
-    def return_with_timeout(fun, args=tuple(), kwargs=dict()):
-        return fun(*args, **kwargs)
-
-    @wraps(fun)
-    def wrapper(*args, **kwargs):
-        return return_with_timeout(fun, args=args, kwargs=kwargs)
-
-    return wrapper
-
-
 class MRASyncingError(MraBaseError):
     def __init__(self, *args, **kwargs):
         for item in self.args:
@@ -117,7 +108,7 @@ class MRAExceptionsHandler(object):
                         raise MRANotFoundError()
                     if e.response.status_code == 409:
                         raise MRAConflictError()
-                if isinstance(e, timeout_decorator.TimeoutError):
+                if isinstance(e, requests.exceptions.Timeout):
                     raise MRATimeoutError()
                 if self.is_ignored(e):
                     return f(*args, **kwargs)
@@ -134,7 +125,6 @@ class MRAClient(object):
         self.base_url = url
         self.auth = (username and password) and (username, password)
 
-    @timeout
     def _req(self, method, url, extension='json', **kwargs):
         kwargs.setdefault('allow_redirects', True)
         kwargs.setdefault('headers', {'content-type': 'application/json; charset=utf-8'})
@@ -142,7 +132,8 @@ class MRAClient(object):
         url = '{0}.{1}'.format(
             reduce(urljoin, (self.base_url,) + tuple(m + '/' for m in url))[:-1],
             extension)
-        r = request(method, url, auth=self.auth, **kwargs)
+        r = get_session('mra', deadline=MRA_TIMEOUT).request(
+            method, url, auth=self.auth, **kwargs)
         r.raise_for_status()
         if r.status_code == 200:
             if extension == 'json':
@@ -173,6 +164,62 @@ class MRAHandler(metaclass=Singleton):
         self.remote = MRAClient(
             MRA['URL'], username=MRA['USERNAME'], password=MRA['PASSWORD'])
 
+    # Miroir local
+    # ============
+
+    # Le miroir peut différer de MRA (objets modifiés par ailleurs,
+    # transaction annulée, etc.) : la commande `reconcile_mra` le répare.
+
+    def mirrored(self, *path):
+        if not MRA_MIRROR:
+            return None
+        MraObject = apps.get_model(app_label='idgo_admin', model_name='MraObject')
+        try:
+            return MraObject.objects.get(path='/'.join(path))
+        except MraObject.DoesNotExist:
+            return None
+
+    def mirror(self, kind, state, *path):
+        if not MRA_MIRROR:
+            return
+        MraObject = apps.get_model(app_label='idgo_admin', model_name='MraObject')
+        MraObject.objects.update_or_create(
+            path='/'.join(path),
+            defaults={'kind': kind, 'name': path[-1], 'state': state})
+
+    def forget(self, *path):
+        MraObject = apps.get_model(app_label='idgo_admin', model_name='MraObject')
+        path = '/'.join(path)
+        MraObject.objects.filter(path=path).delete()
+        MraObject.objects.filter(path__startswith=path + '/').delete()
+
+    def remove(self, *path):
+        """Supprimer l'objet MRA `path` et l'oublier dans le miroir.
+
+        Un objet absent de MRA (404) est considéré comme supprimé ; le
+        miroir est mis à jour même si la suppression échoue, l'objet
+        étant alors de nouveau obtenu auprès de MRA à la prochaine
+        utilisation.
+        """
+        try:
+            self.remote.delete(*path)
+        except requests.exceptions.HTTPError as e:
+            if e.response is None or e.response.status_code != 404:
+                raise e
+        finally:
+            self.forget(*path)
+
+    def get_or_create(self, kind, path, get, create):
+        mirrored = self.mirrored(*path)
+        if mirrored:
+            return mirrored.state
+        try:
+            obj = get()
+        except MRANotFoundError:
+            obj = create()
+        self.mirror(kind, obj, *path)
+        return obj
+
     # Workspace
     # =========
 
@@ -191,7 +238,7 @@ class MRAHandler(metaclass=Singleton):
 
     @MRAExceptionsHandler(ignore=[MRANotFoundError])
     def del_workspace(self, ws_name):
-        self.remote.delete('workspaces', ws_name)
+        self.remove('workspaces', ws_name)
 
     @MRAExceptionsHandler()
     def create_workspace(self, organisation):
@@ -210,11 +257,10 @@ class MRAHandler(metaclass=Singleton):
         return self.get_workspace(organisation.slug)
 
     def get_or_create_workspace(self, organisation):
-        try:
-            return self.get_workspace(organisation.slug)
-        except MRANotFoundError:
-            pass
-        return self.create_workspace(organisation)
+        return self.get_or_create(
+            'workspace', ('workspaces', organisation.slug),
+            lambda: self.get_workspace(organisation.slug),
+            lambda: self.create_workspace(organisation))
 
     # Data store
     # ==========
@@ -226,8 +272,7 @@ class MRAHandler(metaclass=Singleton):
 
     @MRAExceptionsHandler(ignore=[MRANotFoundError])
     def del_datastore(self, ws_name, ds_name):
-        self.remote.delete('workspaces', ws_name,
-                           'datastores', ds_name)
+        self.remove('workspaces', ws_name, 'datastores', ds_name)
 
     @MRAExceptionsHandler()
     def create_datastore(self, ws_name, ds_name):
@@ -248,11 +293,10 @@ class MRAHandler(metaclass=Singleton):
         return self.get_datastore(ws_name, ds_name)
 
     def get_or_create_datastore(self, ws_name, ds_name):
-        try:
-            return self.get_datastore(ws_name, ds_name)
-        except MRANotFoundError:
-            pass
-        return self.create_datastore(ws_name, ds_name)
+        return self.get_or_create(
+            'datastore', ('workspaces', ws_name, 'datastores', ds_name),
+            lambda: self.get_datastore(ws_name, ds_name),
+            lambda: self.create_datastore(ws_name, ds_name))
 
     @MRAExceptionsHandler(ignore=[MRANotFoundError])
     def get_featuretype(self, ws_name, ds_name, ft_name):
@@ -262,9 +306,8 @@ class MRAHandler(metaclass=Singleton):
 
     @MRAExceptionsHandler(ignore=[MRANotFoundError])
     def del_featuretype(self, ws_name, ds_name, ft_name):
-        self.remote.delete('workspaces', ws_name,
-                           'datastores', ds_name,
-                           'featuretypes', ft_name)
+        self.remove('workspaces', ws_name, 'datastores', ds_name,
+                    'featuretypes', ft_name)
 
     @MRAExceptionsHandler()
     def create_featuretype(self, ws_name, ds_name, ft_name, **kwargs):
@@ -282,11 +325,11 @@ class MRAHandler(metaclass=Singleton):
         return self.get_featuretype(ws_name, ds_name, ft_name)
 
     def get_or_create_featuretype(self, ws_name, ds_name, ft_name, **kwargs):
-        try:
-            return self.get_featuretype(ws_name, ds_name, ft_name)
-        except MRANotFoundError:
-            pass
-        return self.create_featuretype(ws_name, ds_name, ft_name, **kwargs)
+        return self.get_or_create(
+            'featuretype',
+            ('workspaces', ws_name, 'datastores', ds_name, 'featuretypes', ft_name),
+            lambda: self.get_featuretype(ws_name, ds_name, ft_name),
+            lambda: self.create_featuretype(ws_name, ds_name, ft_name, **kwargs))
 
     # Coverage store
     # ==============
@@ -298,8 +341,7 @@ class MRAHandler(metaclass=Singleton):
 
     @MRAExceptionsHandler(ignore=[MRANotFoundError])
     def del_coveragestore(self, ws_name, cs_name):
-        self.remote.delete('workspaces', ws_name,
-                           'coveragestores', cs_name)
+        self.remove('workspaces', ws_name, 'coveragestores', cs_name)
 
     @MRAExceptionsHandler()
     def create_coveragestore(self, ws_name, cs_name, filename=None):
@@ -315,11 +357,10 @@ class MRAHandler(metaclass=Singleton):
         return self.get_coveragestore(ws_name, cs_name)
 
     def get_or_create_coveragestore(self, ws_name, cs_name, **kwargs):
-        try:
-            return self.get_coveragestore(ws_name, cs_name)
-        except MRANotFoundError:
-            pass
-        return self.create_coveragestore(ws_name, cs_name, **kwargs)
+        return self.get_or_create(
+            'coveragestore', ('workspaces', ws_name, 'coveragestores', cs_name),
+            lambda: self.get_coveragestore(ws_name, cs_name),
+            lambda: self.create_coveragestore(ws_name, cs_name, **kwargs))
 
     @MRAExceptionsHandler(ignore=[MRANotFoundError])
     def get_coverage(self, ws_name, cs_name, c_name):
@@ -329,9 +370,8 @@ class MRAHandler(metaclass=Singleton):
 
     @MRAExceptionsHandler(ignore=[MRANotFoundError])
     def del_coverage(self, ws_name, cs_name, c_name):
-        self.remote.delete('workspaces', ws_name,
-                           'coveragestores', cs_name,
-                           'coverages', c_name)
+        self.remove('workspaces', ws_name, 'coveragestores', cs_name,
+                    'coverages', c_name)
 
     @MRAExceptionsHandler()
     def create_coverage(self, ws_name, cs_name, c_name, **kwargs):
@@ -349,11 +389,11 @@ class MRAHandler(metaclass=Singleton):
         return self.get_coverage(ws_name, cs_name, c_name)
 
     def get_or_create_coverage(self, ws_name, cs_name, c_name, **kwargs):
-        try:
-            return self.get_coverage(ws_name, cs_name, c_name)
-        except MRANotFoundError:
-            pass
-        return self.create_coverage(ws_name, cs_name, c_name, **kwargs)
+        return self.get_or_create(
+            'coverage',
+            ('workspaces', ws_name, 'coveragestores', cs_name, 'coverages', c_name),
+            lambda: self.get_coverage(ws_name, cs_name, c_name),
+            lambda: self.create_coverage(ws_name, cs_name, c_name, **kwargs))
 
     # Style
     # =====
@@ -398,15 +438,43 @@ class MRAHandler(metaclass=Singleton):
 
     @MRAExceptionsHandler(ignore=[MRANotFoundError])
     def del_layer(self, l_name):
-        self.remote.delete('layers', l_name)
+        self.remove('layers', l_name)
+
+    def get_layer_workspace(self, l_name, store='datastores'):
+        """Retourner le nom du workspace de la couche (`store` : 'datastores' ou 'coveragestores')."""
+        kind = {'datastores': 'featuretype', 'coveragestores': 'coverage'}[store]
+        if MRA_MIRROR:
+            MraObject = apps.get_model(app_label='idgo_admin', model_name='MraObject')
+            for mirrored in MraObject.objects.filter(kind=kind, name=l_name):
+                return mirrored.ws_name
+        layer = self.get_layer(l_name)
+        regex = '/workspaces/(?P<ws_name>[a-z_\-]+)/{}/'.format(store)
+        matched = re.search(regex, layer['resource']['href'])
+        return matched and matched.group('ws_name') or None
 
     @MRAExceptionsHandler()
     def update_layer(self, l_name, data, ws_name=None):
+        # Seules les valeurs qui diffèrent de l'état connu sont envoyées
+        mirrored = self.mirrored('layers', l_name)
+        state = mirrored and mirrored.state or {}
+        if mirrored and all(state.get(k) == v for k, v in data.items()):
+            return
         if ws_name:
-            return self.remote.put('workspaces', ws_name,
-                                   'layers', l_name,
-                                   json={'layer': data})
-        return self.remote.put('layers', l_name, json={'layer': data})
+            r = self.remote.put('workspaces', ws_name,
+                                'layers', l_name,
+                                json={'layer': data})
+        else:
+            r = self.remote.put('layers', l_name, json={'layer': data})
+        self.mirror('layer', dict(state, **data), 'layers', l_name)
+        return r
+
+    @MRAExceptionsHandler()
+    def set_layer_scale_range(self, ws_name, l_name, min_scale=None, max_scale=None):
+        # Correspond aux paramètres MINSCALEDENOM et MAXSCALEDENOM
+        # de la couche MapServer (`None` pour ne pas borner)
+        self.update_layer(l_name, {
+            'minScaleDenominator': min_scale,
+            'maxScaleDenominator': max_scale}, ws_name=ws_name)
 
     @MRAExceptionsHandler()
     def enable_layer(self, ws_name, l_name):
@@ -476,18 +544,21 @@ class MRAHandler(metaclass=Singleton):
     @MRAExceptionsHandler()
     def create_or_update_layergroup(self, ws_name, data):
         lg_name = data.get('name')
-        if self.is_layergroup_exists(ws_name, lg_name):
+        mirrored = self.mirrored('workspaces', ws_name, 'layergroups', lg_name)
+        if mirrored and mirrored.state == data:
+            return
+        if mirrored or self.is_layergroup_exists(ws_name, lg_name):
             self.remote.put('workspaces', ws_name,
                             'layergroups', lg_name,
                             json={'layerGroup': data})
         else:
             self.remote.post('workspaces', ws_name,
                              'layergroups', json={'layerGroup': data})
+        self.mirror('layergroup', data, 'workspaces', ws_name, 'layergroups', lg_name)
 
     @MRAExceptionsHandler()
     def del_layergroup(self, ws_name, lg_name):
-        if self.is_layergroup_exists(ws_name, lg_name):
-            self.remote.delete('workspaces', ws_name, 'layergroups', lg_name)
+        self.remove('workspaces', ws_name, 'layergroups', lg_name)
 
     # Miscellaneous
     # =============
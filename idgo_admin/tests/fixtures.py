@@ -0,0 +1,61 @@
+# Copyright (c) 2017-2019 Datasud.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+
+from django.db import connections
+from idgo_admin.datagis import DATABASE
+import json
+import os
+
+
+# Les tests qui sollicitent la base de données SIG (PostGIS) utilisent la
+# base de test de la connexion `DATAGIS_DB` : ils héritent de
+# `TransactionTestCase` avec `multi_db = True`, les tables étant lues par
+# d'autres connexions (chargement parallèle, verrous de chargement).
+
+
+def polygon(xmin, ymin, xmax, ymax):
+    return {'type': 'Polygon', 'coordinates': [[
+        [xmin, ymin], [xmax, ymin], [xmax, ymax], [xmin, ymax], [xmin, ymin]]]}
+
+
+def feature(geometry, **properties):
+    return {'type': 'Feature', 'properties': properties, 'geometry': geometry}
+
+
+COMMUNES = [
+    feature(polygon(5.70, 45.15, 5.75, 45.20), nom="Saint-Martin-d'Hères", population=38000),
+    feature(polygon(5.75, 45.15, 5.80, 45.20), nom='Gières', population=6700),
+    feature(polygon(5.80, 45.15, 5.85, 45.20), nom='Tabulation\tet\\barre', population=None),
+    ]
+
+
+def write_geojson(directory, name, features):
+    filename = os.path.join(directory, '{}.geojson'.format(name))
+    with open(filename, 'w', encoding='utf-8') as f:
+        json.dump({'type': 'FeatureCollection', 'features': features}, f)
+    return filename
+
+
+def fetch_all(sql, params=None):
+    with connections[DATABASE].cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+
+def list_tables(schema):
+    return [table for table, in fetch_all(
+        'SELECT tablename FROM pg_tables WHERE schemaname = %s;', [schema])]
@@ -0,0 +1,444 @@
+# Copyright (c) 2017-2019 Datasud.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+
+from django.contrib.gis.gdal import DataSource
+from django.contrib.gis.geos import GEOSGeometry
+from django.db import connections
+from django.db import DatabaseError
+from django.db import ProgrammingError
+from django.db import transaction
+from django.test import SimpleTestCase
+from django.test import TestCase
+from django.test import TransactionTestCase
+from django.utils import timezone
+from idgo_admin.datagis import acquire_import_lock
+from idgo_admin.datagis import apply_diff
+from idgo_admin.datagis import clean_up_staging_tables
+from idgo_admin.datagis import DATABASE
+from idgo_admin.datagis import detect_encoding
+from idgo_admin.datagis import drop_table
+from idgo_admin.datagis import gdal2cog
+from idgo_admin.datagis import is_up_to_date
+from idgo_admin.datagis import ogr2postgis
+from idgo_admin.datagis import OgrOpener
+from idgo_admin.datagis import prepare_staging_tables
+from idgo_admin.datagis import publish_tables
+from idgo_admin.datagis import release_import_lock
+from idgo_admin.datagis import QUARANTINE_SCHEMA
+from idgo_admin.datagis import SQLError
+from idgo_admin.datagis import STAGING_SCHEMA
+from idgo_admin.datagis import WrongDataError
+from idgo_admin.datagis import ThreadPool
+from idgo_admin.datagis import transform
+from idgo_admin.models import SupportedCrs
+from idgo_admin.tests.fixtures import COMMUNES
+from idgo_admin.tests.fixtures import feature
+from idgo_admin.tests.fixtures import fetch_all
+from idgo_admin.tests.fixtures import list_tables
+from idgo_admin.tests.fixtures import polygon
+from idgo_admin.tests.fixtures import write_geojson
+import datetime
+import json
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+
+class DatagisTestCase(TransactionTestCase):
+
+    multi_db = True
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.tables = []
+        SupportedCrs.objects.create(auth_name='EPSG', auth_code='4326')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        for table in self.tables:
+            drop_table(table)
+            drop_table(table, schema=QUARANTINE_SCHEMA)
+        for table in list_tables(STAGING_SCHEMA):
+            drop_table(table, schema=STAGING_SCHEMA)
+
+    def load(self, features, name='communes', **kwargs):
+        filename = write_geojson(self.directory, name, features)
+        tables = ogr2postgis(OgrOpener(filename), **kwargs)
+        for table in tables:
+            self.tables.append(table['id'])
+            self.tables.extend(
+                item['name'] for item in table['summary'].get('generalized', []))
+        return tables
+
+    def select(self, table, columns='nom', schema='public'):
+        return fetch_all('SELECT {} FROM {}."{}" ORDER BY fid;'.format(
+            columns, schema, table))
+
+
+class LoadTestCase(DatagisTestCase):
+
+    def assertLoaded(self, method):
+        table, = self.load(COMMUNES, method=method, batch_size=2)
+
+        self.assertEqual(str(table['epsg']), '4326')
+        self.assertEqual(table['geometry'], 'Polygon')
+        self.assertEqual(self.select(table['id'], 'nom, population'), [
+            ("Saint-Martin-d'Hères", 38000),
+            ('Gières', 6700),
+            ('Tabulation\tet\\barre', None)])
+        self.assertEqual(self.select(table['id'], 'ST_SRID(the_geom)')[0][0], 4171)
+
+        summary = table['summary']
+        self.assertEqual(summary['count'], 3)
+        self.assertEqual(summary['vertices'], 15)
+        self.assertEqual(
+            [round(v, 6) for v in summary['extent']], [5.70, 45.15, 5.85, 45.20])
+        population = dict(
+            (item['name'], item) for item in summary['attributes'])['population']
+        self.assertEqual(population['nulls'], 1)
+        self.assertEqual((population['min'], population['max']), ('6700', '38000'))
+
+        # Rien ne reste dans le schéma de chargement
+        self.assertEqual(list_tables(STAGING_SCHEMA), [])
+
+    def test_load_with_insert(self):
+        self.assertLoaded('insert')
+
+    def test_load_with_copy(self):
+        self.assertLoaded('copy')
+
+    def test_reload_replaces_the_table(self):
+        table, = self.load(COMMUNES)
+        reloaded, = self.load(
+            COMMUNES[:1], update={'communes': table['id']})
+
+        self.assertEqual(reloaded['id'], table['id'])
+        self.assertEqual(self.select(table['id']), [("Saint-Martin-d'Hères",)])
+
+
+class ParallelLoadTestCase(DatagisTestCase):
+
+    def test_load_in_daemon_process(self):
+        # Source multi-couches : un fichier CSV par couche (géométries en WKT)
+        directory = os.path.join(self.directory, 'communes')
+        os.mkdir(directory)
+        for name, rows in (('nord', COMMUNES[:2]), ('sud', COMMUNES[2:])):
+            with open(os.path.join(directory, '{}.csv'.format(name)), 'w') as f:
+                f.write('WKT,nom\n')
+                for row in rows:
+                    xmin, ymin = row['geometry']['coordinates'][0][0]
+                    xmax, ymax = row['geometry']['coordinates'][0][2]
+                    f.write('"POLYGON(({0} {1},{2} {1},{2} {3},{0} {3},{0} {1}))",{4}\n'.format(
+                        xmin, ymin, xmax, ymax, row['properties']['nom'].replace('\t', ' ')))
+
+        # Un worker Celery est un processus « démon »
+        process = mock.Mock(daemon=True)
+        with mock.patch('idgo_admin.datagis.multiprocessing.current_process', return_value=process), \
+                mock.patch('idgo_admin.datagis.ThreadPool', wraps=ThreadPool) as pool:
+            tables = ogr2postgis(OgrOpener(directory), epsg=4326, limit_to=2, workers=2)
+        self.tables.extend(table['id'] for table in tables)
+
+        pool.assert_called_once_with(processes=2)
+        self.assertEqual(
+            sorted(table['summary']['count'] for table in tables), [1, 2])
+        for table in tables:
+            self.assertEqual(len(self.select(table['id'])), table['summary']['count'])
+
+
+class ApplyDiffTestCase(DatagisTestCase):
+
+    def test_incremental_reload(self):
+        table, = self.load(COMMUNES)
+        fids = dict((nom, fid) for fid, nom in self.select(table['id'], 'fid, nom'))
+
+        features = [
+            COMMUNES[0],
+            feature(COMMUNES[1]['geometry'], nom='Gières', population=6800),
+            feature(polygon(5.85, 45.15, 5.90, 45.20), nom='Meylan', population=17000)]
+        reloaded, = self.load(
+            features, update={'communes': table['id']}, incremental=True)
+
+        self.assertEqual(
+            reloaded['diff'], {'inserted': 2, 'deleted': 2, 'unchanged': 1})
+        rows = self.select(table['id'], 'fid, nom, population')
+        self.assertEqual(
+            sorted(row[1:] for row in rows),
+            [('Gières', 6800), ('Meylan', 17000), ("Saint-Martin-d'Hères", 38000)])
+        # L'objet inchangé n'a pas été réécrit
+        self.assertIn((fids["Saint-Martin-d'Hères"], "Saint-Martin-d'Hères", 38000), rows)
+        self.assertEqual(list_tables(STAGING_SCHEMA), [])
+
+    def test_duplicated_features(self):
+        table, = self.load(COMMUNES[:1] * 2)
+        prepare_staging_tables([table['id']])
+        with connections[DATABASE].cursor() as cursor:
+            cursor.execute(
+                'CREATE TABLE {staging}."{table}" AS SELECT * FROM public."{table}";'
+                'INSERT INTO {staging}."{table}" SELECT fid + 10, nom, population, the_geom '
+                'FROM public."{table}" LIMIT 1;'.format(
+                    staging=STAGING_SCHEMA, table=table['id']))
+            with transaction.atomic(using=DATABASE):
+                diff = apply_diff(cursor, table['id'])
+
+        self.assertEqual(diff, {'inserted': 1, 'deleted': 0, 'unchanged': 2})
+        self.assertEqual(len(self.select(table['id'])), 3)
+        self.assertNotIn(table['id'], list_tables(STAGING_SCHEMA))
+
+
+class PublishTablesTestCase(DatagisTestCase):
+
+    def test_publication_is_all_or_nothing(self):
+        table, = self.load(COMMUNES)
+        prepare_staging_tables([table['id']])
+        with connections[DATABASE].cursor() as cursor:
+            cursor.execute(
+                'CREATE TABLE {staging}."{table}" AS '
+                'SELECT * FROM public."{table}" WITH NO DATA;'.format(
+                    staging=STAGING_SCHEMA, table=table['id']))
+
+        # La seconde table n'existe pas : la première n'est pas publiée
+        with self.assertRaises(ProgrammingError):
+            publish_tables([table['id'], 'absente_0000000'])
+
+        self.assertEqual(len(self.select(table['id'])), 3)
+        self.assertIn(table['id'], list_tables(STAGING_SCHEMA))
+
+    def test_failed_publication_drops_the_loaded_tables(self):
+        table, = self.load(COMMUNES)
+
+        with mock.patch('idgo_admin.datagis.publish_tables',
+                        side_effect=DatabaseError('publication impossible')):
+            with self.assertRaises(SQLError):
+                self.load(COMMUNES[:1], update={'communes': table['id']})
+
+        self.assertEqual(len(self.select(table['id'])), 3)
+        self.assertEqual(list_tables(STAGING_SCHEMA), [])
+
+
+class RepairFeaturesTestCase(DatagisTestCase):
+
+    def test_repair_and_quarantine(self):
+        bowtie = {'type': 'MultiPolygon', 'coordinates': [[[
+            [5.80, 45.15], [5.85, 45.20], [5.85, 45.15], [5.80, 45.20], [5.80, 45.15]]]]}
+        features = [
+            COMMUNES[0],
+            feature(bowtie, nom='Noeud papillon', population=1),
+            feature(None, nom='Sans géométrie', population=2)]
+        table, = self.load(features, repair=True)
+
+        self.assertEqual(table['geometry'], 'MultiPolygon')
+        self.assertEqual(table['summary']['count'], 2)
+        self.assertEqual(table['summary']['repaired'], 1)
+        self.assertEqual(table['summary']['quarantined'], 1)
+        self.assertEqual(
+            self.select(table['id'], 'nom, ST_IsValid(the_geom), ST_NumGeometries(the_geom)'),
+            [("Saint-Martin-d'Hères", True, 1), ('Noeud papillon', True, 2)])
+        self.assertEqual(
+            self.select(table['id'], 'nom, _error', schema=QUARANTINE_SCHEMA),
+            [('Sans géométrie', 'Géométrie absente ou illisible')])
+
+    def test_quarantine_is_published_with_the_table(self):
+        features = [COMMUNES[0], feature(None, nom='Sans géométrie', population=2)]
+        table, = self.load(features, repair=True)
+
+        # La publication échoue : la quarantaine précédente est conservée
+        features = [COMMUNES[1], feature(None, nom='Autre', population=3)]
+        with mock.patch('idgo_admin.datagis.publish_tables',
+                        side_effect=DatabaseError('publication impossible')):
+            with self.assertRaises(SQLError):
+                self.load(features, repair=True, update={'communes': table['id']})
+        self.assertEqual(list_tables(STAGING_SCHEMA), [])
+        self.assertEqual(
+            self.select(table['id'], schema=QUARANTINE_SCHEMA), [('Sans géométrie',)])
+
+        # Un chargement sans objet écarté supprime la quarantaine
+        self.load(COMMUNES, repair=True, update={'communes': table['id']})
+        self.assertNotIn(table['id'], list_tables(QUARANTINE_SCHEMA))
+
+    def test_invalid_geometries_are_rejected_without_repair(self):
+        features = [feature(None, nom='Sans géométrie', population=2)]
+        with self.assertRaises(WrongDataError):
+            self.load(features, repair=False)
+        self.assertEqual(list_tables(STAGING_SCHEMA), [])
+
+
+class CleanUpStagingTablesTestCase(DatagisTestCase):
+
+    def create_staging_table(self, table, comment=None):
+        prepare_staging_tables([table])
+        with connections[DATABASE].cursor() as cursor:
+            cursor.execute('CREATE TABLE {}."{}" (fid serial);'.format(STAGING_SCHEMA, table))
+            if comment:
+                cursor.execute('COMMENT ON TABLE {}."{}" IS %s;'.format(
+                    STAGING_SCHEMA, table), [json.dumps(comment)])
+
+    def test_table_without_comment_expires(self):
+        self.create_staging_table('sans_commentaire')
+
+        # La table est d'abord datée..
+        clean_up_staging_tables()
+        self.assertIn('sans_commentaire', list_tables(STAGING_SCHEMA))
+        comment, = fetch_all(
+            "SELECT obj_description('{}.sans_commentaire'::regclass, 'pg_class');".format(STAGING_SCHEMA))[0]
+        self.assertIsNone(json.loads(comment)['import'])
+
+        # ..puis supprimée passé le délai d'expiration
+        later = timezone.now() + datetime.timedelta(seconds=7200)
+        with mock.patch('idgo_admin.datagis.timezone.now', return_value=later):
+            clean_up_staging_tables(expiration=3600)
+        self.assertNotIn('sans_commentaire', list_tables(STAGING_SCHEMA))
+
+    def test_table_of_a_terminated_import(self):
+        import_lock = acquire_import_lock()
+        release_import_lock(import_lock)
+        self.create_staging_table('abandonnee', comment={
+            'created': timezone.now().isoformat(), 'import': import_lock})
+        self.create_staging_table('recente', comment={
+            'created': timezone.now().isoformat(), 'import': None})
+
+        clean_up_staging_tables()
+        self.assertEqual(list_tables(STAGING_SCHEMA), ['recente'])
+
+    def test_quarantine_table_without_layer(self):
+        with connections[DATABASE].cursor() as cursor:
+            cursor.execute('CREATE SCHEMA IF NOT EXISTS {};'.format(QUARANTINE_SCHEMA))
+            cursor.execute('CREATE TABLE {}."orpheline" (fid serial);'.format(QUARANTINE_SCHEMA))
+
+        clean_up_staging_tables()
+        self.assertNotIn('orpheline', list_tables(QUARANTINE_SCHEMA))
+
+
+class DetectEncodingTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def datasource(self, content):
+        filename = os.path.join(self.directory, 'communes.csv')
+        with open(filename, 'wb') as f:
+            f.write(content)
+        return DataSource(filename)
+
+    def test_detect_encoding(self):
+        for encoding, expected in (('utf-8', 'utf-8'), ('cp1252', 'cp1252')):
+            with self.subTest(encoding=encoding):
+                content = 'nom,code\nSaint-Martin-d\'Hères,38421\nŒuilly,02577\n'
+                ds = self.datasource(content.encode(encoding))
+                self.assertEqual(detect_encoding(ds), expected)
+
+    def test_ascii_data(self):
+        ds = self.datasource(b'nom,code\nGrenoble,38185\n')
+        self.assertEqual(detect_encoding(ds), 'utf-8')
+
+
+class Gdal2CogTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.coverage = mock.Mock(width=512, height=512)
+        self.coverage.name = os.path.join(self.directory, 'mnt.tif')
+        self.dst = os.path.join(self.directory, 'mnt.cog.tif')
+        self.write_source(b'raster')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_source(self, content):
+        with open(self.coverage.name, 'wb') as f:
+            f.write(content)
+
+    def gdal2cog(self, **kwargs):
+        def run(command, **kwargs):
+            # Chaque commande écrit son dernier argument
+            with open(command[-1], 'wb') as f:
+                f.write(b'cog')
+        with mock.patch('idgo_admin.datagis.subprocess.run', side_effect=run) as run:
+            gdal2cog(self.coverage, self.dst, **kwargs)
+        return run.called
+
+    def test_local_source(self):
+        self.assertTrue(self.gdal2cog())
+        self.assertFalse(self.gdal2cog())
+        self.assertTrue(self.gdal2cog(force=True))
+
+        # Fichier remplacé par un autre de même taille et de même date
+        st = os.stat(self.coverage.name)
+        other = os.path.join(self.directory, 'autre.tif')
+        with open(other, 'wb') as f:
+            f.write(b'RASTER')
+        os.utime(other, ns=(st.st_atime_ns, st.st_mtime_ns))
+        os.replace(other, self.coverage.name)
+        self.assertTrue(self.gdal2cog())
+        self.assertFalse(self.gdal2cog())
+
+        # Fichier modifié sur place, plus long
+        with open(self.coverage.name, 'ab') as f:
+            f.write(b'+')
+        os.utime(self.coverage.name, ns=(st.st_atime_ns, st.st_mtime_ns))
+        self.assertTrue(self.gdal2cog())
+
+    def test_remote_source(self):
+        self.coverage.name = '/vsicurl/http://example.com/mnt.tif'
+        self.assertTrue(self.gdal2cog())
+        # Sans empreinte, la conversion est toujours refaite
+        self.assertTrue(self.gdal2cog())
+
+        self.assertTrue(self.gdal2cog(fingerprint={'sha256': 'a'}))
+        self.assertFalse(self.gdal2cog(fingerprint={'sha256': 'a'}))
+        self.assertTrue(self.gdal2cog(fingerprint={'sha256': 'b'}))
+        self.assertTrue(is_up_to_date(self.dst, {'sha256': 'b'}))
+
+
+class TransformTestCase(TestCase):
+
+    multi_db = True
+
+    def st_transform(self, wkt, epsg_in, epsg_out):
+        return fetch_all(
+            'SELECT ST_AsText(ST_Transform(ST_GeomFromText(%s, %s), %s));',
+            [wkt, epsg_in, epsg_out])[0][0]
+
+    def assertSameAsPostGIS(self, wkt, epsg_in, epsg_out, tolerance):
+        result = GEOSGeometry(transform(wkt, epsg_in, epsg_out))
+        expected = GEOSGeometry(self.st_transform(wkt, epsg_in, epsg_out))
+        self.assertTrue(
+            result.equals_exact(expected, tolerance),
+            '{} != {}'.format(result.wkt, expected.wkt))
+        return result
+
+    def test_same_as_st_transform(self):
+        grenoble = 'POLYGON((913000 6457000,916000 6457000,916000 6460000,913000 6460000,913000 6457000))'
+        result = self.assertSameAsPostGIS(grenoble, 2154, 4171, 1e-9)
+        # Longitude puis latitude
+        self.assertAlmostEqual(result.centroid.x, 5.72, places=1)
+        self.assertAlmostEqual(result.centroid.y, 45.18, places=1)
+
+        self.assertSameAsPostGIS('POINT(5.72 45.18)', 4326, 4171, 1e-9)
+        self.assertSameAsPostGIS('POINT(5.72 45.18)', 4171, 2154, 1e-3)
+
+    def test_round_trip(self):
+        wkt = 'LINESTRING(913000 6457000,916000 6460000)'
+        result = GEOSGeometry(transform(transform(wkt, 2154, 4171), 4171, 2154))
+        self.assertTrue(result.equals_exact(GEOSGeometry(wkt), 1e-3))
+
+    def test_errors(self):
+        self.assertIsNone(transform('POINT(5.72 45.18', 4326))
+        self.assertIsNone(transform('POINT(5.72 45.18)', 999999))
@@ -0,0 +1,92 @@
+# Copyright (c) 2017-2019 Datasud.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from django.test import SimpleTestCase
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+from idgo_admin.http_client import DeadlineExceeded
+from idgo_admin.http_client import Session
+import requests
+from socketserver import ThreadingMixIn
+import threading
+import time
+
+
+class SlowHandler(BaseHTTPRequestHandler):
+    """Serveur dont les en-têtes (`/headers`) ou le corps (`/body`) de la
+    réponse sont envoyés lentement."""
+
+    def do_GET(self):
+        if self.path == '/headers':
+            time.sleep(1.5)
+        body = b'0123456789'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        for byte in body:
+            if self.path == '/body':
+                time.sleep(0.2)
+            try:
+                self.wfile.write(bytes([byte]))
+                self.wfile.flush()
+            except OSError:
+                return
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class SessionTestCase(SimpleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = Server(('127.0.0.1', 0), SlowHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def get(self, path, **kwargs):
+        url = 'http://127.0.0.1:{}{}'.format(self.server.server_port, path)
+        t0 = time.monotonic()
+        try:
+            return Session(**kwargs).get(url)
+        finally:
+            self.elapsed = time.monotonic() - t0
+
+    def test_response_within_deadline(self):
+        r = self.get('/', deadline=1)
+        self.assertEqual(r.content, b'0123456789')
+
+    def test_slow_body(self):
+        # Chaque octet arrive avant l'expiration du délai de lecture..
+        with self.assertRaises(DeadlineExceeded):
+            self.get('/body', deadline=1)
+        # ..mais la durée totale est respectée
+        self.assertLess(self.elapsed, 1.5)
+
+    def test_slow_headers(self):
+        with self.assertRaises(requests.exceptions.Timeout):
+            self.get('/headers', deadline=1)
+        self.assertLess(self.elapsed, 1.4)
@@ -0,0 +1,57 @@
+# Copyright (c) 2017-2019 Datasud.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from idgo_admin.models import Layer
+from idgo_admin.mra_client import MRANotFoundError
+from idgo_admin.tests.test_resource import mra_layer
+from idgo_admin.tests.test_resource import ResourceTestCase
+
+
+class MraInfoTestCase(ResourceTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.layer, = self.create_resource().get_layers()
+        self.mra.get_layer.reset_mock()
+
+    def test_cache_hit(self):
+        self.assertEqual(self.layer.mra_info['name'], self.layer.name)
+
+        # Les informations sont partagées par les instances de la couche
+        layer = Layer.objects.get(pk=self.layer.pk)
+        self.assertTrue(layer.is_enabled)
+        self.assertEqual(self.mra.get_layer.call_count, 1)
+
+    def test_failure(self):
+        self.mra.get_layer.side_effect = MRANotFoundError()
+        self.assertIsNone(getattr(self.layer, 'mra_info', None))
+
+        # L'échec est conservé aussi
+        layer = Layer.objects.get(pk=self.layer.pk)
+        with self.assertRaises(AttributeError):
+            layer.mra_info
+        self.assertEqual(self.mra.get_layer.call_count, 1)
+
+    def test_invalidation_after_save(self):
+        self.mra.get_layer.side_effect = MRANotFoundError()
+        self.assertIsNone(getattr(self.layer, 'mra_info', None))
+
+        self.mra.get_layer.side_effect = lambda name: mra_layer(name, enabled=False)[0]
+        self.layer.save()
+
+        layer = Layer.objects.get(pk=self.layer.pk)
+        self.assertFalse(layer.is_enabled)
+        self.assertFalse(self.layer.is_enabled)
@@ -0,0 +1,63 @@
+# Copyright (c) 2017-2019 Datasud.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from django.test import TestCase
+from idgo_admin.models import MraObject
+from idgo_admin.mra_client import MRAHandler
+from idgo_admin.mra_client import MRASyncingError
+import requests
+from unittest import mock
+
+
+def http_error(status_code):
+    response = requests.Response()
+    response.status_code = status_code
+    return requests.exceptions.HTTPError(response=response)
+
+
+class MirrorTestCase(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch('idgo_admin.mra_client.MRA_MIRROR', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        MRAHandler.mirror('featuretype', {}, 'workspaces', 'organisation',
+                          'datastores', 'public', 'featuretypes', 'communes_abcdef1')
+        MRAHandler.mirror('layer', {}, 'layers', 'communes_abcdef1')
+
+    def delete(self, error=None):
+        with mock.patch.object(MRAHandler, 'remote') as remote:
+            remote.delete.side_effect = error
+            MRAHandler.del_layer('communes_abcdef1')
+        remote.delete.assert_called_once_with('layers', 'communes_abcdef1')
+
+    def assertForgotten(self):
+        self.assertEqual(
+            list(MraObject.objects.values_list('kind', flat=True)), ['featuretype'])
+
+    def test_delete(self):
+        self.delete()
+        self.assertForgotten()
+
+    def test_delete_missing_object(self):
+        # L'objet est déjà absent de MRA : il est supprimé
+        self.delete(http_error(404))
+        self.assertForgotten()
+
+    def test_failed_delete(self):
+        with self.assertRaises(MRASyncingError):
+            self.delete(http_error(500))
+        self.assertForgotten()
@@ -0,0 +1,237 @@
+# Copyright (c) 2017-2019 Datasud.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.http import Http404
+from django.test import RequestFactory
+from django.test import TransactionTestCase
+from idgo_admin.ckan_module import CkanHandler
+from idgo_admin.datagis import drop_table
+from idgo_admin.datagis import QUARANTINE_SCHEMA
+from idgo_admin.models import Dataset
+from idgo_admin.models import Layer
+from idgo_admin.models import Organisation
+from idgo_admin.models import Resource
+from idgo_admin.models import ResourceFormats
+from idgo_admin.models import SupportedCrs
+from idgo_admin.tests.fixtures import COMMUNES
+from idgo_admin.tests.fixtures import feature
+from idgo_admin.tests.fixtures import fetch_all
+from idgo_admin.tests.fixtures import polygon
+from idgo_admin.tests.fixtures import write_geojson
+from idgo_admin.views.layer import vector_tile
+import hashlib
+import shutil
+import tempfile
+from unittest import mock
+import uuid
+
+
+User = get_user_model()
+
+
+# Les ressources sont enregistrées par `Resource.save` et leurs données
+# chargées dans la base SIG (PostGIS). Seuls les services externes sont
+# simulés : le téléchargement (qui fournit un fichier GeoJSON local),
+# MRA et CKAN.
+
+
+def mra_layer(name, enabled=True):
+    """Retourner les réponses de MRA pour la couche `name`."""
+    style = {'name': name, 'href': 'http://mra/styles/{}.json'.format(name)}
+    layer = {
+        'name': name, 'title': name, 'type': 'POLYGON', 'enabled': enabled,
+        'abstract': '', 'defaultStyle': style}
+    featuretype = {'featureType': {
+        'latLonBoundingBox': {'minx': 5.70, 'miny': 45.15, 'maxx': 5.85, 'maxy': 45.20},
+        'attributes': [{'name': 'nom'}, {'name': 'population'}]}}
+    return layer, featuretype
+
+
+class ResourceTestCase(TransactionTestCase):
+
+    multi_db = True
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.tiles = tempfile.mkdtemp()
+        cache.clear()
+
+        self.patch(mock.patch.object(CkanHandler, 'is_user_exists', return_value=False))
+        self.patch(mock.patch.object(CkanHandler, 'is_organisation_exists', return_value=False))
+        self.patch(mock.patch.object(CkanHandler, 'deactivate_ckan_organisation_if_empty'))
+        self.patch(mock.patch.object(
+            Dataset, 'synchronize', return_value={'id': str(uuid.uuid4())}))
+        self.patch(mock.patch('idgo_admin.datagis.TILES_CACHE_PATH', self.tiles))
+        self.mra = self.patch(mock.patch('idgo_admin.models.layer.MRAHandler'))
+        self.mra.get_layer.side_effect = lambda name: mra_layer(name)[0]
+        self.mra.get_featuretype.side_effect = lambda ws, ds, name: mra_layer(name)[1]
+        self.mra.get_style.return_value = '<sld/>'
+        self.mra.get_layer_workspace.return_value = 'organisation'
+
+        organisation = Organisation.objects.create(legal_name='Organisation')
+        editor = User.objects.create(username='editor')
+        self.dataset = Dataset.default.create(
+            save_opts={'current_user': None, 'synchronize': False},
+            editor=editor, organisation=organisation, title='Jeu de données')
+        self.format_type = ResourceFormats.objects.create(
+            slug='geojson', description='GeoJSON', extension='geojson',
+            ckan_format='GeoJSON', is_gis_format=True)
+        SupportedCrs.objects.create(auth_name='EPSG', auth_code='4326')
+
+    def tearDown(self):
+        for name in Layer.objects.values_list('name', flat=True):
+            drop_table(name)
+            drop_table(name, schema=QUARANTINE_SCHEMA)
+        shutil.rmtree(self.directory)
+        shutil.rmtree(self.tiles)
+
+    def patch(self, patcher):
+        mocked = patcher.start()
+        self.addCleanup(patcher.stop)
+        return mocked
+
+    def download(self, features):
+        """Simuler le téléchargement des objets `features` au format GeoJSON."""
+        def download(url, media_root, **kwargs):
+            directory = tempfile.mkdtemp(dir=self.directory)
+            filename = write_geojson(directory, 'communes', features)
+            with open(filename, 'rb') as f:
+                sha256 = hashlib.sha256(f.read()).hexdigest()
+            validators = {'etag': None, 'last_modified': None, 'sha256': sha256}
+            return directory, filename, 'application/geo+json', validators
+        return mock.patch('idgo_admin.models.resource.download', side_effect=download)
+
+    def create_resource(self, features=COMMUNES, **kwargs):
+        with self.download(features):
+            return Resource.default.create(
+                save_opts={'current_user': None, 'synchronize': False},
+                dataset=self.dataset, format_type=self.format_type,
+                title='Communes', dl_url='http://example.com/communes.geojson',
+                **kwargs)
+
+    def reimport(self, resource, features):
+        with self.download(features):
+            resource = Resource.objects.get(pk=resource.pk)
+            resource.save()
+        return resource
+
+
+class ResourceReimportTestCase(ResourceTestCase):
+
+    def test_create_vector_resource(self):
+        resource = self.create_resource()
+
+        layer, = resource.get_layers()
+        self.assertEqual(layer.type, 'vector')
+        self.assertEqual(layer.summary['count'], 3)
+        self.assertEqual(resource.crs.auth_code, '4326')
+        self.assertTrue(resource.ogc_services)
+        self.assertEqual(len(fetch_all('SELECT fid FROM public."{}";'.format(layer.name))), 3)
+        self.assertEqual(
+            self.mra.get_or_create_featuretype.call_args[0],
+            ('organisation', 'public', layer.name))
+
+    def test_reimport_existing_vector_resource(self):
+        resource = self.create_resource()
+        layer, = resource.get_layers()
+
+        features = COMMUNES + [
+            feature(polygon(5.85, 45.15, 5.90, 45.20), nom='Meylan', population=17000)]
+        resource = self.reimport(resource, features)
+
+        # La table existante est rechargée sous le même nom et la couche
+        # est conservée avec sa nouvelle synthèse
+        self.assertEqual(list(resource.get_layers()), [layer])
+        self.assertEqual(Layer.objects.get(pk=layer.pk).summary['count'], 4)
+        self.assertEqual(
+            fetch_all('SELECT nom FROM public."{}" ORDER BY fid;'.format(layer.name))[-1],
+            ('Meylan',))
+        self.mra.del_layer.assert_not_called()
+
+    def test_reimport_synchronised_resource(self):
+        resource = self.create_resource(synchronisation=True)
+        layer, = resource.get_layers()
+
+        # Seules les différences sont appliquées ; l'objet sans géométrie
+        # est mis en quarantaine
+        features = [COMMUNES[0], feature(None, nom='Sans géométrie', population=1)]
+        with mock.patch('idgo_admin.datagis.REPAIR_GEOMETRIES', True):
+            resource = self.reimport(resource, features)
+
+        self.assertEqual(resource.sync_diff['tables'][layer.name], {
+            'inserted': 0, 'deleted': 2, 'unchanged': 1,
+            'repaired': 0, 'quarantined': 1})
+        self.assertEqual(resource.quarantine_report, [
+            {'table': layer.name, 'repaired': 0, 'quarantined': 1}])
+
+
+class VectorTileTestCase(ResourceTestCase):
+
+    def get_tile(self, layer, z=0, x=0, y=0, **headers):
+        request = RequestFactory().get(
+            '/tiles/{}/{}/{}/{}.pbf'.format(layer.name, z, x, y), **headers)
+        request.user = AnonymousUser()
+        try:
+            return vector_tile(request, layer_id=layer.name, z=str(z), x=str(x), y=str(y))
+        except Http404:
+            return None
+
+    def test_public_resource(self):
+        layer, = self.create_resource().get_layers()
+        response = self.get_tile(layer)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/vnd.mapbox-vector-tile')
+        self.assertIn(b'nom', response.content)
+
+        # La tuile n'a pas changé
+        response = self.get_tile(layer, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_reloaded_layer(self):
+        resource = self.create_resource()
+        layer, = resource.get_layers()
+        etag = self.get_tile(layer)['ETag']
+
+        # Les données changent, pas leur synthèse
+        features = [COMMUNES[0], COMMUNES[2], feature(
+            COMMUNES[1]['geometry'], nom='Gieres', population=6700)]
+        self.reimport(resource, features)
+        layer = Layer.objects.get(pk=layer.pk)
+
+        response = self.get_tile(layer, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertIn(b'Gieres', response.content)
+
+    def test_geo_restricted_resource(self):
+        resource = self.create_resource()
+        layer, = resource.get_layers()
+        # La restriction au territoire de compétence désactive les services OGC
+        Resource.objects.filter(pk=resource.pk).update(
+            geo_restriction=True, ogc_services=False)
+
+        self.assertIsNone(self.get_tile(layer))
+
+    def test_disabled_layer(self):
+        layer, = self.create_resource().get_layers()
+        self.mra.get_layer.side_effect = lambda name: mra_layer(name, enabled=False)[0]
+        layer.reset_mra_info()
+
+        self.assertIsNone(self.get_tile(layer))
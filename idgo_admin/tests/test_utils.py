@@ -0,0 +1,292 @@
+# Copyright (c) 2017-2019 Datasud.
+# All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+
+from django.test import SimpleTestCase
+from functools import partial
+import hashlib
+from idgo_admin.exceptions import NotModifiedError
+from idgo_admin.utils import download
+from idgo_admin.utils import place_file
+from idgo_admin.utils import probe
+from idgo_admin.utils import RetryBudget
+import io
+import os
+import re
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+import shutil
+import tempfile
+import threading
+import time
+from unittest import mock
+
+
+class PlaceFileTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.src = os.path.join(self.directory, 'source.tif')
+        self.dst = os.path.join(self.directory, 'copie.tif')
+        with open(self.src, 'wb') as f:
+            f.write(b'0123456789' * 1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_place_file(self):
+        with open(self.dst, 'wb') as f:
+            f.write(b'ancienne version')
+        placed = place_file(self.src, self.dst)
+
+        self.assertIn(placed['method'], ('reflink', 'copy_file_range', 'copy'))
+        self.assertEqual(placed['size'], 10000)
+        self.assertEqual(placed['bytes'], placed['method'] != 'reflink' and 10000 or 0)
+        with open(self.dst, 'rb') as f:
+            self.assertEqual(f.read(), b'0123456789' * 1000)
+        # Aucun fichier temporaire ne subsiste
+        self.assertEqual(sorted(os.listdir(self.directory)), ['copie.tif', 'source.tif'])
+
+    def test_source_modified_in_place(self):
+        place_file(self.src, self.dst)
+        self.assertNotEqual(os.stat(self.src).st_ino, os.stat(self.dst).st_ino)
+
+        with open(self.src, 'r+b') as f:
+            f.write(b'modifie')
+        with open(self.dst, 'rb') as f:
+            self.assertEqual(f.read(10), b'0123456789')
+
+
+# Téléchargement des ressources distantes
+# =======================================
+
+class Stream(io.BytesIO):
+    """Corps de réponse (à partir de l'octet `start` du contenu servi),
+    interrompu à la position éventuellement prévue par le serveur ou lu
+    octet par octet avec un délai (`delay`)."""
+
+    def __init__(self, server, body, start=0, delay=None):
+        super().__init__(body)
+        self.server = server
+        self.start = start
+        self.delay = delay
+        self.cut = None
+
+    def read(self, size=-1):
+        if self.cut is None:
+            # L'interruption n'est décidée qu'à la première lecture
+            self.cut = self.server.take_cut(
+                self.start, self.start + len(self.getvalue()))
+        position = self.tell()
+        if self.cut and position >= self.cut:
+            raise requests.exceptions.ConnectionError('Connexion interrompue')
+        if self.delay:
+            time.sleep(self.delay)
+            size = 1
+        elif self.cut:
+            size = self.cut - position
+        chunk = super().read(size)
+        self.server.sent(len(chunk))
+        return chunk
+
+
+class FakeServer(BaseAdapter):
+    """Serveur HTTP simulé (Cf. `requests.Session.get_adapter`).
+
+    Les requêtes par plages d'octets sont honorées (si `ranges`) tant
+    que l'entête `If-Range` correspond à l'`etag` courant. La lecture
+    des réponses est interrompue aux positions `cuts` (une seule fois
+    chacune) ; `errors` associe un code d'erreur à une plage demandée.
+    """
+
+    def __init__(self, content, etag='"v1"', ranges=True, cuts=None,
+                 errors=None, delay=None, unavailable=False):
+        super().__init__()
+        self.content = content
+        self.etag = etag
+        self.ranges = ranges
+        self.cuts = list(cuts or [])
+        self.errors = errors or {}
+        self.delay = delay
+        self.unavailable = unavailable
+        self.requests = []
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+
+    def sent(self, n):
+        with self._lock:
+            self.bytes_sent += n
+
+    def take_cut(self, start, stop):
+        with self._lock:
+            for position in self.cuts:
+                if start < position < stop:
+                    self.cuts.remove(position)
+                    return position - start
+        return 0
+
+    def response(self, request, status, body=b'', headers=None, start=0, delay=None):
+        r = requests.Response()
+        r.request = request
+        r.url = request.url
+        r.status_code = status
+        r.headers = CaseInsensitiveDict(headers or {})
+        r.headers['Content-Length'] = str(len(body))
+        r.raw = Stream(self, body, start=start, delay=delay)
+        return r
+
+    def send(self, request, **kwargs):
+        with self._lock:
+            self.requests.append(dict(request.headers))
+        if self.unavailable:
+            raise requests.exceptions.ConnectionError('Serveur indisponible')
+
+        range = request.headers.get('Range')
+        if range in self.errors:
+            return self.response(request, self.errors[range])
+        if request.headers.get('If-None-Match') == self.etag:
+            return self.response(request, 304)
+
+        headers = {'Accept-Ranges': 'bytes', 'ETag': self.etag}
+        start, end, status = 0, len(self.content) - 1, 200
+        if range and self.ranges \
+                and request.headers.get('If-Range', self.etag) == self.etag:
+            first, last = re.match(r'bytes=(\d+)-(\d*)', range).groups()
+            start, end, status = int(first), int(last or end), 206
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(
+                start, end, len(self.content))
+
+        # Seules les requêtes par plages sont ralenties
+        delay = range and self.delay or None
+        return self.response(
+            request, status, self.content[start:end + 1], headers=headers,
+            start=start, delay=delay)
+
+    def close(self):
+        pass
+
+
+class DownloadTestCase(SimpleTestCase):
+
+    content = os.urandom(1000)
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def download(self, server, attempts=3, **kwargs):
+        with mock.patch.object(requests.Session, 'get_adapter', return_value=server), \
+                mock.patch('idgo_admin.utils.DOWNLOAD_RANGE_MIN_SIZE', 100), \
+                mock.patch('idgo_admin.utils.RetryBudget',
+                           partial(RetryBudget, attempts=attempts, maximum=0)):
+            return download('http://example.com/data.tif', self.directory, **kwargs)
+
+    def assertDownloaded(self, result, content=None):
+        content = content or self.content
+        _, filename, _, validators = result
+        with open(filename, 'rb') as f:
+            self.assertEqual(f.read(), content)
+        self.assertEqual(validators['sha256'], hashlib.sha256(content).hexdigest())
+
+    def ranges(self, server):
+        return [headers['Range'] for headers in server.requests if 'Range' in headers]
+
+    def test_range_splitting(self):
+        server = FakeServer(self.content)
+        result = self.download(server, workers=4)
+
+        self.assertDownloaded(result)
+        self.assertEqual(sorted(self.ranges(server)), [
+            'bytes=0-249', 'bytes=250-499', 'bytes=500-749', 'bytes=750-999'])
+        self.assertTrue(all(
+            headers.get('If-Range') == '"v1"' for headers in server.requests[1:]))
+
+    def test_small_file_is_not_split(self):
+        server = FakeServer(self.content[:50])
+        self.assertDownloaded(self.download(server, workers=4), self.content[:50])
+        self.assertEqual(self.ranges(server), [])
+
+    def test_interrupted_range_resumes(self):
+        server = FakeServer(self.content, cuts=[600])
+        self.assertDownloaded(self.download(server, workers=4))
+        self.assertIn('bytes=600-749', self.ranges(server))
+
+    def test_interrupted_stream_resumes_with_if_range(self):
+        server = FakeServer(self.content, cuts=[300])
+        self.assertDownloaded(self.download(server, workers=1))
+
+        resume = server.requests[-1]
+        self.assertEqual(resume['Range'], 'bytes=300-')
+        self.assertEqual(resume['If-Range'], '"v1"')
+
+    def test_resource_changed_before_resume(self):
+        server = FakeServer(self.content, cuts=[300])
+        original = server.send
+
+        def send(request, **kwargs):
+            if 'Range' in request.headers:
+                # La ressource a changé entre-temps : réponse complète
+                server.etag, server.content = '"v2"', self.content[::-1]
+            return original(request, **kwargs)
+
+        with mock.patch.object(server, 'send', side_effect=send):
+            result = self.download(server, workers=1)
+        self.assertDownloaded(result, self.content[::-1])
+
+    def test_server_ignoring_ranges(self):
+        server = FakeServer(self.content, ranges=False)
+        self.assertDownloaded(self.download(server, workers=4))
+        # Repli sur un téléchargement d'un seul tenant
+        self.assertNotIn('Range', server.requests[-1])
+
+    def test_retry_budget_is_exhausted(self):
+        server = FakeServer(self.content, unavailable=True)
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            self.download(server, attempts=2)
+        self.assertEqual(len(server.requests), 3)
+
+    def test_retry_budget_is_shared(self):
+        # Deux interruptions pour une seule nouvelle tentative
+        server = FakeServer(self.content, cuts=[300, 600])
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            self.download(server, attempts=1, workers=1)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_not_modified(self):
+        server = FakeServer(self.content)
+        with self.assertRaises(NotModifiedError):
+            self.download(server, etag='"v1"')
+        self.assertEqual(server.requests[0]['If-None-Match'], '"v1"')
+        self.assertEqual(os.listdir(self.directory), [])
+
+        with mock.patch.object(requests.Session, 'get_adapter', return_value=server):
+            with self.assertRaises(NotModifiedError):
+                probe('http://example.com/data.tif', etag='"v1"')
+
+    def test_failed_range_cancels_siblings(self):
+        # Les autres plages sont servies lentement (octet par octet)
+        server = FakeServer(
+            self.content, errors={'bytes=0-249': 500}, delay=0.01)
+        with self.assertRaises(requests.exceptions.HTTPError):
+            self.download(server, workers=4)
+
+        # Les plages abandonnées n'ont été ni achevées, ni retentées
+        self.assertLess(server.bytes_sent, 750)
+        self.assertEqual(len(self.ranges(server)), 4)
+        self.assertEqual(os.listdir(self.directory), [])
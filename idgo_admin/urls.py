@@ -36,6 +36,7 @@ from idgo_admin.views.layer import layer_style
 from idgo_admin.views.layer import layer_styles
 from idgo_admin.views.layer import LayerStyleEditorView
 from idgo_admin.views.layer import LayerView
+from idgo_admin.views.layer import vector_tile
 from idgo_admin.views.mailer import confirm_contribution
 from idgo_admin.views.mailer import confirm_new_orga
 from idgo_admin.views.mailer import confirm_rattachement
@@ -60,6 +61,7 @@ from idgo_admin.views.organisation import UpdateOrganisation
 from idgo_admin.views.resource import resource
 from idgo_admin.views.resource import ResourceManager
 from idgo_admin.views.stuffs import DisplayLicenses
+from idgo_admin.views.stuffs import http_stats
 from idgo_admin.views.stuffs import ows_preview
 
 
@@ -121,6 +123,8 @@ urlpatterns = [
     url('^licences/?$', DisplayLicenses.as_view(), name='licences'),
 
     url('^owspreview/?$', ows_preview, name='ows_preview'),
+    url('^httpstats/?$', http_stats, name='http_stats'),
+    url('^tiles/(?P<layer_id>([a-z0-9_]*))/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.pbf$', vector_tile, name='vector_tile'),
     ]
 
 
@@ -14,19 +14,26 @@
 # under the License.
 
 
+from concurrent.futures import as_completed
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
 from django.conf import settings
 from django.utils.functional import keep_lazy
 from django.utils.safestring import mark_safe
 from django.utils.safestring import SafeText
+from idgo_admin.exceptions import NotModifiedError
 from idgo_admin.exceptions import SizeLimitExceededError
 from idgo_admin import logger
+import fcntl
+import hashlib
 import json
 import os
 import re
 import requests
 import shutil
 import string
+import threading
+import time
 import unicodedata
 from urllib.parse import urlparse
 from uuid import uuid4
@@ -81,6 +88,270 @@ def remove_file(filename):
     os.remove(filename)
 
 
+FICLONE = 0x40049409  # ioctl(2) : clonage d'un fichier (btrfs, xfs, ...)
+
+COPY_BUFFER_SIZE = 8 * 1024 * 1024
+
+
+def place_file(src, dst):
+    """Placer une copie du fichier `src` en `dst` en évitant de dupliquer les données.
+
+    Sur un même système de fichiers, on tente un clonage (« reflink »)
+    puis `copy_file_range` ; sinon, la copie est effectuée par blocs.
+    Dans tous les cas, `dst` est un fichier distinct de `src` (qui peut
+    ensuite être modifié sans conséquence). Le fichier `dst` n'est
+    remplacé qu'une fois entièrement écrit.
+
+    Retourne la méthode employée, la taille du fichier, le nombre
+    d'octets effectivement copiés (aucun en cas de clonage) et la durée.
+    """
+    t0 = time.monotonic()
+    size = os.stat(src).st_size
+    tmp = '{}.{}'.format(dst, str(uuid4())[:7])
+    same_device = os.stat(src).st_dev == os.stat(os.path.dirname(dst)).st_dev
+
+    def copy(fsrc, fdst):
+        if same_device:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            except OSError:
+                pass
+            else:
+                return 'reflink'
+            if hasattr(os, 'copy_file_range'):
+                try:
+                    offset = 0
+                    while offset < size:
+                        n = os.copy_file_range(
+                            fsrc.fileno(), fdst.fileno(), size - offset)
+                        if not n:
+                            break
+                        offset += n
+                except OSError:
+                    fsrc.seek(0)
+                    fdst.seek(0)
+                    fdst.truncate()
+                else:
+                    if offset == size:
+                        return 'copy_file_range'
+                    fsrc.seek(0)
+                    fdst.seek(0)
+                    fdst.truncate()
+        shutil.copyfileobj(fsrc, fdst, COPY_BUFFER_SIZE)
+        return 'copy'
+
+    try:
+        with open(src, 'rb') as fsrc, open(tmp, 'wb') as fdst:
+            method = copy(fsrc, fdst)
+        os.replace(tmp, dst)
+    except Exception:
+        remove_file(tmp)
+        raise
+
+    # Le clonage partage les blocs de données (copie à l'écriture)
+    copied = method != 'reflink' and size or 0
+    seconds = round(time.monotonic() - t0, 3)
+    logger.debug('File "{src}" placed to "{dst}" ({method}): {copied}/{size} bytes copied in {seconds}s'.format(
+        src=src, dst=dst, method=method, copied=copied, size=size, seconds=seconds))
+
+    return {'method': method, 'size': size, 'bytes': copied, 'seconds': seconds}
+
+
+# Téléchargement des ressources distantes
+# =======================================
+
+try:
+    DOWNLOAD_WORKERS = settings.DOWNLOAD_WORKERS
+except AttributeError:
+    DOWNLOAD_WORKERS = 4
+
+# En deçà de cette taille (en octets), le fichier est téléchargé d'un seul tenant
+try:
+    DOWNLOAD_RANGE_MIN_SIZE = settings.DOWNLOAD_RANGE_MIN_SIZE
+except AttributeError:
+    DOWNLOAD_RANGE_MIN_SIZE = 32 * 1024 * 1024
+
+# Délais de connexion et de lecture (en secondes)
+try:
+    DOWNLOAD_TIMEOUT = settings.DOWNLOAD_TIMEOUT
+except AttributeError:
+    DOWNLOAD_TIMEOUT = (10, 60)
+
+# Nombre de nouvelles tentatives pour l'ensemble d'un téléchargement
+DOWNLOAD_ATTEMPTS = 10
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+RETRYABLE_ERRORS = (
+    requests.exceptions.ChunkedEncodingError,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout)
+
+
+class RangeNotHonoredError(Exception):
+    pass
+
+
+class RetryBudget(object):
+    """Nouvelles tentatives partagées par l'ensemble d'un téléchargement.
+
+    Les requêtes (initiale, par plages ou de reprise) puisent dans le même
+    nombre de tentatives, dont l'attente croît de manière exponentielle :
+    la durée totale des attentes est donc bornée.
+    """
+
+    def __init__(self, attempts=None, maximum=60):
+        self.remaining = attempts or DOWNLOAD_ATTEMPTS
+        self.maximum = maximum
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def retry(self, error, message, cancelled=None):
+        """Attendre avant une nouvelle tentative, ou lever `error` si
+        le budget est épuisé ou si le téléchargement est abandonné."""
+        with self._lock:
+            if self.remaining < 1 or (cancelled and cancelled.is_set()):
+                raise error
+            self.remaining -= 1
+            self.used += 1
+            attempt = self.used
+        logger.warning('{} (retry {}, {} left): {}'.format(
+            message, attempt, self.remaining, error))
+        delay = min(2 ** attempt, self.maximum)
+        if cancelled:
+            if cancelled.wait(delay):
+                raise error
+        else:
+            time.sleep(delay)
+
+
+def get_with_retry(url, headers=None, budget=None, cancelled=None):
+    budget = budget or RetryBudget()
+    while True:
+        try:
+            return requests.get(
+                url, stream=True, headers=headers, timeout=DOWNLOAD_TIMEOUT)
+        except RETRYABLE_ERRORS as e:
+            budget.retry(e, 'GET {} failed'.format(url), cancelled=cancelled)
+
+
+def fetch_range(url, filename, start, end, if_range, budget, cancelled):
+    """Télécharger les octets `start` à `end` (inclus) à leur place dans `filename`.
+
+    Après une interruption, la requête reprend là où elle s'était arrêtée.
+    La fonction s'interrompt dès que `cancelled` est positionné.
+    """
+    offset = start
+    while not cancelled.is_set():
+        headers = {
+            'Accept-Encoding': 'identity',
+            'If-Range': if_range,
+            'Range': 'bytes={}-{}'.format(offset, end)}
+        try:
+            r = get_with_retry(
+                url, headers=headers, budget=budget, cancelled=cancelled)
+            try:
+                r.raise_for_status()
+                if r.status_code != 206:
+                    # La ressource a changé ou le serveur ignore la plage
+                    raise RangeNotHonoredError()
+                with open(filename, 'r+b') as f:
+                    f.seek(offset)
+                    for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        if cancelled.is_set():
+                            return
+                        chunk = chunk[:end + 1 - offset]
+                        f.write(chunk)
+                        offset += len(chunk)
+                        if offset > end:
+                            break
+            finally:
+                r.close()
+        except RETRYABLE_ERRORS as e:
+            budget.retry(e, 'Range {}-{} of {} interrupted'.format(
+                offset, end, url), cancelled=cancelled)
+        else:
+            if offset > end:
+                return
+            budget.retry(requests.exceptions.ConnectionError(
+                'Range {}-{} of {} is incomplete'.format(start, end, url)),
+                'Range {}-{} of {} truncated'.format(offset, end, url),
+                cancelled=cancelled)
+
+
+def fetch_ranges(url, filename, length, if_range, workers, budget=None):
+    """Télécharger le fichier par plages d'octets en parallèle.
+
+    Dès qu'une plage échoue (p. ex. si le serveur ne les honore pas),
+    les autres sont abandonnées et l'erreur est levée.
+    """
+    budget = budget or RetryBudget()
+    cancelled = threading.Event()
+
+    with open(filename, 'wb') as f:
+        f.truncate(length)
+
+    part = -(-length // workers)
+    ranges = [
+        (start, min(start + part, length) - 1)
+        for start in range(0, length, part)]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(
+                fetch_range, url, filename, start, end, if_range, budget, cancelled)
+            for start, end in ranges]
+        try:
+            for future in as_completed(futures):
+                future.result()
+        except Exception:
+            cancelled.set()
+            for future in futures:
+                future.cancel()
+            raise
+
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(COPY_BUFFER_SIZE), b''):
+            sha256.update(chunk)
+    return sha256
+
+
+def fetch_stream(url, r, filename, max_size=None, if_range=None, budget=None):
+    """Télécharger le fichier d'un seul tenant à partir de la réponse `r`.
+
+    Si le serveur le permet (`if_range`), une interruption est suivie d'une
+    reprise à partir du dernier octet reçu ; sinon, de l'échec.
+    """
+    budget = budget or RetryBudget()
+    sha256 = hashlib.sha256()
+    size = 0
+    with open(filename, 'wb') as f:
+        while True:
+            try:
+                for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    size += len(chunk)
+                    if max_size and size > max_size:
+                        raise SizeLimitExceededError(max_size=max_size)
+                    f.write(chunk)
+                    sha256.update(chunk)
+                r.close()
+                return sha256
+            except RETRYABLE_ERRORS as e:
+                r.close()
+                if not if_range:
+                    raise e
+                budget.retry(e, 'Download of {} interrupted at {} bytes'.format(
+                    url, size))
+                r = get_with_retry(url, budget=budget, headers={
+                    'If-Range': if_range, 'Range': 'bytes={}-'.format(size)})
+                r.raise_for_status()
+                if r.status_code != 206:
+                    # La ressource a changé : on recommence depuis le début
+                    f.seek(0)
+                    f.truncate()
+                    size = 0
+                    sha256 = hashlib.sha256()
+
+
 def download(url, media_root, **kwargs):
 
     def get_content_header_param(txt, param):
@@ -94,21 +365,27 @@ def download(url, media_root, **kwargs):
                 return found.groups()[0]
 
     max_size = kwargs.get('max_size')
-
-    for i in range(0, 10):  # Try at least ten times before raise
-        try:
-            r = requests.get(url, stream=True)
-        except Exception as e:
-            logger.exception(e)
-            error = e
-            continue
-        else:
-            break
-    else:
-        raise error
+    workers = kwargs.get('workers') or DOWNLOAD_WORKERS
+
+    # Requête conditionnelle si l'on connaît les validateurs
+    # de la version précédemment téléchargée
+    headers = {}
+    if kwargs.get('etag'):
+        headers['If-None-Match'] = kwargs['etag']
+    if kwargs.get('last_modified'):
+        headers['If-Modified-Since'] = kwargs['last_modified']
+
+    budget = RetryBudget()
+    r = get_with_retry(url, headers=headers, budget=budget)
     r.raise_for_status()
 
-    if int(r.headers.get('Content-Length', 0)) > max_size:
+    if r.status_code == 304:
+        r.close()
+        raise NotModifiedError()
+
+    length = int(r.headers.get('Content-Length', 0))
+    if max_size and length > max_size:
+        r.close()
         raise SizeLimitExceededError(max_size=max_size)
 
     directory = create_dir(media_root)
@@ -120,15 +397,91 @@ def download(url, media_root, **kwargs):
 
     # TODO(@m431m) -> https://github.com/django/django/blob/3c447b108ac70757001171f7a4791f493880bf5b/docs/topics/files.txt#L120
 
-    with open(filename, 'wb') as f:
-        for chunk in r.iter_content(chunk_size=1024):
-            if chunk:
-                f.write(chunk)
-            if os.fstat(f.fileno()).st_size > max_size:
-                remove_dir(directory)
-                raise SizeLimitExceededError(max_size=max_size)
-
-    return directory, filename, r.headers.get('Content-Type')
+    etag = r.headers.get('ETag')
+    last_modified = r.headers.get('Last-Modified')
+
+    # Les requêtes partielles ne sont utilisées que si l'on peut s'assurer
+    # que la ressource ne change pas entre deux requêtes (« If-Range »).
+    if_range = etag and not etag.startswith('W/') and etag or last_modified
+    ranged = r.headers.get('Accept-Ranges') == 'bytes' \
+        and not r.headers.get('Content-Encoding') and if_range or None
+
+    try:
+        sha256 = None
+        if ranged and workers > 1 and length >= DOWNLOAD_RANGE_MIN_SIZE:
+            r.close()
+            try:
+                sha256 = fetch_ranges(
+                    url, filename, length, if_range, workers, budget=budget)
+            except RangeNotHonoredError:
+                logger.warning('Ranges not honored by {}'.format(url))
+                r = get_with_retry(url, budget=budget)
+                r.raise_for_status()
+        if not sha256:
+            sha256 = fetch_stream(
+                url, r, filename, max_size=max_size, if_range=ranged,
+                budget=budget)
+    except Exception:
+        remove_dir(directory)
+        raise
+
+    validators = {
+        'etag': etag,
+        'last_modified': last_modified,
+        'sha256': sha256.hexdigest()}
+
+    return directory, filename, r.headers.get('Content-Type'), validators
+
+
+def probe(url, **kwargs):
+    """Contrôler une ressource distante sans la conserver localement.
+
+    Les mêmes contrôles que ceux de `download` sont appliqués (requête
+    conditionnelle, taille maximale) et les mêmes validateurs sont
+    retournés. L'empreinte (`sha256`) n'est calculée, en parcourant le
+    contenu sans l'écrire, que si le serveur ne fournit aucun validateur
+    ou n'indique pas la taille de la ressource ; sinon elle vaut `None`.
+    """
+    max_size = kwargs.get('max_size')
+
+    headers = {}
+    if kwargs.get('etag'):
+        headers['If-None-Match'] = kwargs['etag']
+    if kwargs.get('last_modified'):
+        headers['If-Modified-Since'] = kwargs['last_modified']
+
+    budget = RetryBudget()
+    r = get_with_retry(url, headers=headers, budget=budget)
+    try:
+        r.raise_for_status()
+        if r.status_code == 304:
+            raise NotModifiedError()
+
+        length = r.headers.get('Content-Length')
+        if max_size and length and int(length) > max_size:
+            raise SizeLimitExceededError(max_size=max_size)
+
+        etag = r.headers.get('ETag')
+        last_modified = r.headers.get('Last-Modified')
+
+        sha256 = None
+        if not (etag or last_modified) or not length:
+            sha256 = hashlib.sha256()
+            size = 0
+            for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if max_size and size > max_size:
+                    raise SizeLimitExceededError(max_size=max_size)
+                sha256.update(chunk)
+    finally:
+        r.close()
+
+    validators = {
+        'etag': etag,
+        'last_modified': last_modified,
+        'sha256': sha256 and sha256.hexdigest()}
+
+    return r.headers.get('Content-Type'), validators
 
 
 class PartialFormatter(string.Formatter):
@@ -321,16 +321,18 @@ class DatasetManager(View):
             layers = resource.get_layers()
             if layers:
                 for layer in resource.get_layers():
+                    # Les informations sont absentes si MRA ne répond pas
+                    mra_info = getattr(layer, 'mra_info', None) or {}
                     layer_row_data = common.copy()
                     layer_row_data.extend((
                         layer.pk,
-                        layer.mra_info['name'],
-                        layer.mra_info['title'],
-                        layer.mra_info['type'],
-                        layer.mra_info['enabled'],
-                        layer.mra_info['bbox'],
-                        layer.mra_info['attributes'],
-                        layer.mra_info['styles'],
+                        mra_info.get('name'),
+                        mra_info.get('title'),
+                        mra_info.get('type'),
+                        mra_info.get('enabled'),
+                        mra_info.get('bbox'),
+                        mra_info.get('attributes'),
+                        mra_info.get('styles'),
                         ))
                     layer_rows.append(layer_row_data)
 
@@ -28,6 +28,7 @@ from django.views.decorators.csrf import csrf_exempt
 from django.views import View
 from idgo_admin.ckan_module import CkanHandler
 from idgo_admin.datagis import intersect
+from idgo_admin.http_client import get_session
 from idgo_admin.models import AsyncExtractorTask
 from idgo_admin.models import BaseMaps
 from idgo_admin.models import Commune
@@ -41,7 +42,6 @@ from idgo_admin.shortcuts import render_with_info_profile
 import json
 from math import ceil
 import re
-import requests
 from uuid import UUID
 
 
@@ -177,7 +177,8 @@ class ExtractorDashboard(View):
             else:
                 if 'abort' in list(task.details.get('possible_requests').keys()):
                     abort = task.details['possible_requests']['abort']
-                    r = requests.request(abort['verb'], abort['url'], json=abort['payload'])
+                    r = get_session('extractor').request(
+                        abort['verb'], abort['url'], json=abort['payload'])
 
                     if r.status_code in (201, 202):
                         messages.success(
@@ -500,7 +501,7 @@ class Extractor(View):
             'data_extractions': data_extractions,
             'additional_files': additional_files}
 
-        r = requests.post(EXTRACTOR_URL, json=query)
+        r = get_session('extractor').post(EXTRACTOR_URL, json=query)
 
         if r.status_code == 201:
             details = r.json()
@@ -14,11 +14,16 @@
 # under the License.
 
 
+import base64
 from django.conf import settings
+from django.contrib.auth import authenticate
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.core.exceptions import ValidationError
 from django.http import Http404
+from django.http import HttpResponse
+from django.http import HttpResponseForbidden
+from django.http import HttpResponseNotModified
 from django.http import HttpResponseRedirect
 from django.shortcuts import get_object_or_404
 from django.shortcuts import redirect
@@ -26,11 +31,16 @@ from django.urls import reverse
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 from django.views import View
+from idgo_admin.datagis import get_cached_tile
+from idgo_admin.datagis import get_tile
+from idgo_admin.datagis import get_tile_table
+from idgo_admin.datagis import is_valid_tile
 from idgo_admin.forms.layer import LayerForm as Form
 from idgo_admin.models import Layer
 from idgo_admin.mra_client import MRAHandler
 from idgo_admin.shortcuts import render_with_info_profile
 from idgo_admin.views.dataset import target as datasets_target
+import hashlib
 import json
 
 
@@ -81,6 +91,7 @@ class LayerView(View):
             messages.error(request, e.__str__())
         else:
             messages.success(request, 'Les informations ont été mise à jour avec succès.')
+        Layer.invalidate_mra_info(layer_id)
 
         if 'save' in request.POST:
             to = reverse('idgo_admin:layer_editor', kwargs={
@@ -157,6 +168,7 @@ class LayerStyleEditorView(View):
         else:
             message = 'Le style a été mis à jour avec succès.'
             messages.success(request, message)
+        Layer.invalidate_mra_info(layer_id)
 
         if 'save' in request.POST:
             to = reverse('idgo_admin:layer_styles', kwargs={
@@ -171,3 +183,73 @@ class LayerStyleEditorView(View):
                 'style_id': style_id})
 
         return HttpResponseRedirect(to)
+
+
+def get_basic_auth_user(request):
+    """Retourner l'utilisateur identifié par l'en-tête HTTP `Authorization`."""
+    try:
+        scheme, credentials = request.META['HTTP_AUTHORIZATION'].split(' ', 1)
+        if scheme.lower() != 'basic':
+            return None
+        username, password = \
+            base64.b64decode(credentials).decode('utf-8').split(':', 1)
+    except (KeyError, ValueError):
+        return None
+    return authenticate(username=username, password=password)
+
+
+@csrf_exempt
+def vector_tile(request, layer_id=None, z=None, x=None, y=None, *args, **kwargs):
+    """Servir une tuile vectorielle (Mapbox Vector Tile) de la couche.
+
+    Les règles d'accès sont celles des services OGC (Cf. `auth_ogc`) :
+    une couche désactivée (notamment lorsque la ressource est restreinte
+    au territoire de compétence) n'est pas servie ; une ressource publique
+    est accessible à tous, sinon l'utilisateur (identifié par sa session
+    ou par authentification HTTP) doit y être autorisé.
+    """
+    z, x, y = int(z), int(x), int(y)
+    if not is_valid_tile(z, x, y):
+        raise Http404()
+
+    layer = Layer.objects.filter(
+        name=layer_id, type='vector').select_related('resource').first()
+    if not layer:
+        raise Http404()
+    resource = layer.resource
+
+    if not resource.ogc_services:
+        raise Http404()
+    # État de la couche dans MapServer, s'il est connu (Cf. `Layer.mra_info`)
+    mra_info = getattr(layer, 'mra_info', None)
+    if mra_info and not mra_info.get('enabled'):
+        raise Http404()
+
+    if not resource.anonymous_access:
+        user = request.user.is_authenticated and request.user \
+            or get_basic_auth_user(request)
+        if not user or not user.is_active \
+                or not resource.is_profile_authorized(user):
+            return HttpResponseForbidden()
+
+    # La version de la couche est l'identifiant de son dernier chargement
+    # (Cf. `load_layer`) ; à défaut, la date de mise à jour de la ressource.
+    summary = layer.summary or {}
+    version = summary.get('load') or hashlib.md5(
+        str(resource.last_update).encode('utf-8')).hexdigest()[:12]
+    etag = '"{}-{}-{}-{}"'.format(version, z, x, y)
+    if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+        return HttpResponseNotModified()
+
+    table = get_tile_table(layer_id, summary.get('generalized'), z)
+    tile = get_cached_tile(
+        layer_id, version, z, x, y,
+        lambda: get_tile(
+            table, z, x, y, layer_name=layer_id,
+            columns=summary.get('tile_columns')))
+
+    response = HttpResponse(tile, content_type='application/vnd.mapbox-vector-tile')
+    response['ETag'] = etag
+    response['Cache-Control'] = \
+        resource.anonymous_access and 'public, no-cache' or 'private, no-cache'
+    return response
@@ -276,6 +276,12 @@ class ResourceManager(View):
                 id and 'mise à jour' or 'créée', dataset_href,
                 CKAN_URL, dataset.slug, resource.ckan_id))
 
+            for report in resource.quarantine_report or []:
+                messages.warning(request, (
+                    'Couche « {table} » : {repaired} géométrie(s) réparée(s) '
+                    'et {quarantined} objet(s) écarté(s) car non valides.'
+                    ).format(**report))
+
             if ajax:
                 response = HttpResponse(status=201)  # Ugly hack
                 if save_and_continue:
@@ -16,13 +16,15 @@
 
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
+from django.http import Http404
 from django.http import HttpResponse
 from django.http import JsonResponse
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 from django.views import View
+from idgo_admin.http_client import get_session
+from idgo_admin.http_client import SessionPool
 from idgo_admin.models import License
-import requests
 
 
 OWS_PREVIEW_URL = settings.OWS_PREVIEW_URL
@@ -56,7 +58,19 @@ class DisplayLicenses(View):
 @csrf_exempt
 def ows_preview(request):
 
-    r = requests.get(
-        OWS_PREVIEW_URL, params=dict(request.GET), timeout=MAPSERV_TIMEOUT)
+    r = get_session('mapserver', deadline=MAPSERV_TIMEOUT).get(
+        OWS_PREVIEW_URL, params=dict(request.GET))
     r.raise_for_status()
     return HttpResponse(r.content, content_type=r.headers['Content-Type'])
+
+
+@login_required(login_url=settings.LOGIN_URL)
+@csrf_exempt
+def http_stats(request):
+
+    # Accès réservé aux administrateurs IDGO
+    if not request.user.is_admin:
+        raise Http404()
+
+    # Statistiques du processus ayant traité la requête
+    return JsonResponse(SessionPool.stats())